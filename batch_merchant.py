@@ -0,0 +1,243 @@
+"""
+End-of-day batch exports: all of a merchant's invoices for a period, or one
+customer's statement, as a single multi-invoice PDF or a zip of PDFs.
+
+Runs on its own queue (batch_jobs, `worker_merchant.py --batches`) so a month
+of invoices never holds up interactive messages. Orders stream in chunks from
+db_merchant.iter_orders_merchant and are rendered as they arrive:
+
+  zip  one PDF per invoice, written into the archive one at a time;
+       memory stays flat however many orders there are
+  pdf  one document with every invoice; ReportLab keeps the (compressed)
+       page streams until save, roughly 1-2 KB per invoice
+
+'auto' picks pdf up to BATCH_PDF_MAX_ORDERS orders and zip beyond that.
+
+    python batch_merchant.py <merchant phone> [--period this_month] [--customer Ramesh] [--format zip]
+"""
+import io
+import os
+import re
+import time
+import secrets
+import zipfile
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from db_merchant import ensure_db, get_user_by_phone, count_orders_merchant, iter_orders_merchant, find_customer_merchant, UTC_OFFSET
+from metrics_merchant import job_scope, stage
+
+BATCH_QUEUE = 'batch_jobs'
+BATCH_FOLDER = "static/batches"
+BATCH_PDF_MAX_ORDERS = int(os.getenv("BATCH_PDF_MAX_ORDERS", "500"))
+BATCH_JOB_TIMEOUT = int(os.getenv("BATCH_JOB_TIMEOUT", "1800"))
+
+# Periods are calendar days in the merchant's time zone (db_merchant.UTC_OFFSET)
+PERIODS = ('today', 'yesterday', 'this_week', 'this_month', 'last_month')
+
+def period_range(period, now=None):
+    """(start, end) as naive UTC datetimes for a named period in local time."""
+    local = (now or datetime.now(timezone.utc).replace(tzinfo=None)) + UTC_OFFSET
+    day = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'today':
+        start, end = day, day + timedelta(days=1)
+    elif period == 'yesterday':
+        start, end = day - timedelta(days=1), day
+    elif period == 'this_week':
+        start, end = day - timedelta(days=day.weekday()), day + timedelta(days=1)
+    elif period == 'this_month':
+        start, end = day.replace(day=1), day + timedelta(days=1)
+    elif period == 'last_month':
+        end = day.replace(day=1)
+        start = (end - timedelta(days=1)).replace(day=1)
+    else:
+        raise ValueError(f"Unknown period {period!r}, expected one of {PERIODS}")
+    return start - UTC_OFFSET, end - UTC_OFFSET
+
+def period_days(period, now=None):
+    """(first, last) local dates of a named period, both inclusive."""
+    start, end = period_range(period, now)
+    return (start + UTC_OFFSET).date(), (end + UTC_OFFSET - timedelta(days=1)).date()
+
+# ==========================================
+# 1. WRITERS
+# ==========================================
+
+def _summary_row(order):
+    created_at = order.get('created_at')
+    if isinstance(created_at, str):
+        try: created_at = datetime.fromisoformat(created_at)
+        except ValueError: created_at = None
+    if isinstance(created_at, datetime):
+        created_at = created_at.replace(tzinfo=None) + UTC_OFFSET
+    return (created_at, order.get('invoice_number') or f"INV-{order['id']:04d}",
+            float(order.get('final_amount') or 0), order.get('payment_status') or 'unpaid')
+
+def write_pdf(orders, filepath, statement=None):
+    """Every order into one PDF, each invoice starting on a new page. Returns the number of orders."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from utils_pdf_merchant import render_invoice
+
+    c = canvas.Canvas(filepath, pagesize=A4, invariant=1, pageCompression=1)
+    n, rows = 0, []
+    for order in orders:
+        render_invoice(c, order)
+        c.showPage()
+        n += 1
+        if statement is not None: rows.append(_summary_row(order))
+    if statement is not None and n:
+        render_statement_summary(c, statement, rows)
+        c.showPage()
+    if n: c.save()
+    return n
+
+def write_zip(orders, filepath, statement=None):
+    """One PDF per order inside a zip, written as each is rendered. Returns the number of orders."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from utils_pdf_merchant import render_invoice
+
+    n, rows = 0, []
+    with zipfile.ZipFile(filepath, "w", zipfile.ZIP_DEFLATED) as zf:
+        for order in orders:
+            buf = io.BytesIO()
+            c = canvas.Canvas(buf, pagesize=A4, invariant=1)
+            render_invoice(c, order)
+            c.save()
+            name = order.get('invoice_number') or f"INV-{order['id']:04d}"
+            zf.writestr(f"{re.sub(r'[^A-Za-z0-9_-]+', '_', name)}.pdf", buf.getvalue())
+            n += 1
+            if statement is not None: rows.append(_summary_row(order))
+        if statement is not None and n:
+            buf = io.BytesIO()
+            c = canvas.Canvas(buf, pagesize=A4, invariant=1)
+            render_statement_summary(c, statement, rows)
+            c.save()
+            zf.writestr("statement_summary.pdf", buf.getvalue())
+    return n
+
+def render_statement_summary(c, statement, rows):
+    """Closing page(s) of a customer statement: one line per invoice, then totals."""
+    from reportlab.lib.pagesizes import A4
+    width, height = A4
+
+    def header():
+        c.setFont("Helvetica-Bold", 16)
+        c.drawString(50, height - 50, f"Statement: {statement['customer_name']}")
+        c.setFont("Helvetica", 10)
+        c.drawString(50, height - 65, f"{statement['business_name']}  |  {statement['period_label']}")
+        c.setFont("Helvetica-Bold", 10)
+        y = height - 100
+        c.drawString(50, y, "DATE")
+        c.drawString(150, y, "INVOICE")
+        c.drawString(300, y, "STATUS")
+        c.drawRightString(width - 50, y, "AMOUNT")
+        c.setFont("Helvetica", 10)
+        return y - 20
+
+    y = header()
+    total = paid = 0.0
+    for created_at, invoice_no, amount, status in rows:
+        date = created_at.strftime("%d-%b-%Y") if created_at else ''
+        c.drawString(50, y, date)
+        c.drawString(150, y, invoice_no)
+        c.drawString(300, y, status)
+        c.drawRightString(width - 50, y, f"{amount:.2f}")
+        total += amount
+        if status == 'paid': paid += amount
+        y -= 16
+        if y < 100:
+            c.showPage()
+            y = header()
+
+    c.line(50, y - 5, width - 50, y - 5)
+    c.setFont("Helvetica-Bold", 12)
+    for label, value in (("Total billed", total), ("Paid", paid), ("Outstanding", total - paid)):
+        y -= 20
+        c.drawString(300, y, label)
+        c.drawRightString(width - 50, y, f"INR {value:.2f}")
+
+# ==========================================
+# 2. JOB
+# ==========================================
+
+def build_batch(merchant_phone, period='today', customer_name=None, fmt='auto', base_url=""):
+    """
+    Renders the batch and returns (url, count, fmt), or (None, 0, reason) when
+    there is nothing to export.
+    """
+    start, end = period_range(period)
+    customer = None
+    if customer_name:
+        # Exact name only: a fuzzy match could send another customer's ledger
+        customer = find_customer_merchant(merchant_phone, customer_name)
+        if not customer: return None, 0, "customer_not_found"
+    customer_id = customer['id'] if customer else None
+
+    count = count_orders_merchant(merchant_phone, start, end, customer_id)
+    if not count: return None, 0, "no_orders"
+    if fmt == 'auto':
+        fmt = 'pdf' if count <= BATCH_PDF_MAX_ORDERS else 'zip'
+
+    merchant = get_user_by_phone(merchant_phone)
+    statement = None
+    if customer:
+        local_end = end + UTC_OFFSET - timedelta(days=1)
+        statement = {
+            'customer_name': customer['name'],
+            'business_name': merchant.get('business_name') or "My Business",
+            'period_label': f"{(start + UTC_OFFSET):%d-%b-%Y} to {local_end:%d-%b-%Y}",
+        }
+
+    os.makedirs(BATCH_FOLDER, exist_ok=True)
+    kind = f"statement_{customer_id}" if customer else "invoices"
+    # Served from a public static path: the token keeps the URL from being guessed
+    filename = f"{kind}_{merchant['id']}_{period}_{(start + UTC_OFFSET):%Y%m%d}_{int(time.time())}_{secrets.token_urlsafe(16)}.{fmt}"
+    filepath = os.path.join(BATCH_FOLDER, filename)
+    tmppath = f"{filepath}.{os.getpid()}.tmp"
+
+    orders = iter_orders_merchant(merchant_phone, start, end, customer_id)
+    try:
+        with stage("batch_render"):
+            written = (write_zip if fmt == 'zip' else write_pdf)(orders, tmppath, statement)
+    except Exception:
+        if os.path.exists(tmppath): os.remove(tmppath)
+        raise
+    if not written: return None, 0, "no_orders"
+    os.replace(tmppath, filepath)
+    return f"{base_url}/{filepath}", written, fmt
+
+def batch_invoices_job(merchant_phone, period='today', customer_name=None, fmt='auto', base_url=""):
+    """batch_jobs entry point: builds the export and sends the merchant the file or link."""
+    from tasks_merchant import send_whatsapp
+    ensure_db()
+    with job_scope("batch_invoices"):
+        try:
+            url, count, fmt = build_batch(merchant_phone, period, customer_name, fmt, base_url)
+        except Exception as e:
+            print(f"Batch Error: {e}")
+            send_whatsapp(merchant_phone, "⚠️ Could not prepare the invoices. Please try again.", wait=True)
+            raise
+        label = period.replace('_', ' ')
+        if url is None:
+            text = f"⚠️ No customer matching '{customer_name}'." if fmt == "customer_not_found" else f"ℹ️ No confirmed orders for {label}."
+            send_whatsapp(merchant_phone, text, wait=True)
+        elif fmt == 'pdf':
+            what = f"Statement for {customer_name}" if customer_name else f"{count} invoices"
+            send_whatsapp(merchant_phone, f"📄 {what} ({label})", media_url=url, wait=True)
+        else:
+            # WhatsApp can't carry a zip as media: send the link
+            send_whatsapp(merchant_phone, f"📦 {count} invoices ({label}): {url}", wait=True)
+        return url
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a merchant's invoices or a customer statement")
+    parser.add_argument("merchant_phone")
+    parser.add_argument("--period", default="today", choices=PERIODS)
+    parser.add_argument("--customer", help="customer name for a statement")
+    parser.add_argument("--format", default="auto", choices=("auto", "pdf", "zip"))
+    args = parser.parse_args()
+    ensure_db()
+    url, count, fmt = build_batch(args.merchant_phone, args.period, args.customer, args.format)
+    print(f"✅ {count} orders -> {url.lstrip('/')}" if url else f"Nothing exported ({fmt})")
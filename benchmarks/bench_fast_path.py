@@ -0,0 +1,93 @@
+"""
+Fast-path parser benchmark.
+
+Runs a corpus of typical merchant messages through parser_merchant and
+reports how many skipped Gemini, how long parsing took, and the LLM time
+saved at the given per-call latency. No network or DB needed.
+
+    python benchmarks/bench_fast_path.py [--llm-latency 1.8] [--repeat 200] [--corpus file.txt]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache_merchant import make_catalog
+from parser_merchant import parse_order
+
+CATALOG = [
+    {'id': 1, 'name': 'Aashirvaad Atta', 'alias': 'atta, gehu atta', 'unit': 'kg', 'price': 42, 'hsn_code': '1101'},
+    {'id': 2, 'name': 'Lux Soap', 'alias': 'soap, sabun', 'unit': 'pcs', 'price': 32, 'hsn_code': '3401'},
+    {'id': 3, 'name': 'Tata Tea Premium', 'alias': 'chai, chai patti', 'unit': 'packet', 'price': 120, 'hsn_code': '0902'},
+    {'id': 4, 'name': 'Basmati Rice', 'alias': 'chawal, rice', 'unit': 'kg', 'price': 90, 'hsn_code': '1006'},
+    {'id': 5, 'name': 'Sugar', 'alias': 'cheeni, chini', 'unit': 'kg', 'price': 44, 'hsn_code': '1701'},
+    {'id': 6, 'name': 'Fortune Mustard Oil', 'alias': 'sarson tel, mustard oil', 'unit': 'ltr', 'price': 165, 'hsn_code': '1514'},
+    {'id': 7, 'name': 'Toor Dal', 'alias': 'arhar dal, dal', 'unit': 'kg', 'price': 140, 'hsn_code': '0713'},
+    {'id': 8, 'name': 'Parle G', 'alias': 'biscuit', 'unit': 'packet', 'price': 10, 'hsn_code': '1905'},
+    {'id': 9, 'name': 'Surf Excel', 'alias': 'surf, detergent', 'unit': 'kg', 'price': 130, 'hsn_code': '3402'},
+    {'id': 10, 'name': 'Amul Butter', 'alias': 'butter, makhan', 'unit': 'pcs', 'price': 56, 'hsn_code': '0405'},
+]
+
+CORPUS = [
+    "Ramesh: 10 kg atta @ 42, 5 pcs soap @ 30",
+    "Suresh ko do packet chai 120 ka aur 1 bori chawal",
+    "for Mahesh Traders - 2kg sugar, 3 lux soap",
+    "Gupta ji: aadha kg cheeni, dedh dozen soap",
+    "10 kg atta",
+    "Sharma Store: 5 ltr sarson tel @ 160, 10 kg toor dal, 20 packet parle g",
+    "रमेश को 5 किलो चीनी",
+    "Vijay: 2 kg surf @ 125; 4 amul butter",
+    "Anil ke liye 25 kg basmati rice 85 ka",
+    "Pooja: 1 surf excel, 2 parle g, 1 tata tea",
+    # Free-form messages that should fall through to Gemini
+    "bhai kal wala order cancel kar do",
+    "Ramesh ka payment aa gaya kya?",
+    "remind me to call Suresh at 5",
+    "hello",
+    "aaj ki sale kitni hui?",
+    "Ramesh: 10 kg maida, 5 kg besan",
+    "jo pichli baar bheja tha wahi bhej do",
+    "Mahesh ko 3 carton Maggi",
+]
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--llm-latency", type=float, default=1.8, help="seconds per Gemini call to assume")
+    ap.add_argument("--repeat", type=int, default=200)
+    ap.add_argument("--corpus", help="one message per line (default: built-in corpus)")
+    args = ap.parse_args()
+
+    corpus = CORPUS
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    catalog = make_catalog(CATALOG)
+    parse_order(corpus[0], catalog)   # build the product index outside the timings
+
+    hits, timings = 0, []
+    for msg in corpus:
+        samples = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            res = parse_order(msg, catalog)
+            samples.append(time.perf_counter() - t0)
+        timings.append(statistics.median(samples))
+        hits += res is not None
+        tag = "FAST" if res else "LLM "
+        print(f"  [{tag}] {msg[:60]}")
+
+    n = len(corpus)
+    parse_ms = [t * 1000 for t in timings]
+    saved = hits * args.llm_latency - sum(timings)
+    print()
+    print(f"messages:          {n}")
+    print(f"fast path:         {hits} ({hits / n:.0%})")
+    print(f"parse time:        p50 {statistics.median(parse_ms):.3f} ms, max {max(parse_ms):.3f} ms")
+    print(f"LLM calls avoided: {hits} x {args.llm_latency:.2f} s")
+    print(f"latency saved:     {saved:.2f} s total, {saved / n:.2f} s per message")
+
+if __name__ == '__main__':
+    main()
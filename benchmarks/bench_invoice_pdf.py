@@ -0,0 +1,129 @@
+"""
+Invoice PDF benchmark: invoices/second for 5-, 50- and 500-line orders,
+cached-template renderer vs. the previous canvas-per-call implementation.
+
+    python benchmarks/bench_invoice_pdf.py [--seconds 3] [--lines 5,50,500]
+
+Orders are synthetic and passed in directly, so no DB is needed.
+"""
+import os
+import sys
+import time
+import tempfile
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+from reportlab.lib import colors
+
+import utils_pdf_merchant
+
+def make_order(n_lines, order_id=42):
+    items = [{
+        'product_name': f"Product number {i} with a reasonably long name",
+        'quantity': float(i % 7 + 1),
+        'unit_price': 12.5 + i,
+        'total_price': (i % 7 + 1) * (12.5 + i),
+    } for i in range(n_lines)]
+    return {
+        'id': order_id, 'invoice_number': None, 'customer_name': 'Ramesh Kumar',
+        'business_name': 'Sharma General Store', 'merchant_phone': '+919800000000',
+        'items': items, 'final_amount': sum(i['total_price'] for i in items),
+        'created_at': datetime(2026, 1, 15, 10, 30),
+    }
+
+def legacy_render(filepath, order):
+    """The drawing code of the previous generate_invoice_pdf, minus the DB fetch."""
+    order_id = order['id']
+    invoice_no = order.get('invoice_number') or f"INV-{order_id:04d}"
+    customer_name = order.get('customer_name', 'Cash Customer')
+    merchant_name = order.get('business_name') or "My Business"
+    merchant_phone = order.get('merchant_phone', '')
+    items = order.get('items', [])
+    final_amount = order.get('final_amount', 0.0)
+    date_str = order['created_at'].strftime("%d-%b-%Y")
+
+    c = canvas.Canvas(filepath, pagesize=A4)
+    width, height = A4
+    c.setFont("Helvetica-Bold", 20)
+    c.drawString(50, height - 50, merchant_name)
+    c.setFont("Helvetica", 10)
+    c.drawString(50, height - 65, f"Phone: {merchant_phone}")
+    c.setFont("Helvetica-Bold", 16)
+    c.drawRightString(width - 50, height - 50, "INVOICE")
+    c.setFont("Helvetica", 10)
+    c.drawRightString(width - 50, height - 70, f"# {invoice_no}")
+    c.drawRightString(width - 50, height - 85, f"Date: {date_str}")
+    c.setStrokeColor(colors.lightgrey)
+    c.line(50, height - 100, width - 50, height - 100)
+    c.setFillColor(colors.black)
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(50, height - 130, "Bill To:")
+    c.setFont("Helvetica", 12)
+    c.drawString(50, height - 145, customer_name)
+    y = height - 180
+    c.setFillColor(colors.whitesmoke)
+    c.rect(50, y - 5, width - 100, 20, fill=True, stroke=False)
+    c.setFillColor(colors.black)
+    c.setFont("Helvetica-Bold", 10)
+    c.drawString(60, y, "ITEM")
+    c.drawString(300, y, "QTY")
+    c.drawString(380, y, "RATE")
+    c.drawRightString(width - 60, y, "TOTAL")
+    y -= 25
+    c.setFont("Helvetica", 10)
+    for item in items:
+        name = item.get('product_name', 'Item')
+        qty = item.get('quantity', 0)
+        rate = item.get('unit_price', 0)
+        total = item.get('total_price', 0)
+        if len(name) > 40: name = name[:37] + "..."
+        c.drawString(60, y, name)
+        c.drawString(300, y, str(qty))
+        c.drawString(380, y, f"{rate:.2f}")
+        c.drawRightString(width - 60, y, f"{total:.2f}")
+        y -= 20
+        if y < 100:
+            c.showPage()
+            y = height - 50
+    c.setStrokeColor(colors.black)
+    c.line(50, y - 10, width - 50, y - 10)
+    y -= 40
+    c.setFont("Helvetica-Bold", 14)
+    c.drawString(300, y, "Total Amount:")
+    c.drawRightString(width - 60, y, f"INR {final_amount:.2f}")
+    c.setFont("Helvetica-Oblique", 8)
+    c.setFillColor(colors.grey)
+    c.drawCentredString(width / 2, 30, "Generated via MinA - Your AI Business Assistant")
+    c.save()
+
+def rate(fn, seconds):
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        fn()
+        n += 1
+    return n / (time.perf_counter() - t0)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--seconds", type=float, default=3.0, help="time budget per measurement")
+    ap.add_argument("--lines", default="5,50,500")
+    ap.add_argument("--out-dir", help="where PDFs are written (default: a temp dir; use tmpfs to leave disk out)")
+    args = ap.parse_args()
+
+    out_dir = args.out_dir or tempfile.mkdtemp(prefix="mina_pdf_bench_")
+    utils_pdf_merchant.STATIC_FOLDER = out_dir
+    legacy_path = os.path.join(out_dir, "legacy.pdf")
+
+    print(f"{'lines':>6} {'legacy inv/s':>13} {'new inv/s':>10} {'speedup':>8}")
+    for n in [int(x) for x in args.lines.split(",")]:
+        order = make_order(n)
+        old = rate(lambda: legacy_render(legacy_path, order), args.seconds)
+        new = rate(lambda: utils_pdf_merchant.generate_invoice_pdf(order['id'], base_url="", order=order, force=True), args.seconds)
+        print(f"{n:>6} {old:>13.1f} {new:>10.1f} {new / old:>7.2f}x")
+
+if __name__ == '__main__':
+    main()
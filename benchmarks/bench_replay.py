@@ -0,0 +1,235 @@
+"""
+Offline load replay for tasks_merchant.process_message.
+
+Replays webhook payloads (text, audio, image and confirmations) through the
+real message path against SQLite or a local Postgres, with Gemini, Twilio
+and media downloads replaced by in-process fakes with configurable latency.
+No network needed. Reports messages/s, latency percentiles, DB queries per
+message, per-stage times and PDF render time.
+
+    python benchmarks/bench_replay.py [--rounds 5] [--concurrency 4] [--llm-latency 0.8]
+                                      [--corpus payloads.jsonl] [--database-url postgresql://...]
+                                      [--redis fake|none]
+
+A corpus file has one webhook payload per line as JSON, with the fields
+process_message reads (from, body, num_media, media_url, media_type,
+message_sid). Each round replays the corpus as a fresh merchant, so the
+intent cache starts cold every round.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CORPUS = [
+    {"body": "Ramesh: 10 kg atta @ 42, 5 pcs soap @ 30", "num_media": 0},
+    {"body": "1", "num_media": 0},
+    {"body": "Suresh ko do packet chai 120 ka aur 1 bori chawal", "num_media": 0},
+    {"body": "yes", "num_media": 0},
+    {"body": "Ramesh ka payment aa gaya kya?", "num_media": 0},
+    {"body": "", "num_media": 1, "media_url": "fake://audio/order", "media_type": "audio/ogg"},
+    {"body": "1", "num_media": 0},
+    {"body": "Mahesh ko 3 carton Maggi", "num_media": 0},
+    {"body": "", "num_media": 1, "media_url": "fake://image/list", "media_type": "image/jpeg"},
+    {"body": "aaj ki sale kitni hui?", "num_media": 0},
+    {"body": "Sharma Store: 5 ltr sarson tel @ 160, 10 kg toor dal, 20 packet parle g", "num_media": 0},
+    {"body": "ha", "num_media": 0},
+    {"body": "hello", "num_media": 0},
+    {"body": "Vijay: 2 kg surf @ 125; 4 amul butter", "num_media": 0},
+]
+
+# ==========================================
+# FAKES
+# ==========================================
+
+class FakeModel:
+    """Stands in for GenerativeModel: sleeps, then answers like Gemini would."""
+
+    def __init__(self, latency, catalog):
+        self.latency = latency
+        self.catalog = catalog
+        self.calls = 0
+
+    def generate_content(self, contents):
+        self.calls += 1
+        time.sleep(self.latency * random.uniform(0.7, 1.3))
+        media = any(isinstance(c, dict) for c in contents)
+        text = " ".join(c for c in contents[1:] if isinstance(c, str))
+        if media or any(ch.isdigit() for ch in text):
+            p = self.catalog[self.calls % len(self.catalog)]
+            out = {"intent": "CREATE_ORDER", "reply_text": "",
+                   "data": {"customer_name": "Walk-in", "items": [{"product": p["name"], "qty": 2, "rate": p["price"]}]}}
+        else:
+            out = {"intent": "CHAT", "data": {}, "reply_text": "Noted 👍"}
+
+        class Res: pass
+        res = Res()
+        res.text = "```json\n" + json.dumps(out) + "\n```"
+        return res
+
+class FakeTwilio:
+    """Client.messages.create with a delay."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+        self.messages = self
+        self._lock = threading.Lock()
+
+    def create(self, **msg):
+        time.sleep(self.latency)
+        with self._lock:
+            self.sent += 1
+
+def fake_photo(size):
+    """A noisy phone-camera-sized JPEG of roughly `size` bytes, or None without Pillow."""
+    try:
+        import io
+        from PIL import Image
+    except ImportError:
+        return None
+    rng = random.Random(size)
+    img = Image.frombytes("RGB", (1500, 2000), rng.randbytes(1500 * 2000 * 3)).resize((3000, 4000))
+    for quality in (90, 75, 50, 30, 15):
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=quality)
+        if buf.tell() <= size: break
+    return buf.getvalue()
+
+def fake_download(latency, size):
+    photo = fake_photo(size)
+    def download(url, auth=None, max_bytes=None):
+        time.sleep(latency)
+        if photo and "image" in url: return photo + url.encode()
+        return (url.encode() * (size // max(len(url), 1) + 1))[:size]
+    return download
+
+# ==========================================
+# REPLAY
+# ==========================================
+
+def percentile(sorted_values, p):
+    if not sorted_values: return 0.0
+    i = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+def load_corpus(path):
+    if not path: return CORPUS
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--rounds", type=int, default=5, help="times the corpus is replayed, each as a new merchant")
+    ap.add_argument("--concurrency", type=int, default=1, help="merchants replayed in parallel")
+    ap.add_argument("--corpus", help="JSONL of webhook payloads (default: built-in)")
+    ap.add_argument("--llm-latency", type=float, default=0.8)
+    ap.add_argument("--twilio-latency", type=float, default=0.25)
+    ap.add_argument("--media-latency", type=float, default=0.3)
+    ap.add_argument("--media-bytes", type=int, default=2_000_000)
+    ap.add_argument("--database-url", help="default: a throwaway SQLite file")
+    ap.add_argument("--redis", choices=["none", "fake"], default="none", help="fake needs the fakeredis package")
+    args = ap.parse_args()
+
+    # Configure before the app modules read their env
+    workdir = tempfile.mkdtemp(prefix="mina_replay_")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["REDIS_URL"] = "" if args.redis == "none" else "redis://fake"
+    os.environ.setdefault("SEND_SHARDS", "4")
+    os.environ.setdefault("DB_POOL_SIZE", str(max(args.concurrency, 1)))
+    os.chdir(workdir)   # PDFs land in <workdir>/static/invoices
+
+    import redis_merchant
+    if args.redis == "fake":
+        import fakeredis
+        redis_merchant._client = fakeredis.FakeRedis()
+
+    import http_merchant
+    import metrics_merchant
+    import tasks_merchant
+    import media_merchant
+    from db_merchant import add_product_merchant
+    from bench_fast_path import CATALOG
+
+    model = FakeModel(args.llm_latency, CATALOG)
+    twilio = FakeTwilio(args.twilio_latency)
+    tasks_merchant._model = model
+    http_merchant._twilio = twilio
+    http_merchant.download = fake_download(args.media_latency, args.media_bytes)
+
+    corpus = load_corpus(args.corpus)
+    print(f"⏱️ warm-up: {tasks_merchant.warm_up(llm=False)}")
+
+    merchants = [f"whatsapp:+9199{r:08d}" for r in range(args.rounds)]
+    for phone in merchants:
+        for p in CATALOG:
+            add_product_merchant(phone, p["name"], **{k: v for k, v in p.items() if k not in ("id", "name")})
+
+    latencies = []
+    lat_lock = threading.Lock()
+
+    def replay(round_no, phone):
+        # One merchant's messages run in order, as the worker guarantees per sender
+        for i, payload in enumerate(corpus):
+            data = dict(payload, **{"from": phone, "message_sid": f"SM{round_no:04d}{i:05d}"})
+            t0 = time.perf_counter()
+            try:
+                tasks_merchant.process_message(data)
+            except Exception as e:
+                print(f"❌ {data['message_sid']}: {e}")
+            with lat_lock:
+                latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max(args.concurrency, 1)) as pool:
+        list(pool.map(replay, range(args.rounds), merchants))
+    elapsed = time.perf_counter() - t0
+
+    if args.redis == "fake":
+        # Invoices were queued to invoice_jobs: render them the way the pool would
+        from rq import Queue, SimpleWorker
+        q = Queue(tasks_merchant.INVOICE_QUEUE, connection=redis_merchant._client)
+        SimpleWorker([q], connection=redis_merchant._client).work(burst=True, logging_level="WARNING")
+    http_merchant.flush_sends()
+
+    n = len(latencies)
+    lat_ms = sorted(x * 1000 for x in latencies)
+    jobs = metrics_merchant.summary("mina_job_db_queries")
+    q_count, q_sum = jobs.get((("job", "process_message"),), (0, 0))
+    stages = metrics_merchant.summary("mina_stage_seconds")
+    intents = defaultdict(int)
+    for labels, v in metrics_merchant.counter_values("mina_intents_total").items():
+        intents[dict(labels)["source"]] += v
+
+    print()
+    print(f"messages:        {n} ({args.rounds} rounds x {len(corpus)}), concurrency {args.concurrency}")
+    print(f"throughput:      {n / elapsed:.1f} msg/s ({elapsed:.2f} s)")
+    print(f"latency:         p50 {percentile(lat_ms, 50):.1f} ms, p95 {percentile(lat_ms, 95):.1f} ms, "
+          f"p99 {percentile(lat_ms, 99):.1f} ms, mean {statistics.mean(lat_ms):.1f} ms")
+    print(f"db queries/msg:  {q_sum / q_count:.2f}" if q_count else "db queries/msg:  n/a")
+    print(f"intent sources:  " + ", ".join(f"{k} {v}" for k, v in sorted(intents.items())))
+    print(f"llm calls:       {model.calls}, twilio sends: {twilio.sent}")
+    print("stages (avg):    " + ", ".join(
+        f"{dict(labels)['stage']} {total / count * 1000:.1f} ms x{count}"
+        for labels, (count, total) in sorted(stages.items()) if count))
+    m = media_merchant.MEDIA_STATS
+    if m["bytes_in"]:
+        print(f"media:           {m['bytes_in'] // 1024} KB -> {m['bytes_out'] // 1024} KB "
+              f"({1 - m['bytes_out'] / m['bytes_in']:.0%} smaller), {m['cache_hits']} cache hits")
+    pdf = stages.get((("stage", "pdf"),))
+    if pdf and pdf[0]:
+        print(f"pdf render:      {pdf[1] / pdf[0] * 1000:.1f} ms avg over {pdf[0]} invoices")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Catalog retrieval benchmark.
+
+Pads the fast-path catalog with generated SKUs up to --size products, then
+for each corpus message reports whether the products it names made the
+top-K list, the retrieval time, and the prompt's product list size with and
+without retrieval. No network or DB needed.
+
+    python benchmarks/bench_retrieval.py [--size 5000] [--top-k 50] [--repeat 50]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cache_merchant import make_catalog
+from matching_merchant import CatalogRetriever
+
+from bench_fast_path import CATALOG
+
+# (message, ids of the products it mentions)
+CORPUS = [
+    ("Ramesh: 10 kg atta @ 42, 5 pcs soap @ 30", {1, 2}),
+    ("Suresh ko do packet chai 120 ka aur 1 bori chawal", {3, 4}),
+    ("for Mahesh Traders - 2kg sugar, 3 lux soap", {5, 2}),
+    ("Gupta ji: aadha kg cheeni, dedh dozen sabun", {5, 2}),
+    ("Sharma Store: 5 ltr sarson tel @ 160, 10 kg toor dal, 20 packet parle g", {6, 7, 8}),
+    ("रमेश को 5 किलो चीनी", {5}),
+    ("Vijay: 2 kg surf @ 125; 4 amul butter", {9, 10}),
+    ("Pooja: 1 surf excel, 2 parleg, 1 tata tee", {9, 8, 3}),
+    ("Anil ko 3 makhan aur 2 kilo arhar daal", {10, 7}),
+]
+
+BRANDS = ["Tata", "Fortune", "Patanjali", "Aashirvaad", "Saffola", "Dabur", "Britannia", "Haldiram", "MDH", "Everest",
+          "Catch", "Nestle", "Amul", "Mother Dairy", "Parle", "Sunfeast", "Colgate", "Dettol", "Vim", "Harpic"]
+ITEMS = ["Besan", "Maida", "Suji", "Poha", "Moong Dal", "Chana Dal", "Rajma", "Kabuli Chana", "Jeera", "Haldi Powder",
+         "Mirchi Powder", "Dhania Powder", "Garam Masala", "Sunflower Oil", "Ghee", "Paneer", "Cheese Slice", "Noodles",
+         "Ketchup", "Pickle", "Namkeen", "Cookies", "Rusk", "Toothpaste", "Shampoo", "Handwash", "Dishwash Bar",
+         "Floor Cleaner", "Agarbatti", "Matchbox", "Candle", "Salt", "Jaggery", "Honey", "Oats", "Cornflakes"]
+SIZES = ["100g", "200g", "500g", "1kg", "5kg", "250ml", "500ml", "1L", "5L", "Pack of 6", "Jar", "Pouch"]
+
+def make_products(size, seed=7):
+    rng = random.Random(seed)
+    rows = [dict(p) for p in CATALOG]
+    next_id = len(rows) + 1
+    while len(rows) < size:
+        name = f"{rng.choice(BRANDS)} {rng.choice(ITEMS)} {rng.choice(SIZES)}"
+        rows.append({'id': next_id, 'name': name, 'alias': '', 'unit': 'pcs',
+                     'price': rng.randint(10, 500), 'hsn_code': str(rng.randint(1000, 9999))})
+        next_id += 1
+    return rows
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--size", type=int, default=5000, help="products in the catalog")
+    ap.add_argument("--top-k", type=int, default=50)
+    ap.add_argument("--repeat", type=int, default=50)
+    args = ap.parse_args()
+
+    catalog = make_catalog(make_products(args.size))
+    t0 = time.perf_counter()
+    retriever = CatalogRetriever(catalog.products)
+    build_ms = (time.perf_counter() - t0) * 1000
+    names = {p.id: p.name for p in catalog.products}
+    full_chars = len(', '.join(names.values()))
+
+    found = wanted = 0
+    timings, chars = [], []
+    for msg, expected in CORPUS:
+        samples = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            ids = retriever.top_k(msg, args.top_k)
+            samples.append(time.perf_counter() - t0)
+        timings.append(statistics.median(samples))
+        hit = expected & set(ids)
+        found += len(hit)
+        wanted += len(expected)
+        chars.append(len(', '.join(names[i] for i in ids)))
+        print(f"  [{len(hit)}/{len(expected)}] {len(ids):3d} products  {msg[:60]}")
+
+    print()
+    print(f"catalog:         {args.size} products, index built in {build_ms:.0f} ms")
+    print(f"recall@{args.top_k}:       {found}/{wanted} ({found / wanted:.0%})")
+    print(f"retrieval:       median {statistics.median(timings) * 1000:.2f} ms, max {max(timings) * 1000:.2f} ms")
+    print(f"product list:    {full_chars} chars (~{full_chars // 4} tokens) full vs "
+          f"{statistics.mean(chars):.0f} chars avg with top-{args.top_k}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""
+Caches shared by the merchant worker.
+
+TTLCache is the in-process layer (thread-safe LRU with expiry). The product
+catalog cache sits on top of it with Redis as a second, cross-worker layer,
+and stores only the compact projection the prompt needs.
+"""
+import os
+import json
+import time
+import hashlib
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+from redis_merchant import get_redis, mark_redis_down
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with a per-entry time-to-live. With maxbytes, the
+    total len() of the values is bounded too (values must be bytes-like).
+    """
+
+    def __init__(self, maxsize, ttl, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()   # key -> (expires_at, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _size(self, value):
+        return len(value) if self.maxbytes else 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                    self._bytes -= self._size(entry[1])
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            if self.maxbytes and self._size(value) > self.maxbytes: return
+            old = self._data.pop(key, None)
+            if old is not None: self._bytes -= self._size(old[1])
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._bytes += self._size(value)
+            while len(self._data) > self.maxsize or (self.maxbytes and self._bytes > self.maxbytes):
+                self._bytes -= self._size(self._data.popitem(last=False)[1][1])
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None: return None
+            self._bytes -= self._size(entry[1])
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+# ==========================================
+# PRODUCT CATALOG
+# ==========================================
+
+# Local entries are short-lived so edits made by other workers show up quickly;
+# the Redis copy is dropped explicitly on every catalog write.
+CATALOG_LOCAL_TTL = float(os.getenv("CATALOG_LOCAL_TTL", "60"))
+CATALOG_REDIS_TTL = int(os.getenv("CATALOG_REDIS_TTL", "3600"))
+CATALOG_LOCAL_MAX = int(os.getenv("CATALOG_LOCAL_MAX", "512"))
+
+# Compact projection of products_merchant used by prompts and parsers
+CATALOG_FIELDS = ('id', 'name', 'alias', 'unit', 'price', 'hsn_code')
+Product = namedtuple('Product', CATALOG_FIELDS)
+
+# version is a content hash, so anything derived from a catalog can key on it
+Catalog = namedtuple('Catalog', 'version products')
+
+_catalogs = TTLCache(CATALOG_LOCAL_MAX, CATALOG_LOCAL_TTL)
+
+def _catalog_key(merchant_id):
+    return f"mina:catalog:{merchant_id}"
+
+def make_catalog(rows):
+    """Builds a Catalog from products_merchant rows (dicts)."""
+    products = [Product(*(row.get(f) for f in CATALOG_FIELDS)) for row in rows]
+    version = hashlib.sha1(json.dumps(products, separators=(',', ':')).encode()).hexdigest()[:16]
+    return Catalog(version, products)
+
+def get_catalog(merchant_id, loader):
+    """Catalog for a merchant: local LRU, then Redis, then loader() -> rows."""
+    catalog = _catalogs.get(merchant_id)
+    if catalog is not None:
+        return catalog
+
+    r = get_redis()
+    if r is not None:
+        try:
+            raw = r.get(_catalog_key(merchant_id))
+            if raw:
+                data = json.loads(raw)
+                catalog = Catalog(data['v'], [Product(*p) for p in data['p']])
+                _catalogs.set(merchant_id, catalog)
+                return catalog
+        except Exception as e:
+            mark_redis_down(e)
+            r = None
+
+    catalog = make_catalog(loader())
+    _catalogs.set(merchant_id, catalog)
+    if r is not None:
+        try:
+            payload = json.dumps({'v': catalog.version, 'p': catalog.products}, separators=(',', ':'))
+            r.set(_catalog_key(merchant_id), payload, ex=CATALOG_REDIS_TTL)
+        except Exception as e:
+            mark_redis_down(e)
+    return catalog
+
+def invalidate_catalog(merchant_id):
+    """Drops a merchant's catalog from both layers; call after products_merchant changes commit."""
+    _catalogs.pop(merchant_id)
+    r = get_redis()
+    if r is not None:
+        try: r.delete(_catalog_key(merchant_id))
+        except Exception as e: mark_redis_down(e)
+
+# ==========================================
+# INTENT RESULTS
+# ==========================================
+
+# Content-addressed: the same merchant sending the same text/media against the
+# same catalog version gets the same classification without another LLM call.
+INTENT_CACHE_TTL = int(os.getenv("INTENT_CACHE_TTL", "900"))
+INTENT_CACHE_MAX = int(os.getenv("INTENT_CACHE_MAX", "4096"))
+
+_intents = TTLCache(INTENT_CACHE_MAX, INTENT_CACHE_TTL)
+
+CACHE_STATS = {
+    "intent_local_hits": 0,
+    "intent_redis_hits": 0,
+    "intent_misses": 0,
+    "duplicate_messages": 0,
+}
+
+_SPACES = re.compile(r'\s+')
+
+def _normalize_text(text):
+    return _SPACES.sub(' ', (text or '').strip().lower())
+
+def intent_key(merchant_phone, catalog_version, text=None, media=None, parts=None):
+    """
+    sha256 over merchant, catalog version and the content: the normalized
+    text, the raw media bytes, or every (kind, text or bytes) part in order.
+    """
+    h = hashlib.sha256()
+    h.update(f"{merchant_phone}\0{catalog_version}\0".encode())
+    if parts is not None:
+        h.update(b"parts\0")
+        for kind, value in parts:
+            data = value if isinstance(value, bytes) else _normalize_text(value).encode()
+            # Length-prefixed so part boundaries can't collide
+            h.update(f"{kind}\0{len(data)}\0".encode())
+            h.update(data)
+    elif media is not None:
+        h.update(b"media\0")
+        h.update(media)
+    else:
+        h.update(b"text\0")
+        h.update(_normalize_text(text).encode())
+    return h.hexdigest()
+
+def get_cached_intent(key):
+    res = _intents.get(key)
+    if res is not None:
+        CACHE_STATS["intent_local_hits"] += 1
+        return res
+    r = get_redis()
+    if r is not None:
+        try:
+            raw = r.get(f"mina:intent:{key}")
+            if raw:
+                res = json.loads(raw)
+                _intents.set(key, res)
+                CACHE_STATS["intent_redis_hits"] += 1
+                return res
+        except Exception as e:
+            mark_redis_down(e)
+    CACHE_STATS["intent_misses"] += 1
+    return None
+
+def cache_intent(key, result):
+    _intents.set(key, result)
+    r = get_redis()
+    if r is not None:
+        try: r.set(f"mina:intent:{key}", json.dumps(result), ex=INTENT_CACHE_TTL)
+        except Exception as e: mark_redis_down(e)
+
+# ==========================================
+# MESSAGE IDEMPOTENCY
+# ==========================================
+
+# Twilio retries webhooks and RQ can redeliver jobs: a message id is claimed
+# once and later deliveries become no-ops.
+MESSAGE_DEDUPE_TTL = int(os.getenv("MESSAGE_DEDUPE_TTL", "86400"))
+
+_seen_messages = TTLCache(20000, MESSAGE_DEDUPE_TTL)
+
+def claim_message(message_id):
+    """True the first time a message id is seen; False for redeliveries."""
+    if not message_id: return True
+    claimed = None
+    r = get_redis()
+    if r is not None:
+        try: claimed = bool(r.set(f"mina:msg:{message_id}", 1, nx=True, ex=MESSAGE_DEDUPE_TTL))
+        except Exception as e: mark_redis_down(e)
+    if claimed is None:
+        claimed = _seen_messages.get(message_id) is None
+    _seen_messages.set(message_id, True)
+    if not claimed:
+        CACHE_STATS["duplicate_messages"] += 1
+    return claimed
+
+def release_message(message_id):
+    """Un-claims a message whose processing failed so a retry can run it."""
+    if not message_id: return
+    _seen_messages.pop(message_id)
+    r = get_redis()
+    if r is not None:
+        try: r.delete(f"mina:msg:{message_id}")
+        except Exception as e: mark_redis_down(e)
+
+def cache_stats():
+    """Counters for metrics export."""
+    stats = dict(CACHE_STATS)
+    stats.update({
+        "catalog_local_hits": _catalogs.hits,
+        "catalog_local_misses": _catalogs.misses,
+        "intent_local_size": len(_intents),
+    })
+    return stats
@@ -0,0 +1,182 @@
+"""
+Per-sender coalescing window.
+
+Merchants often dictate one order as several messages a few seconds apart
+("Ramesh ka order", "10 kg atta", a voice note...). With COALESCE_WINDOW > 0,
+process_message buffers each part in Redis instead of handling it, and one
+flush job per window processes them together: text parts are joined into a
+single message, mixed text/media go to the model as one multi-part request.
+
+The window closes once the sender has been quiet for COALESCE_WINDOW seconds,
+or COALESCE_MAX_WAIT after the first part, whichever comes first. Without
+Redis every message is processed on its own, as before.
+
+Each take moves the parts into its own batch, leased to that flush for
+COALESCE_LEASE seconds, so a concurrent flush never gets them too. A batch
+is only dropped (done_parts) once the unit of work that handled it has
+committed; if it fails (release_parts) or its worker dies (the lease runs
+out) the parts are taken again with the sender's next flush.
+"""
+import os
+import json
+import time
+
+from redis_merchant import get_redis, mark_redis_down
+
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))   # seconds; 0 disables
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "15"))
+# How long a flush owns the parts it took; longer than a message job can run
+COALESCE_LEASE = float(os.getenv("COALESCE_LEASE", "180"))
+
+# Answers to a prompt ("Reply 1 to Confirm") are never held back
+IMMEDIATE_REPLIES = {'1', 'yes', 'ha'}
+
+PREFIX = "mina:coalesce:"
+
+COALESCE_STATS = {"buffered": 0, "flushes": 0, "parts_flushed": 0}
+
+def enabled():
+    return COALESCE_WINDOW > 0
+
+def is_immediate(data):
+    return (data.get('body') or '').strip().lower() in IMMEDIATE_REPLIES
+
+def part_of(data):
+    """The part of a webhook payload the model needs: its text and/or one media URL."""
+    part = {}
+    body = (data.get('body') or '').strip()
+    if body: part['text'] = body
+    if data.get('num_media', 0) > 0 and data.get('media_url'):
+        part['media_url'] = data['media_url']
+        part['media_type'] = data.get('media_type', '')
+    return part
+
+def buffer_part(sender, data):
+    """
+    Appends the message to the sender's buffer. Returns None if it wasn't
+    buffered (Redis unavailable: process it now), else True when it opened the
+    window and a flush must be scheduled, False when a flush is already pending.
+    """
+    r = get_redis()
+    if r is None: return None
+    key = PREFIX + sender
+    ttl = int(COALESCE_MAX_WAIT + COALESCE_WINDOW + 300)
+    now = time.time()
+    try:
+        pipe = r.pipeline(transaction=True)
+        pipe.rpush(key, json.dumps(part_of(data)))
+        pipe.hsetnx(key + ":meta", "first", now)
+        pipe.hset(key + ":meta", "last", now)
+        pipe.expire(key, ttl)
+        pipe.expire(key + ":meta", ttl)
+        pipe.set(key + ":flush", 1, nx=True, ex=ttl)
+        opened = bool(pipe.execute()[-1])
+    except Exception as e:
+        mark_redis_down(e)
+        return None
+    COALESCE_STATS["buffered"] += 1
+    return opened
+
+def flush_due_in(sender):
+    """Seconds until the sender's window closes (0 = flush now)."""
+    r = get_redis()
+    if r is None: return 0.0
+    try: meta = r.hgetall(PREFIX + sender + ":meta")
+    except Exception as e:
+        mark_redis_down(e)
+        return 0.0
+    if not meta: return 0.0
+    now = time.time()
+    quiet = float(meta[b'last']) + COALESCE_WINDOW - now
+    cap = float(meta[b'first']) + COALESCE_MAX_WAIT - now
+    return max(0.0, min(quiet, cap))
+
+# Moves the parts of batches whose lease ran out (oldest first), then the
+# buffer, into a new batch <batches>:<id> leased until ARGV[2], and closes
+# the window. Returns {id, parts}; id 0 when there was nothing to take.
+# KEYS: buffer, batches (hash id -> lease end), meta, flush, seq
+# ARGV: now, lease end, ttl
+_TAKE_LUA = """
+local id = redis.call('INCR', KEYS[5])
+local batch = KEYS[2] .. ':' .. id
+local leases = redis.call('HGETALL', KEYS[2])
+local stale = {}
+for i = 1, #leases, 2 do
+    if tonumber(leases[i + 1]) <= tonumber(ARGV[1]) then table.insert(stale, tonumber(leases[i])) end
+end
+table.sort(stale)
+for _, old in ipairs(stale) do
+    local old_key = KEYS[2] .. ':' .. old
+    for _, p in ipairs(redis.call('LRANGE', old_key, 0, -1)) do redis.call('RPUSH', batch, p) end
+    redis.call('DEL', old_key)
+    redis.call('HDEL', KEYS[2], old)
+end
+for _, p in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do redis.call('RPUSH', batch, p) end
+redis.call('DEL', KEYS[1], KEYS[3], KEYS[4])
+local parts = redis.call('LRANGE', batch, 0, -1)
+if #parts == 0 then return {0, parts} end
+redis.call('HSET', KEYS[2], id, ARGV[2])
+redis.call('EXPIRE', batch, ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[5], ARGV[3])
+return {id, parts}
+"""
+
+def take_parts(sender):
+    """
+    Atomically takes the sender's buffer, plus parts left by a failed or dead
+    flush, as (batch, parts) in arrival order. Parts another flush is still
+    handling are not returned. Call done_parts() once they have been handled,
+    release_parts() if that failed. (None, []) when there is nothing to take.
+    """
+    r = get_redis()
+    if r is None: return None, []
+    key = PREFIX + sender
+    now = time.time()
+    try:
+        batch, raw = r.eval(_TAKE_LUA, 5, key, key + ":batches", key + ":meta", key + ":flush", key + ":seq",
+                            now, now + COALESCE_LEASE, int(COALESCE_LEASE + COALESCE_MAX_WAIT + COALESCE_WINDOW + 300))
+    except Exception as e:
+        mark_redis_down(e)
+        return None, []
+    parts = [json.loads(p) for p in raw]
+    if not parts: return None, []
+    COALESCE_STATS["flushes"] += 1
+    COALESCE_STATS["parts_flushed"] += len(parts)
+    return int(batch), parts
+
+def done_parts(sender, batch):
+    """Drops a batch from take_parts() once its unit of work has committed."""
+    r = get_redis()
+    if r is None or batch is None: return
+    key = PREFIX + sender + ":batches"
+    try:
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(f"{key}:{batch}")
+        pipe.hdel(key, batch)
+        pipe.execute()
+    except Exception as e: mark_redis_down(e)
+
+def release_parts(sender, batch):
+    """Ends a batch's lease early after a failure, so the next flush retakes it."""
+    r = get_redis()
+    if r is None or batch is None: return
+    try: r.hset(PREFIX + sender + ":batches", batch, 0)
+    except Exception as e: mark_redis_down(e)
+
+def merge_parts(sender, parts):
+    """
+    A process_message payload for the buffered parts. Text-only buffers become
+    one message (so the fast path still applies); several parts including
+    media carry the full list under 'parts'.
+    """
+    texts = [p['text'] for p in parts if p.get('text')]
+    media = [p for p in parts if p.get('media_url')]
+    data = {'from': sender, 'body': "\n".join(texts), 'num_media': len(media)}
+    if len(parts) == 1 and media:
+        # A lone message is handled exactly as if it had not been buffered
+        data['media_url'] = media[0]['media_url']
+        data['media_type'] = media[0]['media_type']
+    elif media:
+        data['parts'] = parts
+    return data
@@ -1,8 +1,18 @@
 from utils import normalize_phone_for_db
+from matching_merchant import NameIndex
+from cache_merchant import CATALOG_FIELDS, make_catalog, get_catalog, invalidate_catalog
+from state_merchant import RedisStateStore, StateUnavailable, state_ttl
+from metrics_merchant import count_query
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from contextlib import contextmanager
 import os
 import json
+import time
+import queue
+import atexit
+import threading
+import contextvars
 
 # Use DATABASE_URL from environment or default to local SQLite
 DB_URL = os.getenv("DATABASE_URL")
@@ -17,7 +27,7 @@ IS_POSTGRES = DB_URL.startswith('postgresql:') or DB_URL.startswith('postgres:')
 if IS_POSTGRES:
     try:
         import psycopg2
-        from psycopg2.extras import RealDictCursor
+        from psycopg2.extras import RealDictCursor, execute_values
         PSYCOPG_VERSION = 2
     except ImportError:
         import psycopg
@@ -33,38 +43,278 @@ else:
     TIMESTAMP_DEFAULT = "DEFAULT CURRENT_TIMESTAMP"
     LIKE_OPERATOR = "LIKE"
 
-@contextmanager
-def get_conn():
+# Merchants' calendar days (sales rollups, batch periods) are in this time
+# zone, IST by default; the DB stores created_at in UTC.
+UTC_OFFSET_MINUTES = int(os.getenv("MERCHANT_UTC_OFFSET_MINUTES", "330"))
+UTC_OFFSET = timedelta(minutes=UTC_OFFSET_MINUTES)
+
+# SQLite path comes from the URL (sqlite:///path.db), defaulting to the old local file
+SQLITE_PATH = DB_URL[len("sqlite:///"):] if DB_URL.startswith("sqlite:///") else "local_mina.db"
+
+# --- CONNECTION POOL ---
+# One pool per worker process. SQLite always uses a single shared connection.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5")) if IS_POSTGRES else 1
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))          # seconds to wait for a free connection
+DB_POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "1800"))        # max connection age in seconds
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))    # health-check if idle longer than this
+
+def _connect():
     if IS_POSTGRES:
         if PSYCOPG_VERSION == 2:
-            conn = psycopg2.connect(DB_URL)
+            return psycopg2.connect(DB_URL)
+        conn = psycopg.connect(DB_URL)
+        conn.row_factory = dict_row
+        return conn
+    conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _is_closed(conn):
+    if IS_POSTGRES:
+        # psycopg2: int (0 = open), psycopg3: bool; psycopg3 also flags broken sockets
+        return bool(conn.closed) or bool(getattr(conn, "broken", False))
+    return False
+
+def _ping(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT 1")
+        cur.fetchone()
+    finally:
+        try: cur.close()
+        except: pass
+    conn.rollback()
+
+class ConnectionPool:
+    """
+    Thread-safe LIFO pool of DB connections. Connections are health-checked
+    when they have been idle for a while and recycled once they get old.
+    """
+
+    def __init__(self, size, timeout=DB_POOL_TIMEOUT, recycle=DB_POOL_RECYCLE, ping_after=DB_POOL_PING_AFTER):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._born = {}   # id(conn) -> creation time
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # Connections must never cross a fork: the child drops them without
+        # closing, otherwise it would tear down the parent's sockets.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = queue.LifoQueue()
+                    self._created = 0
+                    self._born = {}
+                    self._pid = os.getpid()
+
+    def _new(self):
+        conn = _connect()
+        self._born[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._born.pop(id(conn), None)
+        try: conn.close()
+        except: pass
+        with self._lock:
+            self._created -= 1
+
+    def acquire(self):
+        self._check_fork()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self._new()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"DB pool exhausted ({self.size} connections busy)")
+                try:
+                    conn, idle_since = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+
+            now = time.monotonic()
+            if _is_closed(conn) or now - self._born.get(id(conn), now) > self.recycle:
+                self._discard(conn)
+                continue
+            if IS_POSTGRES and now - idle_since > self.ping_after:
+                try:
+                    _ping(conn)
+                except Exception:
+                    self._discard(conn)
+                    continue
+            return conn
+
+    def release(self, conn, broken=False):
+        if self._pid != os.getpid():
+            return
+        if not broken and not _is_closed(conn):
+            try:
+                # Never hand out a connection with an open transaction
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken or _is_closed(conn):
+            self._discard(conn)
         else:
-            conn = psycopg.connect(DB_URL)
+            self._idle.put((conn, time.monotonic()))
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_POOL_SIZE)
+    return _pool
+
+def close_pool():
+    if _pool is not None:
+        _pool.close()
+
+atexit.register(close_pool)
+
+def _is_disconnect(exc):
+    if IS_POSTGRES and PSYCOPG_VERSION == 2:
+        return isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    if IS_POSTGRES:
+        return isinstance(exc, (psycopg.OperationalError, psycopg.InterfaceError))
+    return False
+
+_held = threading.local()
+
+# --- UNIT OF WORK ---
+# Inside unit_of_work() every db_merchant call shares one pooled connection and
+# one transaction, committed once when the block exits. Resolved users rows are
+# cached on the session so helpers don't re-query them by phone.
+_session = contextvars.ContextVar("db_session", default=None)
+
+class Session:
+    def __init__(self):
+        self.conn = None
+        self.users = {}        # normalized phone -> users row
+        self.on_commit = []    # callbacks run after a successful commit
+
+@contextmanager
+def unit_of_work():
+    """Runs every db_merchant call in the block on one connection and transaction."""
+    current = _session.get()
+    if current is not None:
+        yield current
+        return
+    sess = Session()
+    token = _session.set(sess)
+    broken = False
+    try:
+        yield sess
+        if sess.conn is not None:
+            sess.conn.commit()
+    except Exception as e:
+        broken = _is_disconnect(e)
+        if sess.conn is not None and not broken:
+            try: sess.conn.rollback()
+            except: broken = True
+        raise
+    finally:
+        _session.reset(token)
+        if sess.conn is not None:
+            get_pool().release(sess.conn, broken=broken)
+    for fn, args, kwargs in sess.on_commit:
+        fn(*args, **kwargs)
+
+def after_commit(fn, *args, **kwargs):
+    """Defers fn until the current unit of work commits (runs now if there is none)."""
+    sess = _session.get()
+    if sess is None:
+        fn(*args, **kwargs)
     else:
-        conn = sqlite3.connect("local_mina.db")
-        conn.row_factory = sqlite3.Row
+        sess.on_commit.append((fn, args, kwargs))
+
+def _cache_user(row):
+    sess = _session.get()
+    if sess is not None and row:
+        sess.users[row['phone']] = row
+    return row
+
+def _cached_user(phone):
+    sess = _session.get()
+    return sess.users.get(phone) if sess is not None else None
+
+@contextmanager
+def get_conn():
+    sess = _session.get()
+    if sess is not None:
+        # Opened lazily by the first query of the unit of work
+        if sess.conn is None:
+            sess.conn = get_pool().acquire()
+        yield sess.conn
+        return
+    # Re-entrant per thread: helpers that open a cursor while another one is
+    # still open (e.g. set_user_state -> get_or_create_user) share the
+    # connection instead of taking a second one from the pool.
+    held = getattr(_held, "conn", None)
+    if held is not None:
+        yield held
+        return
+    pool = get_pool()
+    conn = pool.acquire()
+    _held.conn = conn
+    broken = False
     try:
         yield conn
+    except Exception as e:
+        broken = _is_disconnect(e)
+        raise
     finally:
-        try: conn.close()
-        except: pass
+        _held.conn = None
+        pool.release(conn, broken=broken)
 
 @contextmanager
 def get_cursor():
-    """Yields a cursor that commits on success and rolls back on failure."""
+    """Yields a cursor that commits on success and rolls back on failure.
+    Inside unit_of_work(), or nested in another get_cursor(), the commit/rollback
+    is left to the outermost owner of the connection."""
+    owner = _session.get() is None and getattr(_held, "conn", None) is None
     with get_conn() as conn:
         if IS_POSTGRES and PSYCOPG_VERSION == 2:
             cur = conn.cursor(cursor_factory=RealDictCursor)
-        elif IS_POSTGRES and PSYCOPG_VERSION == 3:
-            conn.row_factory = dict_row
-            cur = conn.cursor()
         else:
             cur = conn.cursor()
         try:
             yield cur
-            conn.commit()
+            if owner:
+                conn.commit()
         except Exception:
-            conn.rollback()
+            if owner:
+                conn.rollback()
             raise
         finally:
             try: cur.close()
@@ -96,100 +346,89 @@ def execute_query(cur, sql, params=None):
         # SQLite uses ? placeholders, Postgres uses %s
         sql = sql.replace("%s", "?")
     
+    count_query()
     cur.execute(sql, params)
 
+def insert_returning_id(cur, sql, params=None):
+    """Runs an INSERT and returns the new id (RETURNING on Postgres, lastrowid on SQLite)"""
+    if IS_POSTGRES:
+        execute_query(cur, sql + " RETURNING id", params)
+        return fetchone_normalized(cur)['id']
+    execute_query(cur, sql, params)
+    return cur.lastrowid
+
+def insert_many(cur, table, columns, rows, page_size=500):
+    """Bulk INSERT: one multi-row statement per page_size rows instead of one per row"""
+    if not rows: return
+    cols = ", ".join(columns)
+    count_query(-(-len(rows) // page_size))
+    if IS_POSTGRES and PSYCOPG_VERSION == 2:
+        execute_values(cur, f"INSERT INTO {table} ({cols}) VALUES %s", rows, page_size=page_size)
+    elif IS_POSTGRES:
+        row_tpl = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        for i in range(0, len(rows), page_size):
+            page = rows[i:i + page_size]
+            params = [v for row in page for v in row]
+            cur.execute(f"INSERT INTO {table} ({cols}) VALUES " + ", ".join([row_tpl] * len(page)), params)
+    else:
+        cur.executemany(f"INSERT INTO {table} ({cols}) VALUES ({', '.join(['?'] * len(columns))})", rows)
+
+def copy_rows(cur, table, columns, rows, conflict=None):
+    """
+    Bulk load for imports: COPY on Postgres, executemany on SQLite. With
+    conflict (the unique key, e.g. "merchant_id, phone"), rows that would
+    violate it are skipped instead of failing the batch. Returns rows inserted.
+    """
+    if not rows: return 0
+    cols = ", ".join(columns)
+    if not IS_POSTGRES:
+        count_query()
+        verb = "INSERT OR IGNORE" if conflict else "INSERT"
+        cur.executemany(f"{verb} INTO {table} ({cols}) VALUES ({', '.join(['?'] * len(columns))})", rows)
+        return cur.rowcount
+
+    target = table
+    if conflict:
+        # COPY has no ON CONFLICT: stage the batch, then insert what doesn't clash
+        target = f"_copy_{table}"
+        count_query(2)
+        cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {target} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+    count_query()
+    sql = f"COPY {target} ({cols}) FROM STDIN"
+    if PSYCOPG_VERSION == 2:
+        import io, csv
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        buf.seek(0)
+        cur.copy_expert(sql + " WITH (FORMAT csv)", buf)
+    else:
+        with cur.copy(sql) as copy:
+            for row in rows:
+                copy.write_row(row)
+    if not conflict: return len(rows)
+    cur.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {target} ON CONFLICT ({conflict}) DO NOTHING")
+    return cur.rowcount
+
 # ==========================================
 # 1. INITIALIZATION
 # ==========================================
 
 def init_db():
-    with get_cursor() as cur:
-        # Users
-        cur.execute(f"""
-        CREATE TABLE IF NOT EXISTS users (
-            id {PK_TYPE},
-            phone TEXT UNIQUE NOT NULL,
-            created_at TIMESTAMP {TIMESTAMP_DEFAULT},
-            subscription_tier VARCHAR(20) DEFAULT 'free',
-            credits_remaining FLOAT DEFAULT 30.0,
-            subscription_active BOOLEAN DEFAULT FALSE,
-            subscription_expiry TIMESTAMP,
-            razorpay_customer_id TEXT,
-            business_name TEXT, 
-            gstin TEXT,
-            preferred_language TEXT DEFAULT 'hi',
-            current_state VARCHAR(100),
-            state_metadata TEXT DEFAULT '{{}}'
-        );""")
-
-        # Merchant Tables
-        cur.execute(f"""
-        CREATE TABLE IF NOT EXISTS customers_merchant (
-            id {PK_TYPE},
-            merchant_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-            name TEXT NOT NULL,
-            phone TEXT,
-            gstin TEXT,
-            billing_address TEXT,
-            email TEXT,
-            current_balance FLOAT DEFAULT 0.0,
-            created_at TIMESTAMP {TIMESTAMP_DEFAULT},
-            UNIQUE(merchant_id, phone)
-        );""")
-
-        cur.execute(f"""
-        CREATE TABLE IF NOT EXISTS products_merchant (
-            id {PK_TYPE},
-            merchant_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-            name TEXT NOT NULL,
-            alias TEXT,
-            description TEXT,
-            unit VARCHAR(20) DEFAULT 'pcs',
-            price FLOAT DEFAULT 0.0,
-            stock_qty FLOAT DEFAULT 0.0,
-            hsn_code TEXT,
-            gst_rate FLOAT DEFAULT 0.0,
-            created_at TIMESTAMP {TIMESTAMP_DEFAULT}
-        );""")
-
-        cur.execute(f"""
-        CREATE TABLE IF NOT EXISTS orders_merchant (
-            id {PK_TYPE},
-            merchant_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-            customer_id INTEGER REFERENCES customers_merchant(id),
-            invoice_number TEXT,
-            invoice_date TIMESTAMP {TIMESTAMP_DEFAULT},
-            due_date TIMESTAMP,
-            final_amount FLOAT DEFAULT 0.0,
-            status VARCHAR(20) DEFAULT 'draft',
-            payment_status VARCHAR(20) DEFAULT 'unpaid',
-            pdf_url TEXT,
-            notes TEXT,
-            created_at TIMESTAMP {TIMESTAMP_DEFAULT}
-        );""")
-
-        cur.execute(f"""
-        CREATE TABLE IF NOT EXISTS order_items_merchant (
-            id {PK_TYPE},
-            order_id INTEGER NOT NULL REFERENCES orders_merchant(id) ON DELETE CASCADE,
-            product_id INTEGER REFERENCES products_merchant(id),
-            product_name TEXT NOT NULL,
-            quantity FLOAT NOT NULL,
-            unit_price FLOAT NOT NULL,
-            gst_rate FLOAT DEFAULT 0.0,
-            total_price FLOAT NOT NULL
-        );""")
-        
-        # Legacy Tables (Simplified)
-        cur.execute(f"CREATE TABLE IF NOT EXISTS meeting_notes (id {PK_TYPE}, phone TEXT, audio_file TEXT, transcript TEXT, summary TEXT, message_sid TEXT, created_at TIMESTAMP {TIMESTAMP_DEFAULT});")
-        cur.execute(f"CREATE TABLE IF NOT EXISTS tasks (id {PK_TYPE}, user_id INTEGER, title TEXT, description TEXT, due_at TIMESTAMP, status VARCHAR(20), metadata TEXT, created_at TIMESTAMP {TIMESTAMP_DEFAULT});")
+    """Brings the schema up to date. A no-op version check once it is current."""
+    from migrations_merchant import migrate
+    migrate()
 
-        try:
-            # Migrations
-            execute_query(cur, "ALTER TABLE users ADD COLUMN IF NOT EXISTS current_state VARCHAR(100);")
-        except: pass
+_db_ready = False
+_db_ready_lock = threading.Lock()
 
-        print(f"✅ DB Merchant Initialized ({'Postgres' if IS_POSTGRES else 'SQLite'}).")
+def ensure_db():
+    """init_db() once per process; cheap enough to call at the start of every job."""
+    global _db_ready
+    if _db_ready: return
+    with _db_ready_lock:
+        if not _db_ready:
+            init_db()
+            _db_ready = True
 
 # ==========================================
 # 2. USER & STATE FUNCTIONS
@@ -197,43 +436,122 @@ def init_db():
 
 def get_or_create_user(raw_phone):
     phone = normalize_phone_for_db(raw_phone)
+    user = _cached_user(phone)
+    if user: return user
     with get_cursor() as cur:
         execute_query(cur, "SELECT * FROM users WHERE phone = %s", (phone,))
         user = fetchone_normalized(cur)
         if not user:
-            execute_query(cur, "INSERT INTO users (phone) VALUES (%s)", (phone,))
             if IS_POSTGRES:
-                user = fetchone_normalized(cur) # RETURNING supported
+                execute_query(cur, "INSERT INTO users (phone) VALUES (%s) RETURNING *", (phone,))
+                user = fetchone_normalized(cur)
             else:
                 # SQLite needs manual fetch
+                execute_query(cur, "INSERT INTO users (phone) VALUES (%s)", (phone,))
                 execute_query(cur, "SELECT * FROM users WHERE phone = %s", (phone,))
                 user = fetchone_normalized(cur)
-        return user
+        return _cache_user(user)
 
 def get_user_by_phone(raw_phone):
     phone = normalize_phone_for_db(raw_phone)
+    user = _cached_user(phone)
+    if user: return user
     with get_cursor() as cur:
         execute_query(cur, "SELECT * FROM users WHERE phone = %s", (phone,))
-        return fetchone_normalized(cur)
+        return _cache_user(fetchone_normalized(cur))
+
+# --- CONVERSATION STATE ---
+# STATE_BACKEND picks where get_user_state/set_user_state keep state:
+#   sql        users.current_state / state_metadata (default)
+#   redis      Redis hash per sender; SQL is only used while Redis is down
+#   redis+sql  Redis first, with SQL as the read fallback and a write-behind
+#              copy flushed by flush_state_write_behind()
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sql")
+_state_store = RedisStateStore() if STATE_BACKEND in ("redis", "redis+sql") else None
+_WRITE_BEHIND = STATE_BACKEND == "redis+sql"
+
+_UPSERT_STATE_SQL = """
+    INSERT INTO users (phone, current_state, state_metadata) VALUES (%s, %s, %s)
+    ON CONFLICT (phone) DO UPDATE SET current_state = excluded.current_state, state_metadata = excluded.state_metadata
+"""
+
+def _sql_state_meta(state, metadata):
+    # SQL has no TTL, so the expiry travels inside the metadata JSON
+    meta = dict(metadata or {})
+    if state: meta['_expires'] = time.time() + state_ttl(state)
+    return json.dumps(meta)
 
 def set_user_state(phone, state, metadata=None):
     phone = normalize_phone_for_db(phone)
-    meta_str = json.dumps(metadata or {})
+    if _state_store is not None:
+        # Redis isn't part of the transaction: only write once the unit of work commits
+        after_commit(_store_user_state, phone, state, metadata)
+        return
+    _sql_set_user_state(phone, state, metadata)
+
+def _store_user_state(phone, state, metadata=None):
+    try:
+        _state_store.set(phone, state, metadata, dirty=_WRITE_BEHIND)
+    except StateUnavailable:
+        _sql_set_user_state(phone, state, metadata)
+
+def _sql_set_user_state(phone, state, metadata=None):
+    meta_str = _sql_state_meta(state, metadata)
     with get_cursor() as cur:
-        get_or_create_user(phone)
-        execute_query(cur, "UPDATE users SET current_state = %s, state_metadata = %s WHERE phone = %s", (state, meta_str, phone))
+        # Upsert: creates the user if needed without a second lookup
+        execute_query(cur, _UPSERT_STATE_SQL, (phone, state, meta_str))
+    user = _cached_user(phone)
+    if user:
+        user['current_state'] = state
+        user['state_metadata'] = meta_str
 
 def get_user_state(phone):
     phone = normalize_phone_for_db(phone)
-    with get_cursor() as cur:
-        execute_query(cur, "SELECT current_state, state_metadata FROM users WHERE phone = %s", (phone,))
-        row = fetchone_normalized(cur)
-        if row:
-            try: meta = json.loads(row.get('state_metadata') or '{}')
-            except: meta = {}
-            return row.get('current_state'), meta
+    if _state_store is not None:
+        try:
+            found = _state_store.get(phone)
+            if found is not None or not _WRITE_BEHIND:
+                return found or (None, {})
+            # Redis has never seen this sender: read SQL once and warm Redis
+            state, meta = _sql_get_user_state(phone)
+            _state_store.set(phone, state, meta)
+            return state, meta
+        except StateUnavailable:
+            pass
+    return _sql_get_user_state(phone)
+
+def _sql_get_user_state(phone):
+    row = _cached_user(phone)
+    if not row:
+        with get_cursor() as cur:
+            # Full row so later helpers in the same unit of work can reuse it
+            execute_query(cur, "SELECT * FROM users WHERE phone = %s", (phone,))
+            row = _cache_user(fetchone_normalized(cur))
+    if row:
+        try: meta = json.loads(row.get('state_metadata') or '{}')
+        except: meta = {}
+        if meta.pop('_expires', float('inf')) < time.time():
+            return None, {}
+        return row.get('current_state'), meta
     return None, {}
 
+def flush_state_write_behind(batch=500):
+    """Copies states changed in Redis to users (redis+sql backend). Returns rows written."""
+    if not _WRITE_BEHIND: return 0
+    try:
+        dirty = _state_store.pop_dirty(batch)
+    except StateUnavailable:
+        return 0
+    if not dirty: return 0
+    try:
+        with get_cursor() as cur:
+            for phone, state, meta in dirty:
+                execute_query(cur, _UPSERT_STATE_SQL, (phone, state, _sql_state_meta(state, meta)))
+    except Exception:
+        _state_store.mark_dirty([d[0] for d in dirty])
+        raise
+    return len(dirty)
+
 # ==========================================
 # 3. MERCHANT LOGIC
 # ==========================================
@@ -245,56 +563,199 @@ def get_products_merchant(merchant_phone):
         execute_query(cur, "SELECT * FROM products_merchant WHERE merchant_id = %s", (merchant['id'],))
         return fetchall_normalized(cur)
 
+def get_catalog_merchant(merchant_phone):
+    """
+    Cached compact catalog (id, name, alias, unit, price, hsn_code) for prompts.
+    Returns a cache_merchant.Catalog(version, products).
+    """
+    merchant = get_user_by_phone(merchant_phone)
+    if not merchant: return make_catalog([])
+    merchant_id = merchant['id']
+
+    def load():
+        with get_cursor() as cur:
+            execute_query(cur, f"SELECT {', '.join(CATALOG_FIELDS)} FROM products_merchant WHERE merchant_id = %s ORDER BY id", (merchant_id,))
+            return fetchall_normalized(cur)
+    return get_catalog(merchant_id, load)
+
+PRODUCT_FIELDS = ('name', 'alias', 'description', 'unit', 'price', 'stock_qty', 'hsn_code', 'gst_rate')
+
+def add_product_merchant(merchant_phone, name, **fields):
+    merchant = get_or_create_user(merchant_phone)
+    cols = ['merchant_id', 'name'] + [f for f in PRODUCT_FIELDS if f in fields and f != 'name']
+    vals = [merchant['id'], name] + [fields[f] for f in cols[2:]]
+    with get_cursor() as cur:
+        product_id = insert_returning_id(cur, f"INSERT INTO products_merchant ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})", tuple(vals))
+    after_commit(invalidate_catalog, merchant['id'])
+    return product_id
+
+def update_product_merchant(product_id, **fields):
+    cols = [f for f in PRODUCT_FIELDS if f in fields]
+    if not cols: return
+    with get_cursor() as cur:
+        sets = ", ".join(f"{c} = %s" for c in cols)
+        execute_query(cur, f"UPDATE products_merchant SET {sets} WHERE id = %s", tuple(fields[c] for c in cols) + (product_id,))
+        execute_query(cur, "SELECT merchant_id FROM products_merchant WHERE id = %s", (product_id,))
+        row = fetchone_normalized(cur)
+    if row: after_commit(invalidate_catalog, row['merchant_id'])
+
+# --- CUSTOMER NAME INDEX ---
+# Per-merchant fuzzy index over customers_merchant.name, kept per process.
+# Each lookup pulls in rows added since the last one (by any worker) with a
+# single indexed query; the whole index is rebuilt after CUSTOMER_INDEX_TTL
+# to pick up renames and deletes.
+# A name only resolves to an existing customer when the match is clear (see
+# NameIndex.best_unique); anything ambiguous becomes a new customer.
+CUSTOMER_MATCH_THRESHOLD = float(os.getenv("CUSTOMER_MATCH_THRESHOLD", "0.85"))
+CUSTOMER_MATCH_MARGIN = float(os.getenv("CUSTOMER_MATCH_MARGIN", "0.05"))        # over the runner-up
+CUSTOMER_TOKEN_MIN = float(os.getenv("CUSTOMER_TOKEN_MIN", "0.85"))              # per word, multi-word names
+CUSTOMER_INDEX_TTL = float(os.getenv("CUSTOMER_INDEX_TTL", "600"))
+CUSTOMER_INDEX_MAX_MERCHANTS = 256
+
+_customer_indexes = OrderedDict()   # merchant_id -> [NameIndex, max_id, built_at]
+_customer_indexes_lock = threading.Lock()
+
+def _customer_index(cur, merchant_id):
+    with _customer_indexes_lock:
+        entry = _customer_indexes.get(merchant_id)
+        if entry and time.monotonic() - entry[2] > CUSTOMER_INDEX_TTL:
+            entry = None
+        if entry is None:
+            entry = [NameIndex(), 0, time.monotonic()]
+            _customer_indexes[merchant_id] = entry
+        _customer_indexes.move_to_end(merchant_id)
+        while len(_customer_indexes) > CUSTOMER_INDEX_MAX_MERCHANTS:
+            _customer_indexes.popitem(last=False)
+
+    index, max_id = entry[0], entry[1]
+    execute_query(cur, "SELECT id, name FROM customers_merchant WHERE merchant_id = %s AND id > %s ORDER BY id", (merchant_id, max_id))
+    for row in fetchall_normalized(cur):
+        index.add(row['id'], row['name'])
+        max_id = row['id']
+    entry[1] = max(entry[1], max_id)
+    return index
+
+def _index_new_customer(merchant_id, customer_id, name):
+    entry = _customer_indexes.get(merchant_id)
+    if entry: entry[0].add(customer_id, name)
+
+def invalidate_customer_index(merchant_id):
+    with _customer_indexes_lock:
+        _customer_indexes.pop(merchant_id, None)
+
+def match_customer_merchant(merchant_phone, customer_name, threshold=None):
+    """Clear fuzzy match for a customer name as ({id, name}, score), or (None, score)."""
+    merchant = get_user_by_phone(merchant_phone)
+    if not merchant: return None, 0.0
+    with get_cursor() as cur:
+        return _match_customer(cur, merchant['id'], customer_name, threshold)
+
+def find_customer_merchant(merchant_phone, customer_name):
+    """
+    Exact lookup (same normalized name) as {id, name}, or None when no customer
+    or several have that name. For exports, where a near miss would send
+    someone else's ledger.
+    """
+    merchant = get_user_by_phone(merchant_phone)
+    if not merchant: return None
+    with get_cursor() as cur:
+        index = _customer_index(cur, merchant['id'])
+    ids = index.exact(customer_name)
+    if len(ids) != 1: return None
+    return {'id': ids[0], 'name': index.name_of(ids[0])}
+
+def _match_customer(cur, merchant_id, customer_name, threshold=None):
+    if threshold is None: threshold = CUSTOMER_MATCH_THRESHOLD
+    index = _customer_index(cur, merchant_id)
+    cust_id, score = index.best_unique(customer_name, threshold, CUSTOMER_MATCH_MARGIN, CUSTOMER_TOKEN_MIN)
+    if cust_id is None: return None, score
+    return {'id': cust_id, 'name': index.name_of(cust_id)}, score
+
 def create_draft_order_merchant(merchant_phone, customer_name, items_list):
     merchant = get_or_create_user(merchant_phone)
     merchant_id = merchant['id']
+
+    # Lines are priced up front so the header goes in with its total and the
+    # whole draft is a constant number of statements, whatever its length.
+    lines = []
+    total = 0
+    for item in items_list:
+        p_name = item.get('product', 'Item')
+        qty = float(item.get('qty', 1))
+        rate = float(item.get('rate', 0))
+        line_total = qty * rate
+        total += line_total
+        lines.append((p_name, qty, rate, line_total))
     
     with get_cursor() as cur:
         # 1. Customer
-        execute_query(cur, f"SELECT id FROM customers_merchant WHERE merchant_id=%s AND name {LIKE_OPERATOR} %s", (merchant_id, f"%{customer_name}%"))
-        res = fetchone_normalized(cur)
-        if res:
-            cust_id = res['id']
+        customer, _ = _match_customer(cur, merchant_id, customer_name)
+        if customer:
+            cust_id = customer['id']
         else:
-            execute_query(cur, "INSERT INTO customers_merchant (merchant_id, name) VALUES (%s, %s)", (merchant_id, customer_name))
-            if not IS_POSTGRES:
-                execute_query(cur, f"SELECT id FROM customers_merchant WHERE merchant_id=%s AND name {LIKE_OPERATOR} %s", (merchant_id, f"%{customer_name}%"))
-                res = fetchone_normalized(cur)
-                cust_id = res['id']
-            else:
-                 # Postgres logic handles RETURNING via execute, simplified here for hybrid
-                 execute_query(cur, f"SELECT id FROM customers_merchant WHERE merchant_id=%s AND name {LIKE_OPERATOR} %s", (merchant_id, f"%{customer_name}%"))
-                 cust_id = fetchone_normalized(cur)['id']
+            cust_id = insert_returning_id(cur, "INSERT INTO customers_merchant (merchant_id, name) VALUES (%s, %s)", (merchant_id, customer_name))
+            # Only index it once the row is actually committed
+            after_commit(_index_new_customer, merchant_id, cust_id, customer_name)
 
         # 2. Header
-        execute_query(cur, "INSERT INTO orders_merchant (merchant_id, customer_id, status) VALUES (%s, %s, 'draft')", (merchant_id, cust_id))
-        
-        # Get Order ID
-        if IS_POSTGRES:
-            execute_query(cur, "SELECT currval(pg_get_serial_sequence('orders_merchant','id'))")
-            order_id = cur.fetchone()[0]
-        else:
-             order_id = cur.lastrowid
+        order_id = insert_returning_id(cur, "INSERT INTO orders_merchant (merchant_id, customer_id, status, final_amount) VALUES (%s, %s, 'draft', %s)", (merchant_id, cust_id, total))
 
         # 3. Items
-        total = 0
-        for item in items_list:
-            p_name = item.get('product', 'Item')
-            qty = float(item.get('qty', 1))
-            rate = float(item.get('rate', 0))
-            line_total = qty * rate
-            total += line_total
-            
-            execute_query(cur, """
-                INSERT INTO order_items_merchant (order_id, product_name, quantity, unit_price, total_price)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (order_id, p_name, qty, rate, line_total))
-            
-        # 4. Update Total
-        execute_query(cur, "UPDATE orders_merchant SET final_amount=%s WHERE id=%s", (total, order_id))
+        insert_many(cur, "order_items_merchant",
+                    ("order_id", "product_name", "quantity", "unit_price", "total_price"),
+                    [(order_id,) + line for line in lines])
         
         return order_id
 
+def confirm_order_merchant(order_id):
+    """Moves a draft to confirmed and adds it to the rollups. False if the draft no longer exists (e.g. it expired)."""
+    with get_cursor() as cur:
+        execute_query(cur, "UPDATE orders_merchant SET status = 'confirmed' WHERE id = %s AND status = 'draft'", (order_id,))
+        if cur.rowcount <= 0: return False
+        execute_query(cur, "SELECT merchant_id, customer_id, final_amount, payment_status, created_at FROM orders_merchant WHERE id = %s", (order_id,))
+        order = fetchone_normalized(cur)
+        amount = float(order['final_amount'] or 0)
+        paid = amount if order['payment_status'] == 'paid' else 0.0
+        _apply_rollup(cur, order, orders=1, sales=amount, paid=paid, balance=amount - paid)
+        return True
+
+def set_payment_status_merchant(order_id, payment_status):
+    """
+    Sets an order's payment_status ('paid' / 'unpaid' / ...) and moves the
+    amount between paid and outstanding in the rollups. False if no such order.
+    """
+    with get_cursor() as cur:
+        lock = " FOR UPDATE" if IS_POSTGRES else ""
+        execute_query(cur, f"SELECT merchant_id, customer_id, final_amount, status, payment_status, created_at FROM orders_merchant WHERE id = %s{lock}", (order_id,))
+        order = fetchone_normalized(cur)
+        if not order: return False
+        if order['payment_status'] == payment_status: return True
+        execute_query(cur, "UPDATE orders_merchant SET payment_status = %s WHERE id = %s", (payment_status, order_id))
+        # Drafts aren't in the rollups yet; confirming one reads its payment status
+        was_paid, now_paid = order['payment_status'] == 'paid', payment_status == 'paid'
+        if order['status'] == 'confirmed' and was_paid != now_paid:
+            amount = float(order['final_amount'] or 0)
+            if not now_paid: amount = -amount
+            _apply_rollup(cur, order, paid=amount, balance=-amount)
+        return True
+
+def sweep_expired_drafts(max_age=None):
+    """
+    Deletes drafts older than the CONFIRM_ORDER state TTL; nobody can confirm
+    them any more. An order with an invoice (pdf_url) is never deleted.
+    """
+    max_age = int(max_age or state_ttl("CONFIRM_ORDER"))
+    if IS_POSTGRES:
+        cutoff_sql, cutoff = "NOW() - make_interval(secs => %s)", max_age
+    else:
+        cutoff_sql, cutoff = "datetime('now', %s)", f"-{max_age} seconds"
+    expired = f"status = 'draft' AND pdf_url IS NULL AND created_at < {cutoff_sql}"
+    with get_cursor() as cur:
+        # Items first: SQLite doesn't enforce ON DELETE CASCADE by default
+        execute_query(cur, f"DELETE FROM order_items_merchant WHERE order_id IN (SELECT id FROM orders_merchant WHERE {expired})", (cutoff,))
+        execute_query(cur, f"DELETE FROM orders_merchant WHERE {expired}", (cutoff,))
+        return cur.rowcount
+
 def get_order_details_merchant(order_id):
     with get_cursor() as cur:
         execute_query(cur, """
@@ -314,7 +775,179 @@ def get_order_details_merchant(order_id):
         res['items'] = items
         return res
 
+# --- SALES ROLLUPS ---
+# merchant_daily_sales (one row per merchant per local day) and
+# customers_merchant.current_balance (confirmed, unpaid amount) are kept up to
+# date in the same transaction as the order writes above, so reporting
+# questions are primary-key reads instead of aggregates over order history.
+# rebuild_rollups() recomputes both from orders_merchant.
+
+def _local_day(created_at):
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    return (created_at.replace(tzinfo=None) + UTC_OFFSET).strftime("%Y-%m-%d")
+
+def _apply_rollup(cur, order, orders=0, sales=0.0, paid=0.0, balance=0.0):
+    execute_query(cur, """
+        INSERT INTO merchant_daily_sales (merchant_id, day, orders_count, sales_amount, paid_amount)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (merchant_id, day) DO UPDATE SET
+            orders_count = merchant_daily_sales.orders_count + excluded.orders_count,
+            sales_amount = merchant_daily_sales.sales_amount + excluded.sales_amount,
+            paid_amount = merchant_daily_sales.paid_amount + excluded.paid_amount
+    """, (order['merchant_id'], _local_day(order['created_at']), orders, sales, paid))
+    if balance and order.get('customer_id'):
+        execute_query(cur, "UPDATE customers_merchant SET current_balance = COALESCE(current_balance, 0) + %s WHERE id = %s", (balance, order['customer_id']))
+
+def _rebuild_rollups(cur, merchant_id=None):
+    """Recomputes the rollups from confirmed orders (all merchants, or one)."""
+    if IS_POSTGRES:
+        # Order writes wait until the rebuild commits instead of racing it
+        cur.execute("LOCK TABLE merchant_daily_sales, customers_merchant IN EXCLUSIVE MODE")
+        day_sql, day_param = "CAST(o.created_at + make_interval(mins => %s) AS DATE)", UTC_OFFSET_MINUTES
+    else:
+        day_sql, day_param = "date(o.created_at, %s)", f"{UTC_OFFSET_MINUTES:+d} minutes"
+    only, only_o, params = "", "", ()
+    if merchant_id is not None:
+        only, only_o, params = " WHERE merchant_id = %s", " AND o.merchant_id = %s", (merchant_id,)
+
+    execute_query(cur, "DELETE FROM merchant_daily_sales" + only, params)
+    execute_query(cur, f"""
+        INSERT INTO merchant_daily_sales (merchant_id, day, orders_count, sales_amount, paid_amount)
+        SELECT o.merchant_id, {day_sql}, COUNT(*), COALESCE(SUM(o.final_amount), 0),
+               COALESCE(SUM(CASE WHEN o.payment_status = 'paid' THEN o.final_amount ELSE 0 END), 0)
+        FROM orders_merchant o
+        WHERE o.status = 'confirmed'{only_o}
+        GROUP BY 1, 2
+    """, (day_param,) + params)
+    days = cur.rowcount
+    execute_query(cur, """
+        UPDATE customers_merchant SET current_balance = COALESCE((
+            SELECT SUM(o.final_amount) FROM orders_merchant o
+            WHERE o.customer_id = customers_merchant.id AND o.status = 'confirmed'
+              AND COALESCE(o.payment_status, 'unpaid') <> 'paid'
+        ), 0)""" + only, params)
+    return days, cur.rowcount
+
+def rebuild_rollups(merchant_phone=None):
+    """Backfill: rebuilds the rollups for one merchant, or everyone. Returns (day rows, customers)."""
+    merchant_id = None
+    if merchant_phone:
+        merchant = get_user_by_phone(merchant_phone)
+        if not merchant: return 0, 0
+        merchant_id = merchant['id']
+    with get_cursor() as cur:
+        return _rebuild_rollups(cur, merchant_id)
+
+def get_sales_merchant(merchant_phone, first_day, last_day=None):
+    """
+    {'orders', 'sales', 'paid', 'due'} for local days first_day..last_day
+    (dates or 'YYYY-MM-DD', inclusive), read from merchant_daily_sales.
+    """
+    totals = {'orders': 0, 'sales': 0.0, 'paid': 0.0, 'due': 0.0}
+    merchant = get_user_by_phone(merchant_phone)
+    if not merchant: return totals
+    first_day, last_day = str(first_day), str(last_day or first_day)
+    with get_cursor() as cur:
+        execute_query(cur, """
+            SELECT COALESCE(SUM(orders_count), 0) AS orders, COALESCE(SUM(sales_amount), 0) AS sales, COALESCE(SUM(paid_amount), 0) AS paid
+            FROM merchant_daily_sales WHERE merchant_id = %s AND day >= %s AND day <= %s
+        """, (merchant['id'], first_day, last_day))
+        row = fetchone_normalized(cur)
+    totals.update(orders=int(row['orders']), sales=float(row['sales']), paid=float(row['paid']))
+    totals['due'] = totals['sales'] - totals['paid']
+    return totals
+
+def get_customer_balance_merchant(merchant_phone, customer_name):
+    """Outstanding amount for the best-matching customer as ({id, name, balance}, score), or (None, score)."""
+    merchant = get_user_by_phone(merchant_phone)
+    if not merchant: return None, 0.0
+    with get_cursor() as cur:
+        customer, score = _match_customer(cur, merchant['id'], customer_name)
+        if not customer: return None, score
+        execute_query(cur, "SELECT current_balance FROM customers_merchant WHERE id = %s", (customer['id'],))
+        row = fetchone_normalized(cur)
+    return dict(customer, balance=float((row or {}).get('current_balance') or 0)), score
+
+# --- BATCH READS ---
+# Batch exports walk thousands of orders. They are read in keyset-paginated
+# chunks, two set-based queries per chunk (orders + all their items), each on
+# a short-lived connection, so neither memory nor connection hold time grows
+# with the batch.
+BATCH_CHUNK = int(os.getenv("BATCH_CHUNK", "200"))
+
+def _ts(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S") if isinstance(dt, datetime) else dt
+
+def _orders_filter(merchant_id, start=None, end=None, customer_id=None, status='confirmed'):
+    where, params = ["o.merchant_id = %s"], [merchant_id]
+    if start is not None:
+        where.append("o.created_at >= %s"); params.append(_ts(start))
+    if end is not None:
+        where.append("o.created_at < %s"); params.append(_ts(end))
+    if customer_id is not None:
+        where.append("o.customer_id = %s"); params.append(customer_id)
+    if status:
+        where.append("o.status = %s"); params.append(status)
+    return " AND ".join(where), params
+
+def count_orders_merchant(merchant_phone, start=None, end=None, customer_id=None, status='confirmed'):
+    merchant = get_user_by_phone(merchant_phone)
+    if not merchant: return 0
+    where, params = _orders_filter(merchant['id'], start, end, customer_id, status)
+    with get_cursor() as cur:
+        execute_query(cur, f"SELECT COUNT(*) AS n FROM orders_merchant o WHERE {where}", params)
+        return fetchone_normalized(cur)['n']
+
+def iter_orders_merchant(merchant_phone, start=None, end=None, customer_id=None, status='confirmed', chunk=None):
+    """Yields orders in get_order_details_merchant's shape, oldest first. start/end bound created_at (UTC)."""
+    merchant = get_user_by_phone(merchant_phone)
+    if not merchant: return
+    chunk = chunk or BATCH_CHUNK
+    where, params = _orders_filter(merchant['id'], start, end, customer_id, status)
+    last_id = 0
+    while True:
+        with get_cursor() as cur:
+            execute_query(cur, f"""
+                SELECT o.*, c.name as customer_name, c.phone as customer_phone, u.business_name, u.phone as merchant_phone
+                FROM orders_merchant o
+                JOIN customers_merchant c ON o.customer_id = c.id
+                JOIN users u ON o.merchant_id = u.id
+                WHERE {where} AND o.id > %s
+                ORDER BY o.id
+                LIMIT %s
+            """, params + [last_id, chunk])
+            orders = fetchall_normalized(cur)
+            if not orders: return
+            ids = [o['id'] for o in orders]
+            execute_query(cur, f"SELECT * FROM order_items_merchant WHERE order_id IN ({', '.join(['%s'] * len(ids))}) ORDER BY order_id, id", ids)
+            items = {}
+            for item in fetchall_normalized(cur):
+                items.setdefault(item['order_id'], []).append(item)
+        # Connection is back in the pool while the caller renders this chunk
+        for order in orders:
+            order = dict(order)
+            order['items'] = items.get(order['id'], [])
+            yield order
+        if len(orders) < chunk: return
+        last_id = ids[-1]
+
+def set_order_pdf_url(order_id, pdf_url):
+    with get_cursor() as cur:
+        execute_query(cur, "UPDATE orders_merchant SET pdf_url = %s WHERE id = %s", (pdf_url, order_id))
+
 def save_meeting_notes(phone, audio_file, transcript, summary):
     phone = normalize_phone_for_db(phone)
     with get_cursor() as cur:
-        execute_query(cur, "INSERT INTO meeting_notes (phone, audio_file, transcript, summary) VALUES (%s, %s, %s, %s)", (phone, audio_file, transcript, summary))
\ No newline at end of file
+        execute_query(cur, "INSERT INTO meeting_notes (phone, audio_file, transcript, summary) VALUES (%s, %s, %s, %s)", (phone, audio_file, transcript, summary))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Merchant DB maintenance")
+    parser.add_argument("command", choices=["rebuild-rollups"])
+    parser.add_argument("--merchant", help="merchant phone (default: every merchant)")
+    args = parser.parse_args()
+    ensure_db()
+    t0 = time.perf_counter()
+    days, customers = rebuild_rollups(args.merchant)
+    print(f"✅ Rebuilt {days} daily sales rows and {customers} customer balances in {time.perf_counter() - t0:.2f}s")
@@ -0,0 +1,270 @@
+"""
+Per-merchant fair scheduling for merchant_jobs.
+
+Producers keep enqueueing to the plain RQ queue. Workers move each job from
+there into a per-merchant sub-queue in Redis, then take work round-robin
+across merchants, so one merchant forwarding 200 voice notes gets one turn
+per round like everyone else instead of holding the whole queue:
+
+  priority  "1"/"yes" replies (coalesce_merchant.IMMEDIATE_REPLIES); always
+            served before other merchants' work, no rate limit. The
+            merchant's own earlier jobs move up with the reply and still
+            run before it, so one sender's messages are never reordered
+  normal    everything else; each merchant has a token bucket of
+            FAIR_MERCHANT_RATE jobs/s (burst FAIR_MERCHANT_BURST); a
+            weight (set_weight) scales both and the jobs taken per turn
+
+A merchant whose job is still running in this worker is skipped, so their
+messages keep their order. Jobs moved off the RQ queue wait in a per-worker
+intake list until admitted; if a worker dies in between, another one
+re-admits them (recover()). Needs Redis 6.2+ (LMOVE/BLMOVE), checked when
+the scheduler is created.
+
+Rate limits per external API are in limits_merchant.
+"""
+import os
+import time
+import socket
+import threading
+
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from rq.utils import get_version
+
+from coalesce_merchant import is_immediate
+from limits_merchant import TOKEN_BUCKET_LUA
+from metrics_merchant import inc, register_collector, describe
+
+FAIR_MERCHANT_RATE = float(os.getenv("FAIR_MERCHANT_RATE", "1"))    # jobs/s per merchant; 0 = unlimited
+FAIR_MERCHANT_BURST = float(os.getenv("FAIR_MERCHANT_BURST", "20"))
+# Merchants looked at per dequeue before giving up (all busy or throttled)
+FAIR_MAX_SCAN = int(os.getenv("FAIR_MAX_SCAN", "200"))
+# How often merchants that are busy or throttled are looked at again
+FAIR_POLL = float(os.getenv("FAIR_POLL", "0.05"))
+INTAKE_BATCH = 100
+ALIVE_TTL = 30
+MIN_REDIS_VERSION = (6, 2)
+
+PREFIX = "mina:fair:"
+LANES = ('priority', 'normal')
+
+def sender_of(job):
+    """Ordering key: the sender of a process_message job, else the job itself."""
+    args = job.args
+    if args and isinstance(args[0], dict) and args[0].get('from'):
+        return args[0]['from']
+    return job.id
+
+def lane_of(job):
+    args = job.args
+    if job.func_name.endswith('process_message') and args and isinstance(args[0], dict) and is_immediate(args[0]):
+        return 'priority'
+    return 'normal'
+
+# ==========================================
+# 1. SCRIPTS
+# ==========================================
+
+# ARGV: prefix, lane, merchant, job id, intake list ('' = none), '1' to push at the front
+# A priority job takes the merchant's queued normal jobs into the priority
+# queue ahead of it; a job pushed back to the front goes wherever the
+# merchant's queued work is.
+_ADMIT_LUA = """
+local prefix, lane, m = ARGV[1], ARGV[2], ARGV[3]
+local pq = prefix .. 'priority:q:' .. m
+if lane == 'priority' and ARGV[6] ~= '1' then
+    local nq = prefix .. 'normal:q:' .. m
+    local had = redis.call('LLEN', pq)
+    local moved = 0
+    while redis.call('LMOVE', nq, pq, 'LEFT', 'RIGHT') do moved = moved + 1 end
+    if moved > 0 then
+        redis.call('LREM', prefix .. 'normal:ring', 0, m)
+        redis.call('HDEL', prefix .. 'normal:credit', m)
+        if had == 0 then redis.call('LPUSH', prefix .. 'priority:ring', m) end
+    end
+elseif ARGV[6] == '1' and redis.call('LLEN', pq) > 0 then
+    lane = 'priority'
+end
+local q = prefix .. lane .. ':q:' .. m
+local n
+if ARGV[6] == '1' then n = redis.call('LPUSH', q, ARGV[4]) else n = redis.call('RPUSH', q, ARGV[4]) end
+if n == 1 then redis.call('LPUSH', prefix .. lane .. ':ring', m) end
+if ARGV[5] ~= '' then redis.call('LREM', ARGV[5], 1, ARGV[4]) end
+return n
+"""
+
+# The ring holds each merchant with queued jobs once; its tail is served next.
+# ARGV: prefix, now, rate, burst, max scan, busy merchants...
+# Returns {job id, merchant, lane, merchants throttled, merchants waiting}; job
+# id '' when nothing is runnable.
+_NEXT_LUA = TOKEN_BUCKET_LUA + """
+local prefix, now, rate, burst, max_scan = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local busy = {}
+for i = 6, #ARGV do busy[ARGV[i]] = true end
+local throttled, waiting = 0, 0
+for _, lane in ipairs({'priority', 'normal'}) do
+    local ring = prefix .. lane .. ':ring'
+    local credit = prefix .. lane .. ':credit'
+    local n = redis.call('LLEN', ring)
+    waiting = waiting + n
+    for i = 1, math.min(n, max_scan) do
+        local m = redis.call('LINDEX', ring, -1)
+        local weight = tonumber(redis.call('HGET', prefix .. 'weights', m) or '1')
+        local ok = not busy[m]
+        if ok and lane == 'normal' and rate > 0 and take(prefix .. 'bucket:' .. m, rate * weight, burst * weight, now) > 0 then
+            ok = false
+            throttled = throttled + 1
+        end
+        if ok then
+            local q = prefix .. lane .. ':q:' .. m
+            local job = redis.call('LPOP', q)
+            if redis.call('LLEN', q) == 0 then
+                redis.call('RPOP', ring)
+                redis.call('HDEL', credit, m)
+            else
+                -- Weighted: a merchant keeps the turn for `weight` jobs
+                local left = tonumber(redis.call('HGET', credit, m) or weight) - 1
+                if left <= 0 then
+                    redis.call('RPOPLPUSH', ring, ring)
+                    redis.call('HDEL', credit, m)
+                else
+                    redis.call('HSET', credit, m, left)
+                end
+            end
+            if job then return {job, m, lane, throttled, waiting} end
+        else
+            redis.call('RPOPLPUSH', ring, ring)
+        end
+    end
+end
+return {'', '', '', throttled, waiting}
+"""
+
+# ==========================================
+# 2. SCHEDULER
+# ==========================================
+
+class FairScheduler:
+    def __init__(self, queues, connection):
+        version = get_version(connection)
+        if version[:2] < MIN_REDIS_VERSION:
+            raise RuntimeError(f"Fair scheduling needs Redis {'.'.join(map(str, MIN_REDIS_VERSION))}+ (LMOVE/BLMOVE), "
+                               f"server is {'.'.join(map(str, version))}. Unset FAIR_SCHEDULING to use the plain queue.")
+        self.conn = connection
+        self.queues = {q.name: q for q in queues}
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.intake_key = f"{PREFIX}intake:{self.worker_id}"
+        self._admit = connection.register_script(_ADMIT_LUA)
+        self._next = connection.register_script(_NEXT_LUA)
+        self._alive_at = 0.0
+        self._wakeup = threading.Event()
+        self.waiting = 0
+        register_collector(self.depth_samples)
+
+    def admit(self, job, front=False, intake=True):
+        """Puts a job on its merchant's sub-queue (and takes it off this worker's intake list)."""
+        self._admit(args=[PREFIX, lane_of(job), sender_of(job), job.id,
+                          self.intake_key if intake else '', '1' if front else '0'])
+
+    def requeue_front(self, job):
+        """Returns a job taken but not run to the head of its merchant's sub-queue."""
+        self.admit(job, front=True, intake=False)
+
+    def _admit_id(self, job_id, intake_key):
+        try:
+            job = Job.fetch(job_id.decode(), connection=self.conn)
+        except NoSuchJobError:
+            # Deleted or expired while queued: nothing to run
+            self.conn.lrem(intake_key, 1, job_id)
+            return
+        self._admit(args=[PREFIX, lane_of(job), sender_of(job), job.id, intake_key, '0'])
+
+    def intake(self, timeout=0):
+        """Moves waiting RQ jobs to the sub-queues; blocks up to timeout for the first if there are none."""
+        now = time.monotonic()
+        if now - self._alive_at > ALIVE_TTL / 3:
+            self.conn.set(f"{PREFIX}alive:{self.worker_id}", 1, ex=ALIVE_TTL)
+            self._alive_at = now
+        moved = 0
+        for q in self.queues.values():
+            while moved < INTAKE_BATCH:
+                job_id = self.conn.lmove(q.key, self.intake_key, 'LEFT', 'RIGHT')
+                if job_id is None: break
+                self._admit_id(job_id, self.intake_key)
+                moved += 1
+        if not moved and timeout:
+            # Only the first queue is waited on; merchant_jobs is the only one in practice
+            q = next(iter(self.queues.values()))
+            job_id = self.conn.blmove(q.key, self.intake_key, timeout, 'LEFT', 'RIGHT')
+            if job_id is not None:
+                self._admit_id(job_id, self.intake_key)
+                moved += 1
+        return moved
+
+    def pop(self, busy=()):
+        """(job, queue) for the next merchant in turn that isn't busy or throttled, else None."""
+        res = self._next(args=[PREFIX, time.time(), FAIR_MERCHANT_RATE, FAIR_MERCHANT_BURST, FAIR_MAX_SCAN, *busy])
+        job_id, merchant, lane, throttled, self.waiting = res
+        if throttled: inc("mina_fair_throttled_total", throttled)
+        if not job_id: return None
+        try:
+            job = Job.fetch(job_id.decode(), connection=self.conn)
+        except NoSuchJobError:
+            return None
+        inc("mina_fair_dispatched_total", lane=lane.decode())
+        queue = self.queues.get(job.origin) or next(iter(self.queues.values()))
+        return job, queue
+
+    def next(self, busy=(), timeout=1):
+        """Admits new jobs and returns the next (job, queue) to run, or None after about `timeout` seconds."""
+        self.intake()
+        res = self.pop(busy)
+        if res is not None: return res
+        if self.waiting:
+            # Queued work, but every merchant with some is busy or throttled:
+            # look again when a job finishes here or after FAIR_POLL
+            self._wakeup.wait(FAIR_POLL)
+            self._wakeup.clear()
+            return None
+        # Nothing queued at all: block for new work
+        if self.intake(timeout=timeout):
+            return self.pop(busy)
+        return None
+
+    def notify(self):
+        """Called by the worker when a merchant's job finishes, so their next one is picked up at once."""
+        self._wakeup.set()
+
+    def recover(self):
+        """Re-admits jobs left on the intake list of a worker that is gone. Returns how many."""
+        recovered = 0
+        for key in self.conn.scan_iter(f"{PREFIX}intake:*"):
+            worker_id = key.decode()[len(f"{PREFIX}intake:"):]
+            if worker_id == self.worker_id or self.conn.exists(f"{PREFIX}alive:{worker_id}"):
+                continue
+            for job_id in self.conn.lrange(key, 0, -1):
+                self._admit_id(job_id, key.decode())
+                recovered += 1
+        if recovered: print(f"♻️ Re-admitted {recovered} jobs from stopped workers")
+        return recovered
+
+    def depth_samples(self):
+        """Queued jobs per merchant and lane, plus jobs not yet admitted."""
+        samples = [("mina_queue_depth", {"queue": name}, self.conn.llen(q.key)) for name, q in self.queues.items()]
+        for lane in LANES:
+            merchants = self.conn.lrange(f"{PREFIX}{lane}:ring", 0, -1)
+            if not merchants: continue
+            pipe = self.conn.pipeline(transaction=False)
+            for m in merchants:
+                pipe.llen(f"{PREFIX}{lane}:q:{m.decode()}")
+            for m, n in zip(merchants, pipe.execute()):
+                samples.append(("mina_fair_queue_depth", {"merchant": m.decode(), "lane": lane}, n))
+        return samples
+
+def set_weight(connection, merchant, weight):
+    """Share for a merchant: multiplies their rate limit and jobs per turn (1 = default)."""
+    if weight == 1: connection.hdel(f"{PREFIX}weights", merchant)
+    else: connection.hset(f"{PREFIX}weights", merchant, int(weight))
+
+describe("mina_fair_dispatched_total", "Jobs handed out by the fair scheduler, by lane.")
+describe("mina_fair_throttled_total", "Turns skipped because the merchant's token bucket was empty.")
@@ -0,0 +1,149 @@
+"""
+Shared HTTP plumbing: one pooled requests.Session, a cached Twilio client,
+capped streaming downloads and a background sender for outbound messages.
+
+Everything here is process-wide and thread-safe, so keep-alive connections
+are reused across jobs and worker threads.
+"""
+import os
+import queue
+import threading
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) seconds
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "20"))
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+
+# Voice notes/photos bigger than this are refused rather than buffered
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Outbound sends go through this many background threads (0 = send inline)
+SEND_SHARDS = int(os.getenv("SEND_SHARDS", "4"))
+
+def _retry():
+    # Connection failures are retried for any method (nothing reached the server);
+    # 429/5xx only for idempotent ones, so a POSTed message is never sent twice.
+    return Retry(
+        total=HTTP_RETRIES, connect=HTTP_RETRIES, read=HTTP_RETRIES, status=HTTP_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+# ==========================================
+# 1. SESSION
+# ==========================================
+
+_session = None
+_twilio = None
+_lock = threading.Lock()
+
+def get_session():
+    """Process-wide requests.Session with keep-alive pooling and retry/backoff."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=_retry())
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
+
+def get_twilio_client(sid, token):
+    """Twilio client built once per process on a pooled HTTP client with timeouts."""
+    global _twilio
+    if _twilio is None:
+        with _lock:
+            if _twilio is None:
+                from twilio.rest import Client
+                from twilio.http.http_client import TwilioHttpClient
+                http = TwilioHttpClient(pool_connections=True, timeout=HTTP_READ_TIMEOUT, max_retries=_retry())
+                _twilio = Client(sid, token, http_client=http)
+    return _twilio
+
+class MediaTooLarge(Exception):
+    pass
+
+def download(url, auth=None, max_bytes=MEDIA_MAX_BYTES):
+    """
+    Streams url into memory, refusing anything over max_bytes (by
+    Content-Length up front, or while reading). Returns bytes, or None on
+    a non-200 response.
+    """
+    with get_session().get(url, auth=auth, stream=True, timeout=HTTP_TIMEOUT) as res:
+        if res.status_code != 200:
+            return None
+        size = int(res.headers.get("Content-Length") or 0)
+        if size > max_bytes:
+            raise MediaTooLarge(f"{size} bytes > {max_bytes}")
+        buf = bytearray()
+        for chunk in res.iter_content(64 * 1024):
+            buf += chunk
+            if len(buf) > max_bytes:
+                raise MediaTooLarge(f"more than {max_bytes} bytes")
+        return bytes(buf)
+
+# ==========================================
+# 2. BACKGROUND SENDER
+# ==========================================
+# Jobs hand outbound messages off here instead of waiting on the provider's
+# API. Calls with the same key (the recipient) always go to the same thread,
+# so a recipient's messages still arrive in the order they were sent.
+
+class ShardedSender:
+    def __init__(self, shards):
+        self.queues = [queue.Queue() for _ in range(shards)]
+        self.threads = []
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"sender-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is None: return
+                fn, args, kwargs = item
+                try: fn(*args, **kwargs)
+                except Exception as e: print(f"Send Error: {e}")
+            finally:
+                q.task_done()
+
+    def submit(self, key, fn, *args, **kwargs):
+        shard = zlib.crc32(str(key).encode()) % len(self.queues)
+        self.queues[shard].put((fn, args, kwargs))
+
+    def flush(self):
+        """Blocks until everything submitted so far has been sent."""
+        for q in self.queues:
+            q.join()
+
+_sender = None
+
+def send_async(key, fn, *args, **kwargs):
+    """Runs fn(*args, **kwargs) on the sender thread for key; inline if SEND_SHARDS=0."""
+    global _sender
+    if SEND_SHARDS <= 0:
+        return fn(*args, **kwargs)
+    if _sender is None:
+        with _lock:
+            if _sender is None:
+                _sender = ShardedSender(SEND_SHARDS)
+    _sender.submit(key, fn, *args, **kwargs)
+
+def flush_sends():
+    """Waits for queued sends; call before the process exits."""
+    if _sender is not None:
+        _sender.flush()
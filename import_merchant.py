@@ -0,0 +1,319 @@
+"""
+Bulk onboarding import: a merchant's product list or customer book from a
+CSV, Excel (.xlsx) or Tally XML export.
+
+    python import_merchant.py <merchant phone> products.csv --kind products
+    python import_merchant.py <merchant phone> Master.xml --kind customers
+
+The file is read row by row (Tally XML with iterparse, Excel in read-only
+mode), so memory stays flat for 100k-row exports. Rows are validated,
+deduplicated against the merchant's existing rows and earlier rows of the
+file (customers by phone, as UNIQUE(merchant_id, phone) requires, else by
+name; products by name), and written IMPORT_BATCH at a time, one
+transaction per batch, with COPY on Postgres / executemany on SQLite. The
+catalog cache and customer index are invalidated once, at the end.
+"""
+import os
+import re
+import csv
+import time
+import argparse
+
+from utils import normalize_phone_for_db
+from db_merchant import (
+    ensure_db,
+    get_cursor,
+    execute_query,
+    fetchall_normalized,
+    get_or_create_user,
+    copy_rows,
+    invalidate_customer_index,
+)
+from cache_merchant import invalidate_catalog
+
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "2000"))
+MAX_ERRORS_KEPT = 100
+
+KINDS = ('products', 'customers')
+
+# Header spellings seen in merchant spreadsheets -> our column
+HEADERS = {
+    'products': {
+        'name': ('name', 'product', 'product name', 'item', 'item name', 'stock item', 'particulars'),
+        'alias': ('alias', 'aliases', 'local name', 'other name'),
+        'unit': ('unit', 'units', 'uom', 'base unit', 'base units'),
+        'price': ('price', 'rate', 'selling price', 'sale price', 'sp', 'mrp'),
+        'hsn_code': ('hsn', 'hsn code', 'hsn/sac', 'hsn_code', 'sac'),
+        'gst_rate': ('gst', 'gst rate', 'gst %', 'gst_rate', 'tax rate', 'tax %'),
+        'stock_qty': ('stock', 'stock qty', 'stock_qty', 'qty', 'quantity', 'opening stock', 'closing stock'),
+        'description': ('description', 'details', 'remarks'),
+    },
+    'customers': {
+        'name': ('name', 'customer', 'customer name', 'party', 'party name', 'ledger', 'ledger name'),
+        'phone': ('phone', 'mobile', 'mobile no', 'mobile number', 'phone number', 'contact', 'contact no', 'whatsapp'),
+        'gstin': ('gstin', 'gst no', 'gst number', 'gstin/uin', 'party gstin'),
+        'billing_address': ('address', 'billing address', 'billing_address'),
+        'email': ('email', 'e-mail', 'email id'),
+    },
+}
+NUMERIC = {'price', 'gst_rate', 'stock_qty'}
+
+# ==========================================
+# 1. READERS
+# ==========================================
+# Each yields (line number, {header: value}) in file order.
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8-sig', errors='replace') as f:
+        sample = f.read(8192)
+        f.seek(0)
+        try: dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        except csv.Error: dialect = csv.excel
+        for i, row in enumerate(csv.DictReader(f, dialect=dialect), start=2):
+            yield i, row
+
+def read_excel(path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("Excel import needs the openpyxl package")
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = [str(h or '').strip() for h in next(rows, ())]
+        for i, values in enumerate(rows, start=2):
+            if any(v not in (None, '') for v in values):
+                yield i, dict(zip(header, values))
+    finally:
+        wb.close()
+
+def _text(elem, *paths):
+    for path in paths:
+        for node in elem.iter(path):
+            if node.text and node.text.strip():
+                return node.text.strip()
+    return None
+
+def read_tally(path, kind):
+    """STOCKITEMs (products) or Sundry Debtors LEDGERs (customers) from a Tally master export."""
+    import xml.etree.ElementTree as ET
+    tag = 'STOCKITEM' if kind == 'products' else 'LEDGER'
+    n = 0
+    for _, elem in ET.iterparse(path, events=('end',)):
+        if elem.tag != tag: continue
+        n += 1
+        names = [node.text.strip() for node in elem.iter('NAME') if node.text and node.text.strip()]
+        name = elem.get('NAME') or (names[0] if names else None)
+        if kind == 'products':
+            gst = None
+            for detail in elem.iter('RATEDETAILS.LIST'):
+                if (_text(detail, 'GSTRATEDUTYHEAD') or '').upper() == 'IGST':
+                    gst = _text(detail, 'GSTRATE')
+            row = {
+                'name': name,
+                'alias': ', '.join(a for a in names if a != name) or None,
+                'unit': _text(elem, 'BASEUNITS'),
+                'price': _text(elem, 'RATE', 'OPENINGRATE'),
+                'hsn_code': _text(elem, 'HSNCODE'),
+                'gst_rate': gst or _text(elem, 'GSTRATE'),
+                'stock_qty': _text(elem, 'OPENINGBALANCE'),
+            }
+            yield n, row
+        elif (_text(elem, 'PARENT') or '').lower() == 'sundry debtors':
+            address = [node.text.strip() for node in elem.iter('ADDRESS') if node.text and node.text.strip()]
+            yield n, {
+                'name': name,
+                'phone': _text(elem, 'LEDGERMOBILE', 'LEDGERPHONE'),
+                'gstin': _text(elem, 'PARTYGSTIN', 'GSTIN'),
+                'billing_address': ', '.join(address) or None,
+                'email': _text(elem, 'EMAIL'),
+            }
+        # Keep memory flat on big exports
+        elem.clear()
+
+def detect_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.xlsx', '.xlsm'): return 'excel'
+    if ext == '.xml': return 'tally'
+    return 'csv'
+
+def read_rows(path, kind, fmt=None):
+    fmt = fmt or detect_format(path)
+    if fmt == 'excel': return read_excel(path)
+    if fmt == 'tally': return read_tally(path, kind)
+    return read_csv(path)
+
+# ==========================================
+# 2. VALIDATION
+# ==========================================
+
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+_GSTIN = re.compile(r'^\d{2}[A-Z0-9]{10}[A-Z0-9]Z[A-Z0-9]$')
+_EMAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+def _number(value):
+    """42, '42', '₹ 1,250.00', '42.00/kg' -> float; blank -> None; ValueError otherwise."""
+    if value is None or isinstance(value, (int, float)): return value
+    text = str(value).replace(',', '').strip()
+    if not text: return None
+    m = _NUMBER.search(text)
+    if not m: raise ValueError(f"not a number: {value!r}")
+    return float(m.group())
+
+def clean_phone(value):
+    """
+    The phone as normalize_phone_for_db stores it everywhere else (so the
+    UNIQUE(merchant_id, phone) dedupe matches), or None if it doesn't look
+    like a phone number.
+    """
+    if value is None: return None
+    if isinstance(value, float): value = f"{value:.0f}"   # Excel stores numbers as floats
+    value = str(value).strip()
+    if not 10 <= len(re.sub(r'\D', '', value)) <= 15: return None
+    return normalize_phone_for_db(value) or None
+
+def dedupe_key(name):
+    return ' '.join(str(name).lower().split())
+
+def map_headers(row, kind):
+    """Renames a row's headers to our columns; unknown headers are dropped."""
+    lookup = {}
+    for col, names in HEADERS[kind].items():
+        for n in (col,) + names: lookup[n] = col
+    out = {}
+    for header, value in row.items():
+        col = lookup.get(str(header or '').strip().lower())
+        if col and col not in out:
+            out[col] = value.strip() if isinstance(value, str) else value
+    return out
+
+def clean_row(row, kind):
+    """Validated {column: value}; raises ValueError with the reason for a row to reject."""
+    row = {k: (None if v == '' else v) for k, v in map_headers(row, kind).items()}
+    if not row.get('name') or not str(row['name']).strip():
+        raise ValueError("missing name")
+    row['name'] = str(row['name']).strip()[:200]
+    for col in NUMERIC & row.keys():
+        row[col] = _number(row[col])
+    if kind == 'products':
+        if row.get('price') is not None and row['price'] < 0: raise ValueError("negative price")
+        if row.get('hsn_code') is not None:
+            hsn = row['hsn_code']
+            row['hsn_code'] = f"{hsn:.0f}" if isinstance(hsn, float) else str(hsn).strip()
+    else:
+        # Bad contact details are dropped, the customer is still imported;
+        # a dropped phone is reported (import_file counts it in bad_phones)
+        raw_phone = row.get('phone')
+        row['phone'] = clean_phone(raw_phone)
+        if row['phone'] is None and str(raw_phone or '').strip():
+            row['bad_phone'] = str(raw_phone).strip()
+        gstin = str(row.get('gstin') or '').strip().upper()
+        row['gstin'] = gstin if _GSTIN.match(gstin) else None
+        email = str(row.get('email') or '').strip()
+        row['email'] = email if _EMAIL.match(email) else None
+    return row
+
+# ==========================================
+# 3. IMPORT
+# ==========================================
+
+COLUMNS = {
+    'products': ('name', 'alias', 'description', 'unit', 'price', 'stock_qty', 'hsn_code', 'gst_rate'),
+    'customers': ('name', 'phone', 'gstin', 'billing_address', 'email'),
+}
+DEFAULTS = {'unit': 'pcs', 'price': 0.0, 'stock_qty': 0.0, 'gst_rate': 0.0}
+
+def _existing_keys(merchant_id, kind):
+    """Dedupe keys already in the DB: product names, or customer names, phones and names without a phone."""
+    with get_cursor() as cur:
+        if kind == 'products':
+            execute_query(cur, "SELECT name FROM products_merchant WHERE merchant_id = %s", (merchant_id,))
+            return {dedupe_key(r['name']) for r in fetchall_normalized(cur)}, set(), set()
+        execute_query(cur, "SELECT name, phone FROM customers_merchant WHERE merchant_id = %s", (merchant_id,))
+        rows = fetchall_normalized(cur)
+        return ({dedupe_key(r['name']) for r in rows}, {r['phone'] for r in rows if r['phone']},
+                {dedupe_key(r['name']) for r in rows if not r['phone']})
+
+def print_progress(stats):
+    rate = stats['read'] / max(stats['seconds'], 1e-9)
+    bad = f", {stats['bad_phones']:,} invalid phones dropped" if stats['bad_phones'] else ""
+    print(f"📥 {stats['kind']}: {stats['read']:,} read, {stats['imported']:,} imported, "
+          f"{stats['duplicates']:,} duplicates, {stats['rejected']:,} rejected{bad} ({rate:,.0f} rows/s)")
+
+def import_file(merchant_phone, path, kind, fmt=None, batch_size=None, progress=print_progress):
+    """
+    Imports products or customers for a merchant. Returns stats: read,
+    imported, duplicates, rejected, bad_phones (customers imported without
+    their invalid phone), errors [(line, reason)], seconds.
+    progress(stats) is called after every batch.
+    """
+    if kind not in KINDS: raise ValueError(f"kind must be one of {KINDS}")
+    batch_size = batch_size or IMPORT_BATCH
+    merchant_id = get_or_create_user(merchant_phone)['id']
+    table = f"{kind}_merchant"
+    columns = ('merchant_id',) + COLUMNS[kind]
+    conflict = "merchant_id, phone" if kind == 'customers' else None
+    names, phones, phoneless = _existing_keys(merchant_id, kind)
+
+    stats = {'kind': kind, 'read': 0, 'imported': 0, 'duplicates': 0, 'rejected': 0, 'bad_phones': 0, 'errors': [], 'seconds': 0.0}
+    t0 = time.perf_counter()
+    batch = []
+
+    def flush():
+        with get_cursor() as cur:
+            inserted = copy_rows(cur, table, columns, batch, conflict)
+        # Rows another writer inserted meanwhile were skipped by the unique key
+        stats['duplicates'] += len(batch) - inserted
+        stats['imported'] += inserted
+        stats['seconds'] = time.perf_counter() - t0
+        batch.clear()
+        if progress: progress(stats)
+
+    for line, raw in read_rows(path, kind, fmt):
+        stats['read'] += 1
+        try:
+            row = clean_row(raw, kind)
+        except ValueError as e:
+            stats['rejected'] += 1
+            if len(stats['errors']) < MAX_ERRORS_KEPT: stats['errors'].append((line, str(e)))
+            continue
+        name_key = dedupe_key(row['name'])
+        phone = row.get('phone')
+        # Customers are the same person by phone; without one, by name. A
+        # row whose phone was dropped only matches customers without a phone:
+        # its namesake with a number may well be someone else.
+        if phone: duplicate = phone in phones
+        elif row.get('bad_phone'): duplicate = name_key in phoneless
+        else: duplicate = name_key in names
+        if duplicate:
+            stats['duplicates'] += 1
+            continue
+        if row.get('bad_phone'):
+            stats['bad_phones'] += 1
+            if len(stats['errors']) < MAX_ERRORS_KEPT: stats['errors'].append((line, f"invalid phone {row['bad_phone']!r}, imported without it"))
+        names.add(name_key)
+        if phone: phones.add(phone)
+        else: phoneless.add(name_key)
+        batch.append((merchant_id,) + tuple(DEFAULTS.get(c) if row.get(c) is None else row[c] for c in COLUMNS[kind]))
+        if len(batch) >= batch_size: flush()
+    if batch or not stats['seconds']: flush()
+
+    if kind == 'products': invalidate_catalog(merchant_id)
+    else: invalidate_customer_index(merchant_id)
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import a merchant's products or customers")
+    parser.add_argument("merchant_phone")
+    parser.add_argument("path")
+    parser.add_argument("--kind", required=True, choices=KINDS)
+    parser.add_argument("--format", choices=("csv", "excel", "tally"), help="default: from the file extension")
+    parser.add_argument("--batch", type=int, default=IMPORT_BATCH, help="rows per transaction")
+    args = parser.parse_args()
+    ensure_db()
+    stats = import_file(args.merchant_phone, args.path, args.kind, args.format, args.batch)
+    for line, reason in stats['errors']:
+        print(f"  line {line}: {reason}")
+    print(f"✅ Imported {stats['imported']:,} {args.kind} in {stats['seconds']:.2f}s")
+    if stats['bad_phones']:
+        print(f"⚠️ {stats['bad_phones']:,} customers imported without their phone (not a valid number)")
@@ -0,0 +1,139 @@
+"""
+Per-dependency concurrency and rate limits.
+
+With worker_merchant.py --concurrency N, up to N messages are in flight in
+one process. Each external service gets its own cap so a slow one (usually
+Gemini) can't tie up every thread, and we stay under provider rate limits:
+
+    with limit('gemini'):
+        res = model.generate_content(contents)
+
+LIMITS caps calls in flight per process. RATES caps calls per second across
+every worker: a token bucket kept in Redis (per process when Redis is down),
+so all tenants together stay inside the provider's quota. A call waits for
+its token before taking a concurrency slot.
+
+The DB needs no entry here: the connection pool (DB_POOL_SIZE) already bounds it.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from redis_merchant import get_redis, mark_redis_down
+from metrics_merchant import observe, describe
+
+LIMITS = {
+    'gemini': int(os.getenv('LIMIT_GEMINI', '8')),
+    'twilio': int(os.getenv('LIMIT_TWILIO', '8')),
+    'media': int(os.getenv('LIMIT_MEDIA', '4')),
+}
+
+# Calls per second, shared by all workers; 0 = unlimited
+RATES = {
+    'gemini': float(os.getenv('RATE_GEMINI', '0')),
+    'twilio': float(os.getenv('RATE_TWILIO', '0')),
+    'media': float(os.getenv('RATE_MEDIA', '0')),
+}
+# Bucket size, as seconds' worth of the rate
+RATE_BURST_SECONDS = float(os.getenv('RATE_BURST_SECONDS', '2'))
+
+_semaphores = {name: threading.BoundedSemaphore(n) for name, n in LIMITS.items() if n > 0}
+
+# ==========================================
+# 1. TOKEN BUCKETS
+# ==========================================
+
+# take(key, rate, burst, now) -> 0 when a token was taken, else seconds until
+# one is available. Shared with fair_merchant's dequeue script.
+TOKEN_BUCKET_LUA = """
+local function take(key, rate, burst, now)
+    local b = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(b[1]) or burst
+    local ts = tonumber(b[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local wait = 0
+    if tokens < 1 then
+        wait = (1 - tokens) / rate
+    else
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 60)
+    return wait
+end
+"""
+
+_TAKE_LUA = TOKEN_BUCKET_LUA + """
+return tostring(take(KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])))
+"""
+
+class TokenBucket:
+    """In-process bucket, used when Redis is unavailable."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + max(0.0, now - self.ts) * self.rate)
+            self.ts = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            return 0.0
+
+_local_buckets = {}
+_script = None
+
+def take_token(key, rate, burst):
+    """Takes a token from bucket `key`: 0.0 on success, else seconds to wait before retrying."""
+    global _script
+    r = get_redis()
+    if r is not None:
+        try:
+            if _script is None: _script = r.register_script(_TAKE_LUA)
+            return float(_script(keys=[f"mina:rate:{key}"], args=[rate, burst, time.time()], client=r))
+        except Exception as e:
+            mark_redis_down(e)
+    bucket = _local_buckets.get(key)
+    if bucket is None:
+        bucket = _local_buckets.setdefault(key, TokenBucket(rate, burst))
+    return bucket.take()
+
+def wait_for_token(name):
+    """Blocks until dependency `name` is under its RATES entry (no-op if unlimited)."""
+    rate = RATES.get(name)
+    if not rate: return
+    burst = max(1.0, rate * RATE_BURST_SECONDS)
+    t0 = time.perf_counter()
+    while True:
+        wait = take_token(name, rate, burst)
+        if wait <= 0: break
+        time.sleep(min(wait, 1.0))
+    observe("mina_rate_wait_seconds", time.perf_counter() - t0, service=name)
+
+# ==========================================
+# 2. LIMIT
+# ==========================================
+
+@contextmanager
+def limit(name):
+    """Waits for a rate token, then holds one of the slots for dependency `name` (no-op for unknown/unlimited names)."""
+    wait_for_token(name)
+    sem = _semaphores.get(name)
+    if sem is None:
+        yield
+        return
+    sem.acquire()
+    try:
+        yield
+    finally:
+        sem.release()
+
+describe("mina_rate_wait_seconds", "Time calls waited for a RATES token.")
@@ -0,0 +1,363 @@
+"""
+Fast fuzzy name matching for merchant data (customers, products).
+
+Names are split into tokens and each token is reduced to a phonetic key that
+ignores common Hindi/English spelling variants, so "Ramesh", "Rameshh",
+"Rames" and "रमेश" all key to "rames". A NameIndex keeps an inverted index of
+key trigrams, so a lookup only scores the handful of entries that share
+trigrams with the query instead of scanning every name.
+
+catalog_retriever() uses the same keys to pick the few products a message is
+about out of a large catalog, for the Gemini prompt.
+"""
+import re
+import math
+import threading
+from collections import Counter
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+# ==========================================
+# 1. NORMALIZATION
+# ==========================================
+
+# --- Devanagari -> Latin ---
+_DEV_VOWELS = {
+    'अ': 'a', 'आ': 'aa', 'इ': 'i', 'ई': 'ii', 'उ': 'u', 'ऊ': 'uu', 'ऋ': 'ri',
+    'ए': 'e', 'ऐ': 'ai', 'ओ': 'o', 'औ': 'au', 'ऑ': 'o', 'ऍ': 'e',
+}
+_DEV_MATRAS = {
+    'ा': 'aa', 'ि': 'i', 'ी': 'ii', 'ु': 'u', 'ू': 'uu', 'ृ': 'ri',
+    'े': 'e', 'ै': 'ai', 'ो': 'o', 'ौ': 'au', 'ॉ': 'o', 'ॅ': 'e',
+}
+_DEV_CONSONANTS = {
+    'क': 'k', 'ख': 'kh', 'ग': 'g', 'घ': 'gh', 'ङ': 'n',
+    'च': 'ch', 'छ': 'chh', 'ज': 'j', 'झ': 'jh', 'ञ': 'n',
+    'ट': 't', 'ठ': 'th', 'ड': 'd', 'ढ': 'dh', 'ण': 'n',
+    'त': 't', 'थ': 'th', 'द': 'd', 'ध': 'dh', 'न': 'n',
+    'प': 'p', 'फ': 'ph', 'ब': 'b', 'भ': 'bh', 'म': 'm',
+    'य': 'y', 'र': 'r', 'ल': 'l', 'व': 'v', 'श': 'sh',
+    'ष': 'sh', 'स': 's', 'ह': 'h', 'ळ': 'l',
+}
+_DEV_SIGNS = {'ं': 'n', 'ँ': 'n', 'ः': 'h'}
+_VIRAMA = '्'
+_NUKTA = '़'
+
+def transliterate(text):
+    """Romanizes Devanagari (inherent 'a' included); other characters pass through."""
+    out = []
+    pending_a = False
+    for ch in text:
+        if ch == _NUKTA:
+            continue
+        if ch in _DEV_MATRAS:
+            out.append(_DEV_MATRAS[ch])
+            pending_a = False
+            continue
+        if ch == _VIRAMA:
+            pending_a = False
+            continue
+        if pending_a:
+            out.append('a')
+            pending_a = False
+        if ch in _DEV_CONSONANTS:
+            out.append(_DEV_CONSONANTS[ch])
+            pending_a = True
+        elif ch in _DEV_VOWELS:
+            out.append(_DEV_VOWELS[ch])
+        elif ch in _DEV_SIGNS:
+            out.append(_DEV_SIGNS[ch])
+        elif '०' <= ch <= '९':
+            out.append(str(ord(ch) - ord('०')))
+        else:
+            out.append(ch)
+    if pending_a:
+        out.append('a')
+    return ''.join(out)
+
+# --- Phonetic keys ---
+# Applied in order; multi-letter clusters first
+_PHONETIC_RULES = [
+    ('chh', 'c'), ('ch', 'c'), ('sh', 's'), ('ph', 'f'), ('kh', 'k'), ('gh', 'g'),
+    ('jh', 'j'), ('th', 't'), ('dh', 'd'), ('bh', 'b'), ('ck', 'k'),
+    ('q', 'k'), ('x', 'ks'), ('z', 'j'), ('w', 'v'), ('y', 'i'),
+    ('ee', 'i'), ('ii', 'i'), ('oo', 'u'), ('uu', 'u'), ('aa', 'a'),
+]
+_REPEATS = re.compile(r'(.)\1+')
+_TOKEN_SPLIT = re.compile(r'[^0-9a-z]+')
+
+def phonetic_key(token):
+    """Spelling-insensitive key for a single lowercase Latin token."""
+    key = token
+    for src, dst in _PHONETIC_RULES:
+        key = key.replace(src, dst)
+    # Silent/optional 'h' (Mahesh / Maesh), doubled letters, trailing schwa
+    key = key[:1] + key[1:].replace('h', '')
+    key = _REPEATS.sub(r'\1', key)
+    if len(key) > 2 and key.endswith('a'):
+        key = key[:-1]
+    return key
+
+# Honorifics carry no identity; business suffixes do, but weakly
+HONORIFICS = {'ji', 'shri', 'sri', 'shree', 'mr', 'mrs', 'ms', 'smt', 'sir', 'sahab', 'saheb', 'seth', 'bhai', 'bhaiya', 'didi', 'madam'}
+WEAK_TOKENS = {'traders', 'trader', 'store', 'stores', 'kirana', 'general', 'enterprises', 'enterprise', 'agency', 'agencies',
+               'mart', 'shop', 'co', 'and', 'sons', 'brothers', 'bros', 'wale', 'wala', 'vala', 'wali'}
+WEAK_WEIGHT = 0.3
+
+def tokenize(name):
+    """[(phonetic_key, weight)] for a name, honorifics dropped."""
+    text = transliterate(name or '').lower()
+    tokens = []
+    for tok in _TOKEN_SPLIT.split(text):
+        if not tok or tok in HONORIFICS: continue
+        tokens.append((phonetic_key(tok), WEAK_WEIGHT if tok in WEAK_TOKENS else 1.0))
+    return tokens
+
+def normalize_name(name):
+    """Canonical string form of a name, used as an exact-match key."""
+    return ' '.join(k for k, _ in tokenize(name))
+
+def _trigrams(key):
+    padded = f"${key}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# Name vocabularies are small, so token pairs repeat a lot across lookups
+@lru_cache(maxsize=65536)
+def _token_sim(a, b):
+    if a == b: return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+def score_tokens(query, candidate):
+    """0..1 similarity, weighted mostly on how well the query is covered."""
+    if not query or not candidate: return 0.0
+    q_total = sum(w for _, w in query)
+    c_total = sum(w for _, w in candidate)
+    recall = sum(w * max(_token_sim(k, ck) for ck, _ in candidate) for k, w in query) / q_total
+    precision = sum(w * max(_token_sim(ck, k) for k, _ in query) for ck, w in candidate) / c_total
+    return 0.7 * recall + 0.3 * precision
+
+# ==========================================
+# 2. INDEX
+# ==========================================
+
+class NameIndex:
+    """
+    In-memory fuzzy index of id -> name(s). An id may carry several names
+    (e.g. a product name and its alias); the best-scoring one counts.
+    """
+
+    # Only this many trigram-overlap candidates get a full similarity score
+    MAX_CANDIDATES = 25
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}      # id -> [(name, tokens)]
+        self._exact = {}      # normalized name -> set(ids)
+        self._grams = {}      # trigram -> set(ids)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, item_id, *names):
+        with self._lock:
+            entries = self._names.setdefault(item_id, [])
+            known = {n for n, _ in entries}
+            for name in names:
+                if not name or name in known: continue
+                tokens = tokenize(name)
+                if not tokens: continue
+                entries.append((name, tokens))
+                known.add(name)
+                self._exact.setdefault(' '.join(k for k, _ in tokens), set()).add(item_id)
+                for key, _ in tokens:
+                    for g in _trigrams(key):
+                        self._grams.setdefault(g, set()).add(item_id)
+
+    def remove(self, item_id):
+        with self._lock:
+            for name, tokens in self._names.pop(item_id, []):
+                ids = self._exact.get(' '.join(k for k, _ in tokens))
+                if ids: ids.discard(item_id)
+                for key, _ in tokens:
+                    for g in _trigrams(key):
+                        ids = self._grams.get(g)
+                        if ids: ids.discard(item_id)
+
+    def name_of(self, item_id):
+        entries = self._names.get(item_id)
+        return entries[0][0] if entries else None
+
+    def exact(self, name):
+        """Ids with a name that normalizes exactly like name, oldest first."""
+        with self._lock:
+            return sorted(self._exact.get(normalize_name(name), ()))
+
+    def search(self, name, limit=5):
+        """Best matches as [(id, score)], highest first."""
+        query = tokenize(name)
+        if not query: return []
+        with self._lock:
+            exact = self._exact.get(' '.join(k for k, _ in query), ())
+            hits = Counter()
+            for key, _ in query:
+                for g in _trigrams(key):
+                    ids = self._grams.get(g)
+                    if ids: hits.update(ids)
+            candidates = set(exact)
+            candidates.update(i for i, _ in hits.most_common(self.MAX_CANDIDATES))
+            scored = []
+            for item_id in candidates:
+                best = max(score_tokens(query, tokens) for _, tokens in self._names.get(item_id, [('', [])]))
+                scored.append((item_id, best))
+        # Ties go to the oldest (lowest) id, like the old first-row lookup
+        scored.sort(key=lambda x: (-x[1], x[0]))
+        return scored[:limit]
+
+    def best(self, name, threshold=0.0):
+        """(id, score) of the best match at or above threshold, else (None, score)."""
+        res = self.search(name, limit=1)
+        if res and res[0][1] >= threshold:
+            return res[0]
+        return None, (res[0][1] if res else 0.0)
+
+    def best_unique(self, name, threshold=0.0, margin=0.0, token_min=0.0):
+        """
+        Like best(), but only for an unambiguous match: it must beat the next
+        id by margin, and every strong query token needs a token at least
+        token_min similar in the match. A one-word name needs its key exactly
+        ("Rakesh" is not a typo of "Ramesh"). An exact match always wins.
+        """
+        res = self.search(name, limit=2)
+        if not res: return None, 0.0
+        top_id, top = res[0]
+        if top >= 1.0: return top_id, top
+        runner = res[1][1] if len(res) > 1 else 0.0
+        if top < threshold or top - runner < margin: return None, top
+        query = tokenize(name)
+        strong = [k for k, w in query if w >= 1.0] or [k for k, _ in query]
+        need = 1.0 if len(strong) == 1 else token_min
+        for _, tokens in self._names.get(top_id, []):
+            if all(max(_token_sim(k, ck) for ck, _ in tokens) >= need for k in strong):
+                return top_id, top
+        return None, top
+
+# --- Product index ---
+# One NameIndex per catalog version (name + alias), shared by every lookup on
+# that catalog until it changes.
+_PRODUCT_INDEXES = {}
+_PRODUCT_INDEXES_MAX = 256
+_product_indexes_lock = threading.Lock()
+
+def product_index(catalog):
+    """NameIndex over a cache_merchant.Catalog, keyed by product id."""
+    index = _PRODUCT_INDEXES.get(catalog.version)
+    if index is not None:
+        return index
+    index = NameIndex()
+    for p in catalog.products:
+        aliases = [a.strip() for a in re.split(r'[,/|;]', p.alias or '')]
+        index.add(p.id, p.name, *aliases)
+    with _product_indexes_lock:
+        if len(_PRODUCT_INDEXES) >= _PRODUCT_INDEXES_MAX:
+            _PRODUCT_INDEXES.pop(next(iter(_PRODUCT_INDEXES)))
+        _PRODUCT_INDEXES[catalog.version] = index
+    return index
+
+# ==========================================
+# 3. CATALOG RETRIEVAL
+# ==========================================
+# Picks the products a message is likely about, so the Gemini prompt can list
+# a few dozen candidates instead of a distributor's whole catalog. Works per
+# token rather than per name: a message mentions several products, in any
+# order, among quantities and filler words.
+
+class CatalogRetriever:
+    """
+    Inverted index of one catalog: phonetic token -> product ids (name and
+    aliases), key trigrams -> tokens for misspellings, and HSN code -> ids.
+    Tokens shared by many products (brands, "dal", "oil") weigh less.
+    """
+
+    # Query tokens are compared to at most this many trigram-overlap keys
+    MAX_KEYS = 20
+    MIN_SIM = 0.75
+
+    def __init__(self, products):
+        self._postings = {}   # key -> set(ids)
+        self._grams = {}      # trigram -> set(keys)
+        self._hsn = {}        # hsn code -> set(ids)
+        for p in products:
+            names = [p.name] + [a.strip() for a in re.split(r'[,/|;]', p.alias or '')]
+            for name in names:
+                for key, _ in tokenize(name):
+                    self._postings.setdefault(key, set()).add(p.id)
+            if p.hsn_code:
+                self._hsn.setdefault(str(p.hsn_code).strip(), set()).add(p.id)
+        for key in self._postings:
+            for g in _trigrams(key):
+                self._grams.setdefault(g, set()).add(key)
+        self._n = max(len(products), 1)
+
+    def _idf(self, key):
+        return math.log(1 + self._n / len(self._postings[key]))
+
+    def _similar_keys(self, key):
+        if key in self._postings and len(key) < 3:
+            return [(key, 1.0)]
+        if len(key) < 3: return []
+        hits = Counter()
+        for g in _trigrams(key):
+            keys = self._grams.get(g)
+            if keys: hits.update(keys)
+        out = []
+        for cand, _ in hits.most_common(self.MAX_KEYS):
+            sim = _token_sim(key, cand)
+            if sim >= self.MIN_SIM: out.append((cand, sim))
+        return out
+
+    def top_k(self, text, k=50):
+        """
+        Product ids most relevant to text (at most k, possibly none). Slots are
+        dealt round-robin across the message's words, so a brand shared by
+        hundreds of products can't crowd out the other items mentioned.
+        """
+        scores = Counter()
+        lists = []
+        for raw in set(_TOKEN_SPLIT.split(transliterate(text or '').lower())):
+            if raw in self._hsn:
+                lists.append(self._hsn[raw])
+                for pid in self._hsn[raw]: scores[pid] += 2.0
+        for key in {k for k, _ in tokenize(text)}:
+            matched = set()
+            for cand, sim in self._similar_keys(key):
+                weight = sim * self._idf(cand)
+                for pid in self._postings[cand]:
+                    scores[pid] += weight
+                matched |= self._postings[cand]
+            if matched: lists.append(matched)
+
+        rank = lambda pid: (-scores[pid], pid)
+        lists = [sorted(ids, key=rank) for ids in lists]
+        out, seen = [], set()
+        for i in range(max(map(len, lists), default=0)):
+            for pid in sorted((ids[i] for ids in lists if i < len(ids)), key=rank):
+                if pid in seen: continue
+                seen.add(pid)
+                out.append(pid)
+                if len(out) >= k: return out
+        return out
+
+_RETRIEVERS = {}
+_retrievers_lock = threading.Lock()
+
+def catalog_retriever(catalog):
+    """CatalogRetriever for a cache_merchant.Catalog; rebuilt whenever the catalog version changes."""
+    retriever = _RETRIEVERS.get(catalog.version)
+    if retriever is not None:
+        return retriever
+    retriever = CatalogRetriever(catalog.products)
+    with _retrievers_lock:
+        if len(_RETRIEVERS) >= _PRODUCT_INDEXES_MAX:
+            _RETRIEVERS.pop(next(iter(_RETRIEVERS)))
+        _RETRIEVERS[catalog.version] = retriever
+    return retriever
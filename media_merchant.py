@@ -0,0 +1,200 @@
+"""
+Media pre-processing before the LLM call.
+
+Voice notes and photos of handwritten orders arrive at full size; most of
+those bytes don't help the model. prepare() sniffs the real type from the
+content (Twilio's media_type and file names are not trusted), then:
+
+  image  EXIF-rotated, grayscale, longest side cut to MEDIA_IMAGE_MAX_SIDE,
+         re-encoded as JPEG (needs Pillow)
+  audio  leading/inner silence removed, downmixed to 16 kHz mono Opus
+         (needs an ffmpeg binary on PATH)
+
+Whatever is missing is skipped and the original bytes pass through with the
+sniffed mime type. The output is only used when it is smaller. Shrunk results
+are cached by the sha256 of the original bytes, locally (bounded by
+MEDIA_CACHE_MAX_BYTES) and in Redis, so a forwarded or re-sent photo is
+processed once; pass-through media is never cached.
+"""
+import os
+import time
+import shutil
+import hashlib
+import subprocess
+from collections import namedtuple
+
+from cache_merchant import TTLCache
+from redis_merchant import get_redis, mark_redis_down
+from metrics_merchant import inc, observe, stage, describe
+
+MEDIA_IMAGE_MAX_SIDE = int(os.getenv("MEDIA_IMAGE_MAX_SIDE", "1600"))
+MEDIA_JPEG_QUALITY = int(os.getenv("MEDIA_JPEG_QUALITY", "75"))
+MEDIA_AUDIO_BITRATE = os.getenv("MEDIA_AUDIO_BITRATE", "16k")
+MEDIA_FFMPEG = os.getenv("MEDIA_FFMPEG") or shutil.which("ffmpeg")
+MEDIA_FFMPEG_TIMEOUT = float(os.getenv("MEDIA_FFMPEG_TIMEOUT", "20"))
+
+# Used to turn bytes saved into upload time saved in the report
+MEDIA_UPLINK_BPS = float(os.getenv("MEDIA_UPLINK_BPS", str(2 * 1024 * 1024)))
+
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", "3600"))
+MEDIA_CACHE_MAX = int(os.getenv("MEDIA_CACHE_MAX", "64"))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+BYTES_BUCKETS = (10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 16_000_000)
+
+Media = namedtuple('Media', 'data mime')
+
+MEDIA_STATS = {"processed": 0, "passed_through": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0}
+
+_processed = TTLCache(MEDIA_CACHE_MAX, MEDIA_CACHE_TTL, maxbytes=MEDIA_CACHE_MAX_BYTES)
+
+# ==========================================
+# 1. SNIFFING
+# ==========================================
+
+def sniff(data):
+    """Mime type from the leading bytes, or None if unrecognized."""
+    if not data: return None
+    head = data[:16]
+    if head.startswith(b'\xff\xd8\xff'): return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'): return 'image/png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP': return 'image/webp'
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE': return 'audio/wav'
+    if head.startswith((b'GIF87a', b'GIF89a')): return 'image/gif'
+    if head.startswith(b'OggS'): return 'audio/ogg'
+    if head.startswith(b'#!AMR'): return 'audio/amr'
+    if head.startswith(b'fLaC'): return 'audio/flac'
+    if head.startswith(b'ID3') or head[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'): return 'audio/mpeg'
+    if head[:2] in (b'\xff\xf1', b'\xff\xf9'): return 'audio/aac'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'heic', b'heix', b'mif1', b'msf1'): return 'image/heic'
+        if brand == b'avif': return 'image/avif'
+        if brand in (b'M4A ', b'M4B '): return 'audio/mp4'
+        return 'video/mp4'
+    return None
+
+def kind_of(mime):
+    """'audio' | 'image' | None."""
+    if not mime: return None
+    major = mime.split('/')[0]
+    return major if major in ('audio', 'image') else None
+
+# ==========================================
+# 2. TRANSFORMS
+# ==========================================
+
+def shrink_image(data):
+    """Grayscale JPEG no larger than MEDIA_IMAGE_MAX_SIDE, or None without Pillow/on bad input."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    import io
+    try:
+        img = Image.open(io.BytesIO(data))
+        # JPEG can decode straight to a smaller grayscale image, much cheaper than full size
+        img.draft('L', (MEDIA_IMAGE_MAX_SIDE, MEDIA_IMAGE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img).convert('L')
+        img.thumbnail((MEDIA_IMAGE_MAX_SIDE, MEDIA_IMAGE_MAX_SIDE), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=MEDIA_JPEG_QUALITY, optimize=True)
+        return out.getvalue()
+    except Exception as e:
+        print(f"Image Prep Error: {e}")
+        return None
+
+def shrink_audio(data):
+    """Silence-trimmed 16 kHz mono Opus/Ogg, or None without ffmpeg/on failure."""
+    if not MEDIA_FFMPEG: return None
+    cmd = [
+        MEDIA_FFMPEG, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+        "-af", "silenceremove=start_periods=1:start_threshold=-40dB:"
+               "stop_periods=-1:stop_duration=0.6:stop_threshold=-40dB",
+        "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", MEDIA_AUDIO_BITRATE,
+        "-application", "voip", "-f", "ogg", "pipe:1",
+    ]
+    try:
+        res = subprocess.run(cmd, input=data, capture_output=True, timeout=MEDIA_FFMPEG_TIMEOUT)
+    except Exception as e:
+        print(f"Audio Prep Error: {e}")
+        return None
+    if res.returncode != 0 or not res.stdout:
+        print(f"Audio Prep Error: {res.stderr.decode(errors='replace')[:200]}")
+        return None
+    return res.stdout
+
+# ==========================================
+# 3. PIPELINE
+# ==========================================
+
+def _cache_key(digest):
+    return f"mina:media:{digest}"
+
+def _cached(digest):
+    data = _processed.get(digest)
+    if data is not None: return data
+    r = get_redis()
+    if r is not None:
+        try:
+            data = r.get(_cache_key(digest))
+            if data:
+                _processed.set(digest, data)
+                return data
+        except Exception as e:
+            mark_redis_down(e)
+    return None
+
+def _store(digest, data):
+    _processed.set(digest, data)
+    r = get_redis()
+    if r is not None:
+        try: r.set(_cache_key(digest), data, ex=MEDIA_CACHE_TTL)
+        except Exception as e: mark_redis_down(e)
+
+def prepare(data, fallback_mime=None):
+    """
+    Media(data, mime) ready for the model: smaller when it can be shrunk,
+    with the sniffed mime type (fallback_mime if the content isn't recognized).
+    """
+    if not data: return Media(data, fallback_mime)
+    mime = sniff(data) or fallback_mime
+    kind = kind_of(mime)
+    shrink = shrink_image if kind == 'image' else shrink_audio if kind == 'audio' else None
+    if shrink is None:
+        MEDIA_STATS["passed_through"] += 1
+        return Media(data, mime)
+
+    digest = hashlib.sha256(data).hexdigest()
+    t0 = time.perf_counter()
+    out = _cached(digest)
+    if out is not None:
+        MEDIA_STATS["cache_hits"] += 1
+    else:
+        with stage("media_prep"):
+            out = shrink(data)
+        # Unshrinkable (no Pillow/ffmpeg, or already small): send the original,
+        # and don't spend cache memory on a copy of it
+        if not out or len(out) >= len(data): out = data
+        else: _store(digest, out)
+    _report(kind, len(data), len(out), time.perf_counter() - t0)
+    return Media(out, sniff(out) or mime)
+
+def _report(kind, size_in, size_out, seconds):
+    MEDIA_STATS["processed"] += 1
+    MEDIA_STATS["bytes_in"] += size_in
+    MEDIA_STATS["bytes_out"] += size_out
+    saved = size_in - size_out
+    upload_saved = saved / MEDIA_UPLINK_BPS - seconds
+    observe("mina_media_bytes", size_in, buckets=BYTES_BUCKETS, kind=kind, stage="in")
+    observe("mina_media_bytes", size_out, buckets=BYTES_BUCKETS, kind=kind, stage="out")
+    # Counters only go up: processing that cost more than it saved counts as 0
+    inc("mina_media_saved_bytes_total", max(0, saved), kind=kind)
+    inc("mina_media_saved_seconds_total", max(0.0, upload_saved), kind=kind)
+    if saved:
+        print(f"🗜️ {kind} {size_in // 1024} KB -> {size_out // 1024} KB (-{saved / size_in:.0%}) "
+              f"in {seconds * 1000:.0f} ms, ~{upload_saved:.2f} s upload saved")
+
+describe("mina_media_bytes", "Media size before and after pre-processing.")
+describe("mina_media_saved_bytes_total", "Upload bytes saved by media pre-processing.")
+describe("mina_media_saved_seconds_total", "Estimated upload time saved (at MEDIA_UPLINK_BPS) net of processing time.")
@@ -0,0 +1,195 @@
+"""
+In-process metrics with a Prometheus text exporter.
+
+    with stage("llm"):
+        res = model.generate_content(contents)
+
+    inc("mina_intents_total", intent="CREATE_ORDER", source="fast_path")
+
+Histograms use fixed buckets and a lock per update, cheap enough to leave on
+in production. DB statements are counted per job through a contextvar (see
+job_scope()). The worker serves everything on METRICS_PORT at /metrics;
+other modules' counters (cache, fast path, coalescing) are added at scrape
+time through register_collector().
+"""
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))   # 0 = no exporter
+
+# Seconds; covers a ~1 ms cache hit up to a slow multi-part Gemini call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_lock = threading.Lock()
+_counters = {}     # (name, labels) -> value
+_histograms = {}   # (name, labels) -> [bucket counts..., sum, count]
+_buckets = {}      # name -> bucket bounds
+_help = {}
+_collectors = []   # callables returning [(name, labels dict, value)]
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def describe(name, text):
+    _help[name] = text
+
+# ==========================================
+# 1. COUNTERS & HISTOGRAMS
+# ==========================================
+
+def inc(name, value=1, **labels):
+    k = _key(name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0) + value
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    k = _key(name, labels)
+    with _lock:
+        h = _histograms.get(k)
+        if h is None:
+            _buckets.setdefault(name, buckets)
+            h = _histograms[k] = [0] * (len(_buckets[name]) + 2)
+        bounds = _buckets[name]
+        for i, le in enumerate(bounds):
+            if value <= le:
+                h[i] += 1
+                break
+        h[-2] += value
+        h[-1] += 1
+
+@contextmanager
+def stage(name):
+    """Times a stage of message handling into mina_stage_seconds; exceptions count as stage errors."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("mina_stage_errors_total", stage=name)
+        raise
+    finally:
+        observe("mina_stage_seconds", time.perf_counter() - t0, stage=name)
+
+def summary(name):
+    """{labels dict as sorted tuple: (count, sum)} for histogram `name`; used by benchmarks."""
+    with _lock:
+        return {labels: (h[-1], h[-2]) for (n, labels), h in _histograms.items() if n == name}
+
+def counter_values(name):
+    with _lock:
+        return {labels: v for (n, labels), v in _counters.items() if n == name}
+
+def register_collector(fn):
+    """fn() -> [(name, labels, value)], read at scrape time."""
+    _collectors.append(fn)
+
+# ==========================================
+# 2. PER-JOB SCOPE
+# ==========================================
+
+_job_queries = contextvars.ContextVar("job_queries", default=None)
+
+def count_query(n=1):
+    """Called by db_merchant for every statement it runs."""
+    counter = _job_queries.get()
+    if counter is not None:
+        counter[0] += n
+
+@contextmanager
+def job_scope(job):
+    """Times a job and records how many DB statements it ran."""
+    counter = [0]
+    token = _job_queries.set(counter)
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        _job_queries.reset(token)
+        observe("mina_job_seconds", time.perf_counter() - t0, job=job)
+        observe("mina_job_db_queries", counter[0], buckets=COUNT_BUCKETS, job=job)
+        inc("mina_jobs_total", job=job, status=status)
+
+# ==========================================
+# 3. EXPORT
+# ==========================================
+
+def _fmt_labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render():
+    """All metrics in Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    lines, typed = [], set()
+
+    def header(name, kind):
+        if name in typed: return
+        typed.add(name)
+        if name in _help: lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f"{name}{_fmt_labels(labels)} {value}")
+    for (name, labels), h in sorted(histograms.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for le, n in zip(_buckets[name], h):
+            cumulative += n
+            lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+        lines.append(f"{name}_sum{_fmt_labels(labels)} {h[-2]}")
+        lines.append(f"{name}_count{_fmt_labels(labels)} {h[-1]}")
+    for fn in _collectors:
+        try: samples = fn()
+        except Exception as e:
+            print(f"Metrics Collector Error: {e}")
+            continue
+        for name, labels, value in samples:
+            header(name, "gauge")
+            lines.append(f"{name}{_fmt_labels(sorted(labels.items()))} {value}")
+    return "\n".join(lines) + "\n"
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_exporter(port=None):
+    """Serves /metrics on a daemon thread. Returns the server, or None if disabled."""
+    port = METRICS_PORT if port is None else port
+    if not port: return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"📈 Metrics on :{port}/metrics")
+    return server
+
+describe("mina_stage_seconds", "Time spent in each stage of message handling.")
+describe("mina_stage_errors_total", "Stages that raised.")
+describe("mina_job_seconds", "Wall time per job.")
+describe("mina_job_db_queries", "DB statements executed per job.")
+describe("mina_jobs_total", "Jobs by outcome.")
+describe("mina_intents_total", "Handled messages by intent and where the intent came from.")
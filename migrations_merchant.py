@@ -0,0 +1,220 @@
+"""
+Versioned schema migrations for the merchant DB.
+
+Applied versions are recorded in schema_migrations, so once the schema is
+current a worker boot costs a single version check and no DDL. New schema
+changes are appended to MIGRATIONS; never edit one that has shipped.
+
+Run by hand with: python migrations_merchant.py
+"""
+import os
+
+from db_merchant import (
+    get_cursor,
+    execute_query,
+    fetchone_normalized,
+    fetchall_normalized,
+    IS_POSTGRES,
+    PK_TYPE,
+    TIMESTAMP_DEFAULT,
+    _rebuild_rollups
+)
+
+# Arbitrary key for pg_advisory_xact_lock so concurrent workers migrate one at a time
+MIGRATION_LOCK_KEY = 7419001
+
+# ==========================================
+# MIGRATIONS
+# ==========================================
+
+def _m001_base_schema(cur):
+    # Users
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS users (
+        id {PK_TYPE},
+        phone TEXT UNIQUE NOT NULL,
+        created_at TIMESTAMP {TIMESTAMP_DEFAULT},
+        subscription_tier VARCHAR(20) DEFAULT 'free',
+        credits_remaining FLOAT DEFAULT 30.0,
+        subscription_active BOOLEAN DEFAULT FALSE,
+        subscription_expiry TIMESTAMP,
+        razorpay_customer_id TEXT,
+        business_name TEXT, 
+        gstin TEXT,
+        preferred_language TEXT DEFAULT 'hi',
+        current_state VARCHAR(100),
+        state_metadata TEXT DEFAULT '{{}}'
+    );""")
+
+    # Merchant Tables
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS customers_merchant (
+        id {PK_TYPE},
+        merchant_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        phone TEXT,
+        gstin TEXT,
+        billing_address TEXT,
+        email TEXT,
+        current_balance FLOAT DEFAULT 0.0,
+        created_at TIMESTAMP {TIMESTAMP_DEFAULT},
+        UNIQUE(merchant_id, phone)
+    );""")
+
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS products_merchant (
+        id {PK_TYPE},
+        merchant_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        alias TEXT,
+        description TEXT,
+        unit VARCHAR(20) DEFAULT 'pcs',
+        price FLOAT DEFAULT 0.0,
+        stock_qty FLOAT DEFAULT 0.0,
+        hsn_code TEXT,
+        gst_rate FLOAT DEFAULT 0.0,
+        created_at TIMESTAMP {TIMESTAMP_DEFAULT}
+    );""")
+
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS orders_merchant (
+        id {PK_TYPE},
+        merchant_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        customer_id INTEGER REFERENCES customers_merchant(id),
+        invoice_number TEXT,
+        invoice_date TIMESTAMP {TIMESTAMP_DEFAULT},
+        due_date TIMESTAMP,
+        final_amount FLOAT DEFAULT 0.0,
+        status VARCHAR(20) DEFAULT 'draft',
+        payment_status VARCHAR(20) DEFAULT 'unpaid',
+        pdf_url TEXT,
+        notes TEXT,
+        created_at TIMESTAMP {TIMESTAMP_DEFAULT}
+    );""")
+
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS order_items_merchant (
+        id {PK_TYPE},
+        order_id INTEGER NOT NULL REFERENCES orders_merchant(id) ON DELETE CASCADE,
+        product_id INTEGER REFERENCES products_merchant(id),
+        product_name TEXT NOT NULL,
+        quantity FLOAT NOT NULL,
+        unit_price FLOAT NOT NULL,
+        gst_rate FLOAT DEFAULT 0.0,
+        total_price FLOAT NOT NULL
+    );""")
+    
+    # Legacy Tables (Simplified)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS meeting_notes (id {PK_TYPE}, phone TEXT, audio_file TEXT, transcript TEXT, summary TEXT, message_sid TEXT, created_at TIMESTAMP {TIMESTAMP_DEFAULT});")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS tasks (id {PK_TYPE}, user_id INTEGER, title TEXT, description TEXT, due_at TIMESTAMP, status VARCHAR(20), metadata TEXT, created_at TIMESTAMP {TIMESTAMP_DEFAULT});")
+
+    if IS_POSTGRES:
+        # Databases created before current_state existed
+        execute_query(cur, "ALTER TABLE users ADD COLUMN IF NOT EXISTS current_state VARCHAR(100);")
+
+def _m002_lookup_indexes(cur):
+    # Hot lookups: catalog by merchant, customer by name, items by order, orders by merchant
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_products_merchant_merchant ON products_merchant (merchant_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_customers_merchant_lower_name ON customers_merchant (merchant_id, lower(name));")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_order_items_merchant_order ON order_items_merchant (order_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_orders_merchant_merchant ON orders_merchant (merchant_id, created_at);")
+
+    if IS_POSTGRES:
+        # Trigram indexes serve ILIKE '%name%' lookups. pg_trgm needs privileges
+        # we may not have on managed Postgres, so a failure only skips them.
+        cur.execute("SAVEPOINT trgm;")
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            cur.execute("CREATE INDEX IF NOT EXISTS ix_customers_merchant_name_trgm ON customers_merchant USING gin (name gin_trgm_ops);")
+            cur.execute("CREATE INDEX IF NOT EXISTS ix_products_merchant_name_trgm ON products_merchant USING gin (name gin_trgm_ops);")
+            cur.execute("RELEASE SAVEPOINT trgm;")
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT trgm;")
+            print(f"⚠️ pg_trgm unavailable, skipping trigram indexes: {e}")
+
+# Where the old confirm flow wrote invoices (utils_pdf_merchant.STATIC_FOLDER,
+# not imported here: it pulls in ReportLab), relative to the worker's cwd
+LEGACY_INVOICE_PATH = os.path.join("static", "invoices", "invoice_{}.pdf")
+
+def _m003_draft_sweep_index(cur):
+    # Before confirm_order_merchant existed nothing left 'draft': a confirmed
+    # order was a draft with an invoice. Confirm those so the sweep never
+    # touches them and the rollup backfill (004) counts them. Drafts without
+    # an invoice stay drafts: live ones can still be confirmed and abandoned
+    # ones expire through sweep_expired_drafts.
+    cur.execute("UPDATE orders_merchant SET status = 'confirmed' WHERE status = 'draft' AND pdf_url IS NOT NULL;")
+    cur.execute("SELECT id FROM orders_merchant WHERE status = 'draft';")
+    invoiced = [row['id'] for row in fetchall_normalized(cur) if os.path.exists(LEGACY_INVOICE_PATH.format(row['id']))]
+    for order_id in invoiced:
+        execute_query(cur, "UPDATE orders_merchant SET status = 'confirmed' WHERE id = %s", (order_id,))
+    # sweep_expired_drafts: WHERE status = 'draft' AND created_at < cutoff
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_orders_merchant_status_created ON orders_merchant (status, created_at);")
+
+def _m004_sales_rollups(cur):
+    # Maintained on order confirm / payment change (db_merchant._apply_rollup)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS merchant_daily_sales (
+        merchant_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        day DATE NOT NULL,
+        orders_count INTEGER NOT NULL DEFAULT 0,
+        sales_amount FLOAT NOT NULL DEFAULT 0.0,
+        paid_amount FLOAT NOT NULL DEFAULT 0.0,
+        PRIMARY KEY (merchant_id, day)
+    );""")
+    # Backfill from existing orders; current_balance was never maintained before
+    _rebuild_rollups(cur)
+
+MIGRATIONS = [
+    (1, "base_schema", _m001_base_schema),
+    (2, "lookup_indexes", _m002_lookup_indexes),
+    (3, "draft_sweep_index", _m003_draft_sweep_index),
+    (4, "sales_rollups", _m004_sales_rollups),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# ==========================================
+# RUNNER
+# ==========================================
+
+def current_version():
+    """Highest applied version, or 0 on a database that has never been migrated."""
+    try:
+        with get_cursor() as cur:
+            execute_query(cur, "SELECT MAX(version) AS version FROM schema_migrations")
+            row = fetchone_normalized(cur)
+            return (row or {}).get('version') or 0
+    except Exception:
+        return 0
+
+def migrate():
+    """Applies pending migrations, each in its own transaction."""
+    version = current_version()
+    if version >= LATEST_VERSION:
+        return version
+
+    for mig_version, name, apply in MIGRATIONS:
+        if mig_version <= version: continue
+        with get_cursor() as cur:
+            # Lock first: concurrent CREATE TABLE IF NOT EXISTS can still
+            # fail with a duplicate pg_type error on a fresh database
+            if IS_POSTGRES:
+                execute_query(cur, "SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP {TIMESTAMP_DEFAULT}
+            );""")
+            # Another worker may have applied it while we waited for the lock
+            execute_query(cur, "SELECT 1 AS done FROM schema_migrations WHERE version = %s", (mig_version,))
+            if fetchone_normalized(cur): continue
+            apply(cur)
+            execute_query(cur, "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (mig_version, name))
+            print(f"🛠️ Applied migration {mig_version:03d}_{name}")
+
+    print(f"✅ DB Merchant Initialized ({'Postgres' if IS_POSTGRES else 'SQLite'}, schema v{LATEST_VERSION}).")
+    return LATEST_VERSION
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,246 @@
+"""
+Deterministic fast-path parser for structured text orders.
+
+Handles the regular messages merchants type all day, e.g.
+
+    Ramesh: 10 kg atta @ 42, 5 pcs soap @ 30
+    Suresh ko do packet chai 120 ka aur 1 bori chawal
+    aaj ki sale kitni hui?        Ramesh ka kitna baaki hai?
+
+without a Gemini call. Products are resolved against the merchant's catalog;
+anything it is not confident about returns None so the caller falls through
+to the LLM. The result has the same {intent, data, reply_text} shape as
+process_merchant_intent.
+"""
+import os
+import re
+import time
+
+from matching_merchant import product_index, tokenize
+
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv("FAST_PATH_MIN_CONFIDENCE", "0.8"))
+PRODUCT_MATCH_THRESHOLD = float(os.getenv("PRODUCT_MATCH_THRESHOLD", "0.85"))
+
+# Counters for the benchmark and metrics. saved_s is the LLM time avoided,
+# estimated from the running average of real Gemini calls.
+FAST_PATH_STATS = {"hits": 0, "misses": 0, "saved_s": 0.0}
+
+# ==========================================
+# 1. VOCABULARY
+# ==========================================
+
+QTY_WORDS = {
+    # Hindi (romanized)
+    'ek': 1, 'do': 2, 'teen': 3, 'char': 4, 'chaar': 4, 'paanch': 5, 'panch': 5, 'paach': 5,
+    'chhe': 6, 'che': 6, 'chha': 6, 'saat': 7, 'sat': 7, 'aath': 8, 'ath': 8, 'nau': 9, 'das': 10,
+    'gyarah': 11, 'barah': 12, 'pandrah': 15, 'bees': 20, 'pachees': 25, 'tees': 30, 'chalis': 40,
+    'pachas': 50, 'sau': 100,
+    'aadha': 0.5, 'adha': 0.5, 'dedh': 1.5, 'derh': 1.5, 'dhai': 2.5, 'dhaai': 2.5,
+    # English
+    'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8,
+    'nine': 9, 'ten': 10, 'eleven': 11, 'twelve': 12, 'fifteen': 15, 'twenty': 20, 'twentyfive': 25,
+    'thirty': 30, 'forty': 40, 'fifty': 50, 'hundred': 100, 'half': 0.5, 'dozen': 12,
+    # Devanagari
+    'एक': 1, 'दो': 2, 'तीन': 3, 'चार': 4, 'पांच': 5, 'पाँच': 5, 'छह': 6, 'सात': 7, 'आठ': 8,
+    'नौ': 9, 'दस': 10, 'बीस': 20, 'पचास': 50, 'सौ': 100, 'आधा': 0.5, 'डेढ़': 1.5, 'ढाई': 2.5,
+}
+
+# Spoken/typed unit -> canonical unit; catalog units are added per message
+UNIT_ALIASES = {
+    'kg': 'kg', 'kgs': 'kg', 'kilo': 'kg', 'kilos': 'kg', 'किलो': 'kg',
+    'g': 'g', 'gm': 'g', 'gms': 'g', 'gram': 'g', 'grams': 'g', 'ग्राम': 'g',
+    'l': 'ltr', 'lt': 'ltr', 'ltr': 'ltr', 'ltrs': 'ltr', 'litre': 'ltr', 'liter': 'ltr', 'litres': 'ltr', 'लीटर': 'ltr',
+    'ml': 'ml',
+    'pc': 'pcs', 'pcs': 'pcs', 'piece': 'pcs', 'pieces': 'pcs', 'nos': 'pcs', 'pis': 'pcs',
+    'dz': 'dozen', 'dozen': 'dozen', 'darjan': 'dozen',
+    'box': 'box', 'boxes': 'box', 'pkt': 'packet', 'pkts': 'packet', 'packet': 'packet', 'packets': 'packet',
+    'bag': 'bag', 'bags': 'bag', 'bori': 'bag', 'katta': 'bag', 'bottle': 'bottle', 'bottles': 'bottle',
+    'tin': 'tin', 'carton': 'carton', 'cartons': 'carton', 'peti': 'carton', 'strip': 'strip', 'strips': 'strip',
+}
+
+# Words that carry no product meaning inside an item
+FILLER = {'x', 'of', 'the', 'ka', 'ke', 'ki', 'wala', 'wali', 'wale', 'bhi', 'aur', 'and', 'per', 'each', 'rate', 'bhejo', 'dena', 'de', 'do', 'chahiye'}
+
+_NUM = r'\d+(?:\.\d+)?'
+# Price markers: "@ 42", "@42/kg", "rs 42", "₹42", "42 rs", "42 rupaye", "42 ka/ke/ki", "42/-"
+_PRICE_BEFORE = re.compile(rf'(?P<mark>@|\brs\.?|₹|\binr\b|\brate\b)\s*(?P<amount>{_NUM})(?P<per>\s*(?:/|per\s+)\s*[^\s,]+)?')
+_PRICE_AFTER = re.compile(rf'\b(?P<amount>{_NUM})\s*(?P<mark>/-|\brs\b\.?|\brupees?\b|\brupaye\b|\brupay\b|\bka\b|\bke\b|\bki\b)(?P<per>\s*(?:/|per\s+)\s*[^\s,]+)?')
+# Markers that make the amount a per-unit rate. "10 kg atta 420 rs" may just
+# as well be the line total, so a bare amount is only trusted for one unit.
+_PER_UNIT_MARKS = {'@', 'rate', 'ka', 'ke', 'ki'}
+_FRACTION = re.compile(r'^(\d+)/(\d+)$')
+
+_ITEM_SPLIT = re.compile(r'\s*(?:,|;|\n|\+|&|\band\b|\baur\b|\btatha\b)\s*')
+_DEV_DIGITS = str.maketrans('०१२३४५६७८९', '0123456789')
+
+# "Ramesh: ...", "For Ramesh - ...", "Ramesh ko ...", "Ramesh ke liye ..."
+_CUSTOMER_PATTERNS = [
+    re.compile(r'^\s*(?:order\s+)?(?:for|to)\s+(?P<cust>[^:\-\n,]{2,40}?)\s*[:\-–\n,]\s*(?P<rest>.+)$', re.S | re.I),
+    re.compile(r'^\s*(?:order\s+)?(?P<cust>[^:\-\n\d]{2,40}?)\s*[:\-–]\s*(?P<rest>.+)$', re.S | re.I),
+    re.compile(r'^\s*(?P<cust>[^\d,:\n]{2,40}?)\s+(?:ko|ke\s+liye|ka\s+order|को|के\s+लिए)\s+(?P<rest>.+)$', re.S | re.I),
+]
+
+# Reporting questions, answered from the sales rollups without the LLM:
+# "aaj ki sale kitni hui?", "Ramesh ka kitna baaki hai?"
+_SALES_WORDS = re.compile(r'\b(?:sale|sales|bikri|bikree|becha|bika|bikaa|kamai|revenue|turnover)\b|बिक्री|सेल', re.I)
+# A sales word alone isn't a question ("sale kal se band hai kya"): it must ask an amount
+_HOW_MUCH = re.compile(r'\b(?:kitna|kitni|kitne|kitana|how\s+much|how\s+many)\b|कितना|कितनी|कितने', re.I)
+# Most specific first: "pichle mahine" before "mahine"
+_PERIOD_WORDS = [
+    ('last_month', re.compile(r'\b(?:pichh?le|pichhla|pichla|last)\s+(?:mahine|mahina|month)\b|पिछले\s+महीने', re.I)),
+    ('this_month', re.compile(r'\b(?:mahine|mahina|month)\b|महीने', re.I)),
+    ('this_week', re.compile(r'\b(?:hafte|hafta|week)\b|हफ्ते', re.I)),
+    ('yesterday', re.compile(r'\b(?:kal|yesterday)\b|कल', re.I)),
+]
+# "aaj ka balance kitna hai" asks about the merchant, not a customer called "aaj"
+_NOT_CUSTOMERS = {
+    'aaj', 'kal', 'parso', 'abhi', 'today', 'yesterday', 'mera', 'meri', 'mere', 'hamara', 'hamari', 'apna', 'apni',
+    'my', 'our', 'total', 'kul', 'sab', 'sabka', 'sabhi', 'is', 'iss', 'us', 'uss', 'yeh', 'ye', 'wo', 'woh',
+    'आज', 'कल', 'मेरा', 'मेरी', 'मेरे', 'कुल', 'सब',
+}
+_BALANCE_PATTERNS = [
+    re.compile(r'^\s*(?P<cust>[^\d?]{2,40}?)\s+(?:ka|ki|ke|का|की|के)\s+(?:(?:kitna|kitne|kitni|कितना|कितने)\s+)?(?:(?:paisa|paise|पैसे)\s+)?'
+               r'(?:baaki|baki|baqi|bakaya|udhar|udhaar|due|dues|balance|outstanding|बाकी|बकाया|उधार)(?!\w)', re.I),
+    re.compile(r'^\s*how\s+much\s+(?:does|do|is)\s+(?P<cust>.{2,40}?)\s+(?:owe|owes|due)\b', re.I),
+    re.compile(r"^\s*(?:balance|dues|outstanding)\s+(?:of|for)\s+(?P<cust>[^\d?]{2,40}?)\s*\??\s*$", re.I),
+]
+
+# ==========================================
+# 2. PARSING
+# ==========================================
+
+def _to_number(tok):
+    tok = tok.translate(_DEV_DIGITS)
+    m = _FRACTION.match(tok)
+    if m and int(m.group(2)):
+        return int(m.group(1)) / int(m.group(2))
+    try:
+        return float(tok)
+    except ValueError:
+        return QTY_WORDS.get(tok)
+
+def _split_customer(text, index):
+    for pat in _CUSTOMER_PATTERNS:
+        m = pat.match(text)
+        if m:
+            cust = m.group('cust').strip()
+            # A "customer" made of numbers/units or naming a product is really the first item
+            if any(_to_number(t) is not None or t in UNIT_ALIASES for t in cust.lower().split()): continue
+            if not tokenize(cust) or index.best(cust, 0.95)[0] is not None: continue
+            return cust, m.group('rest')
+    return None, text
+
+def _parse_item(segment, units, index, catalog_by_id):
+    """{'product', 'qty', 'rate', 'unit'} plus a 0..1 confidence, or (None, 0)."""
+    rate, per_unit = None, True
+    m = _PRICE_BEFORE.search(segment) or _PRICE_AFTER.search(segment)
+    if m:
+        rate = float(m.group('amount'))
+        per_unit = bool(m.group('per')) or m.group('mark').rstrip('.') in _PER_UNIT_MARKS
+        segment = segment[:m.start()] + ' ' + segment[m.end():]
+
+    qty, unit, words = None, None, []
+    prev_qty = False
+    for i, tok in enumerate(segment.replace('*', ' x ').split()):
+        # "10kg" / "2pcs"
+        glued = re.match(rf'^({_NUM})([^\d.].*)$', tok)
+        if glued and glued.group(2) in units:
+            tok, unit_tok = glued.group(1), glued.group(2)
+        else:
+            unit_tok = None
+        num = _to_number(tok)
+        # "do" is "two" only when it leads the item ("do packet chai", not "chai do")
+        if num is not None and qty is None and (tok != 'do' or i == 0):
+            qty = num
+            if unit_tok: unit = units[unit_tok]
+            prev_qty = True
+            continue
+        # A unit either follows the quantity or leads the item ("parle g" keeps its "g")
+        if tok in units and unit is None and (prev_qty or not words):
+            unit = units[tok]
+            prev_qty = False
+            continue
+        prev_qty = False
+        if tok in FILLER or num is not None:
+            continue
+        words.append(tok)
+
+    # A bare product name ("atta") is not an order
+    if not words or qty is None: return None, 0.0
+    if unit == 'dozen':
+        qty, unit = qty * 12, 'pcs'
+    if not per_unit and qty != 1: return None, 0.0
+
+    product_id, score = index.best(' '.join(words), PRODUCT_MATCH_THRESHOLD)
+    if product_id is None: return None, 0.0
+    product = catalog_by_id[product_id]
+    if unit and product.unit and units.get(product.unit.lower(), product.unit.lower()) != unit:
+        # The catalog price is per its own unit: "1 bori chawal" at the per-kg
+        # price would be a wrong invoice. Without a typed rate, leave it to Gemini.
+        if rate is None: return None, 0.0
+        score *= 0.9
+    if rate is None:
+        if not product.price: return None, 0.0
+        rate = float(product.price)
+    return {'product': product.name, 'qty': qty, 'rate': rate, 'unit': unit or product.unit}, score
+
+def parse_order(text, catalog):
+    """
+    Parses a text order against a cache_merchant.Catalog. Returns the
+    process_merchant_intent result dict, or None if not confident.
+    """
+    if not text or not catalog.products: return None
+    text = text.strip().replace('₹', ' rs ').translate(_DEV_DIGITS)
+
+    index = product_index(catalog)
+    customer, rest = _split_customer(text, index)
+    segments = [s for s in _ITEM_SPLIT.split(rest.lower()) if s.strip()]
+    if not segments: return None
+
+    units = dict(UNIT_ALIASES)
+    for p in catalog.products:
+        if p.unit: units.setdefault(p.unit.lower(), p.unit.lower())
+    catalog_by_id = {p.id: p for p in catalog.products}
+
+    items, confidence = [], 1.0
+    for seg in segments:
+        item, score = _parse_item(seg, units, index, catalog_by_id)
+        if item is None: return None
+        items.append(item)
+        confidence = min(confidence, score)
+    if not customer:
+        confidence *= 0.9
+    if confidence < FAST_PATH_MIN_CONFIDENCE: return None
+
+    customer_name = customer or 'Guest'
+    return {
+        "intent": "CREATE_ORDER",
+        "data": {"customer_name": customer_name, "items": items},
+        "reply_text": "",
+        "confidence": round(confidence, 3),
+        "source": "fast_path",
+    }
+
+def parse_report(text):
+    """SALES_REPORT / BALANCE result for a reporting question, or None."""
+    if not text or re.search(r'\d', text): return None
+    for pat in _BALANCE_PATTERNS:
+        m = pat.match(text)
+        if m and tokenize(m.group('cust')) and not _NOT_CUSTOMERS & set(m.group('cust').lower().split()):
+            return {"intent": "BALANCE", "data": {"customer_name": m.group('cust').strip()},
+                    "reply_text": "", "source": "fast_path"}
+    if _SALES_WORDS.search(text) and _HOW_MUCH.search(text):
+        period = next((p for p, pat in _PERIOD_WORDS if pat.search(text)), 'today')
+        return {"intent": "SALES_REPORT", "data": {"period": period}, "reply_text": "", "source": "fast_path"}
+    return None
+
+def try_fast_path(text, catalog, llm_latency_s=0.0):
+    """parse_report / parse_order plus bookkeeping in FAST_PATH_STATS."""
+    t0 = time.perf_counter()
+    res = parse_report(text) or parse_order(text, catalog)
+    if res is None:
+        FAST_PATH_STATS["misses"] += 1
+    else:
+        FAST_PATH_STATS["hits"] += 1
+        FAST_PATH_STATS["saved_s"] += max(0.0, llm_latency_s - (time.perf_counter() - t0))
+    return res
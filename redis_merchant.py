@@ -0,0 +1,46 @@
+"""
+Shared Redis client for caches and conversation state: the same Redis RQ
+already uses. Everything built on it must degrade to in-process behaviour
+when get_redis() returns None.
+"""
+import os
+import time
+import threading
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+REDIS_TIMEOUT = float(os.getenv('REDIS_TIMEOUT', '0.5'))
+# After a failure, skip Redis for this long instead of paying a timeout per call
+REDIS_RETRY_AFTER = float(os.getenv('REDIS_RETRY_AFTER', '30'))
+
+_client = None
+_lock = threading.Lock()
+_down_until = 0.0
+
+def get_redis():
+    """Process-wide Redis client, or None when disabled (REDIS_URL='') or recently down."""
+    global _client
+    if not REDIS_URL or time.monotonic() < _down_until:
+        return None
+    if _client is None:
+        with _lock:
+            if _client is None:
+                try:
+                    import redis
+                    _client = redis.from_url(
+                        REDIS_URL,
+                        socket_timeout=REDIS_TIMEOUT,
+                        socket_connect_timeout=REDIS_TIMEOUT,
+                        health_check_interval=30,
+                    )
+                except Exception as e:
+                    print(f"⚠️ Redis unavailable: {e}")
+                    mark_redis_down()
+                    return None
+    return _client
+
+def mark_redis_down(err=None):
+    """Called by users of get_redis() when a command fails."""
+    global _down_until
+    if err is not None:
+        print(f"⚠️ Redis error, falling back to local: {err}")
+    _down_until = time.monotonic() + REDIS_RETRY_AFTER
@@ -0,0 +1,92 @@
+"""
+Redis-resident conversation state.
+
+Each sender's state lives in a Redis hash mina:state:<phone> with a TTL that
+depends on the state, so abandoned conversations expire on their own.
+Cleared states are stored as an empty state rather than deleted, which keeps
+"cleared" distinguishable from "unknown" for the SQL fallback in db_merchant.
+"""
+import os
+import json
+
+from redis_merchant import get_redis, mark_redis_down
+
+# Seconds a state survives without activity
+STATE_TTL_DEFAULT = int(os.getenv("STATE_TTL_DEFAULT", "21600"))
+STATE_TTLS = {
+    "CONFIRM_ORDER": int(os.getenv("STATE_TTL_CONFIRM_ORDER", "86400")),
+}
+
+def state_ttl(state):
+    return STATE_TTLS.get(state, STATE_TTL_DEFAULT)
+
+class StateUnavailable(Exception):
+    """Redis is disabled or down; callers fall back to SQL."""
+
+class RedisStateStore:
+    prefix = "mina:state:"
+    dirty_key = "mina:state:dirty"
+
+    def _client(self):
+        r = get_redis()
+        if r is None:
+            raise StateUnavailable()
+        return r
+
+    def get(self, phone):
+        """(state, metadata), or None if Redis has nothing for this phone."""
+        r = self._client()
+        try:
+            data = r.hgetall(self.prefix + phone)
+        except Exception as e:
+            mark_redis_down(e)
+            raise StateUnavailable() from e
+        if not data:
+            return None
+        state = data.get(b'state', b'').decode() or None
+        try: meta = json.loads(data.get(b'meta') or b'{}')
+        except: meta = {}
+        return state, meta
+
+    def set(self, phone, state, metadata=None, dirty=False):
+        """Stores the state with its TTL; dirty=True queues it for the SQL write-behind."""
+        r = self._client()
+        key = self.prefix + phone
+        try:
+            pipe = r.pipeline(transaction=True)
+            pipe.delete(key)
+            pipe.hset(key, mapping={'state': state or '', 'meta': json.dumps(metadata or {})})
+            pipe.expire(key, state_ttl(state))
+            if dirty:
+                pipe.sadd(self.dirty_key, phone)
+            pipe.execute()
+        except Exception as e:
+            mark_redis_down(e)
+            raise StateUnavailable() from e
+
+    def mark_dirty(self, phones):
+        """Re-queues phones whose SQL write failed."""
+        if not phones: return
+        try: self._client().sadd(self.dirty_key, *phones)
+        except Exception as e: mark_redis_down(e)
+
+    def pop_dirty(self, count=500):
+        """[(phone, state, metadata)] written since the last flush; expired ones come back cleared."""
+        r = self._client()
+        try:
+            phones = [p.decode() for p in (r.spop(self.dirty_key, count) or [])]
+            if not phones: return []
+            pipe = r.pipeline(transaction=False)
+            for phone in phones:
+                pipe.hgetall(self.prefix + phone)
+            rows = pipe.execute()
+        except Exception as e:
+            mark_redis_down(e)
+            raise StateUnavailable() from e
+        out = []
+        for phone, data in zip(phones, rows):
+            state = (data.get(b'state', b'').decode() or None) if data else None
+            try: meta = json.loads(data.get(b'meta') or b'{}') if data else {}
+            except: meta = {}
+            out.append((phone, state, meta))
+        return out
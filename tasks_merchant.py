@@ -1,18 +1,31 @@
 import os
 import json
-import requests
-import google.generativeai as genai
-from twilio.rest import Client
+import time
+import threading
+from datetime import timedelta
 
 # IMPORTS UPDATED TO _merchant
 from db_merchant import (
-    init_db, 
+    ensure_db,
     create_draft_order_merchant, 
-    get_products_merchant,
+    confirm_order_merchant,
+    set_order_pdf_url,
+    get_sales_merchant,
+    get_customer_balance_merchant,
+    get_catalog_merchant,
     set_user_state, 
-    get_user_state
+    get_user_state,
+    unit_of_work,
+    after_commit
 )
-from utils_pdf_merchant import generate_invoice_pdf
+from parser_merchant import try_fast_path
+from limits_merchant import limit
+import http_merchant
+from cache_merchant import intent_key, get_cached_intent, cache_intent, claim_message, release_message
+import coalesce_merchant
+import media_merchant
+from metrics_merchant import stage, inc, observe, job_scope, register_collector, describe
+from matching_merchant import catalog_retriever
 
 # Config
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -20,105 +33,467 @@ TWILIO_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_NUMBER = os.getenv("TWILIO_NUMBER")
 
-# Init
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-2.0-flash-exp")
-init_db()
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-exp")
+
+# Text prompts list only the PROMPT_TOP_K products most relevant to the
+# message; smaller catalogs (and audio/images, which have no text to match
+# on) get the whole list, up to PROMPT_MEDIA_MAX products (0 = no cap).
+PROMPT_TOP_K = int(os.getenv("PROMPT_TOP_K", "50"))
+PROMPT_MEDIA_MAX = int(os.getenv("PROMPT_MEDIA_MAX", "0"))
+PROMPT_BUCKETS = (0, 10, 25, 50, 100, 250, 1000, 5000)
+
+# ==========================================
+# LAZY INIT
+# ==========================================
+# Importing this module does no network, DDL or filesystem work: RQ may import
+# it in every forked job. Each dependency is set up on first use, once per
+# process, and worker_merchant.py calls warm_up() before taking jobs.
+
+_model = None
+_init_lock = threading.Lock()
+
+# step -> seconds spent by warm_up(), for the startup report
+STARTUP_TIMINGS = {}
+
+def get_model():
+    global _model
+    if _model is None:
+        with _init_lock:
+            if _model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                _model = genai.GenerativeModel(GEMINI_MODEL)
+    return _model
+
+def _warm_pdf():
+    import utils_pdf_merchant
+    utils_pdf_merchant.warm_up()
+
+def warm_up(llm=True, pdf=True):
+    """Initializes the DB schema, Gemini model and PDF renderer now instead of in the first job."""
+    steps = [("db", ensure_db), ("http", http_merchant.get_session)]
+    if llm: steps.append(("gemini", get_model))
+    if pdf: steps.append(("pdf", _warm_pdf))
+    timings = {}
+    for name, fn in steps:
+        t0 = time.perf_counter()
+        fn()
+        timings[name] = time.perf_counter() - t0
+    STARTUP_TIMINGS.update(timings)
+    return timings
 
 def get_twilio_client():
-    return Client(TWILIO_SID, TWILIO_AUTH)
+    return http_merchant.get_twilio_client(TWILIO_SID, TWILIO_AUTH)
+
+def send_whatsapp(to, body, media_url=None, wait=False):
+    """Hands the message to the background sender so the job doesn't wait on Twilio; wait=True sends now."""
+    if wait:
+        _send_whatsapp_now(to, body, media_url)
+    else:
+        http_merchant.send_async(to, _send_whatsapp_now, to, body, media_url)
 
-def send_whatsapp(to, body, media_url=None):
+def _send_whatsapp_now(to, body, media_url=None):
     client = get_twilio_client()
     msg = {"from_": TWILIO_NUMBER, "to": to, "body": body}
     if media_url: msg['media_url'] = [media_url]
-    try: client.messages.create(**msg)
+    try:
+        with limit('twilio'), stage("send"):
+            client.messages.create(**msg)
     except Exception as e: print(f"Twilio Error: {e}")
 
 def download_media(url):
     if not url: return None
     try:
-        res = requests.get(url, auth=(TWILIO_SID, TWILIO_AUTH))
-        return res.content if res.status_code == 200 else None
-    except: return None
+        with limit('media'), stage("media"):
+            return http_merchant.download(url, auth=(TWILIO_SID, TWILIO_AUTH))
+    except Exception as e:
+        print(f"Media Error: {e}")
+        return None
+
+def fetch_media(url, fallback_mime):
+    """Downloads and pre-processes media for the model: media_merchant.Media, or None."""
+    blob = download_media(url)
+    if not blob: return None
+    return media_merchant.prepare(blob, fallback_mime)
+
+def prompt_products(catalog, text=None, media=False):
+    """Product names for the prompt and how they were chosen: 'all', 'top_k' or 'full'."""
+    products = catalog.products
+    if len(products) <= PROMPT_TOP_K:
+        return [p.name for p in products], "all"
+    if media:
+        # The model hears/sees the products itself: it needs the catalog to map them
+        if PROMPT_MEDIA_MAX: products = products[:PROMPT_MEDIA_MAX]
+        return [p.name for p in products], "full"
+    with stage("retrieval"):
+        ids = catalog_retriever(catalog).top_k(text, PROMPT_TOP_K)
+    by_id = {p.id: p for p in products}
+    return [by_id[i].name for i in ids], "top_k"
 
-def process_merchant_intent(user_phone, text=None, audio=None, image=None):
-    products = get_products_merchant(user_phone)
-    p_names = [p['name'] for p in products] if products else []
+# Running average of Gemini latency, used to estimate time saved by the fast path
+_llm_latency_avg = 1.5
+
+def process_merchant_intent(user_phone, text=None, audio=None, image=None, parts=None, media_missing=False):
+    """
+    Returns {intent, data, reply_text, cache_key}. cache_key identifies the
+    content (merchant + text/media + catalog version) for dedupe.
+    audio and image are media_merchant.Media. parts is a list of
+    ('text' | 'audio' | 'image', str or Media) for several coalesced
+    messages sent to the model as one request.
+    media_missing: some media could not be downloaded, so the content is
+    unknown; the intent cache is skipped and cache_key is None.
+    """
+    global _llm_latency_avg
+    with stage("catalog"):
+        catalog = get_catalog_merchant(user_phone)
+    if parts:
+        text = "\n".join(v for kind, v in parts if kind == 'text') or None
+        if any(kind != 'text' for kind, _ in parts):
+            key = intent_key(user_phone, catalog.version,
+                             parts=[(kind, v if kind == 'text' else v.data) for kind, v in parts])
+        else:
+            # Every download failed: the request is just its text
+            key = intent_key(user_phone, catalog.version, text=text)
+    else:
+        single = audio or image
+        key = intent_key(user_phone, catalog.version, text=text, media=single.data if single else None)
+    # Two voice notes that both failed to download would share a key
+    if media_missing: key = None
+
+    # Regular typed orders are parsed locally; only low-confidence ones reach Gemini
+    if text and not audio and not image and not parts:
+        fast = try_fast_path(text, catalog, llm_latency_s=_llm_latency_avg)
+        if fast: return dict(fast, cache_key=key)
+
+    cached = get_cached_intent(key) if key else None
+    if cached: return dict(cached, cache_key=key, source="cache")
+
+    media = bool(audio or image or (parts and any(kind != 'text' for kind, _ in parts)))
+    p_names, mode = prompt_products(catalog, text, media)
+    observe("mina_prompt_products", len(p_names), buckets=PROMPT_BUCKETS, mode=mode)
     
     prompt = f"""
     You are MinA, Merchant Assistant.
-    Known Products: {', '.join(p_names)}
+    Known Products: {', '.join(p_names) or '(none matched)'}
     Classify:
     1. CREATE_ORDER: Extract "customer_name", "items": [{{"product", "qty", "rate"}}]
     2. REMINDER: Extract "details", "time"
-    3. CHAT: General.
+    3. INVOICE_BATCH: All invoices for a period, or one customer's statement. Extract "period" (today | yesterday | this_week | this_month | last_month), "customer_name" (only for a statement)
+    4. SALES_REPORT: How much was sold in a period. Extract "period" (same values as INVOICE_BATCH)
+    5. BALANCE: How much a customer owes. Extract "customer_name"
+    6. CHAT: General.
     Output JSON: {{ "intent": "...", "data": {{...}}, "reply_text": "..." }}
     """
     
     contents = [prompt]
-    if audio: contents.append({"mime_type": "audio/ogg", "data": audio})
-    elif image: contents.append({"mime_type": "image/jpeg", "data": image})
+    if parts:
+        contents.append("The user sent the following as several messages in a row; treat them as one request.")
+        for kind, value in parts:
+            if kind == 'text': contents.append(f"User Message: {value}")
+            else: contents.append({"mime_type": value.mime, "data": value.data})
+    elif audio: contents.append({"mime_type": audio.mime, "data": audio.data})
+    elif image: contents.append({"mime_type": image.mime, "data": image.data})
     elif text: contents.append(f"User Message: {text}")
     
     try:
-        res = model.generate_content(contents)
+        with limit('gemini'), stage("llm"):
+            t0 = time.perf_counter()
+            res = get_model().generate_content(contents)
+        _llm_latency_avg = 0.9 * _llm_latency_avg + 0.1 * (time.perf_counter() - t0)
         txt = res.text.strip()
         if "```json" in txt: txt = txt.split("```json")[1].split("```")[0]
         elif "```" in txt: txt = txt.split("```")[1].split("```")[0]
-        return json.loads(txt)
+        result = json.loads(txt)
     except Exception as e:
         print(f"AI Error: {e}")
-        return {"intent": "CHAT", "reply_text": "Error processing request."}
+        return {"intent": "CHAT", "reply_text": "Error processing request.", "cache_key": key, "source": "error"}
+    if key: cache_intent(key, result)
+    return dict(result, cache_key=key, source="llm")
+
+def reply(to, body, media_url=None):
+    """Queues a WhatsApp reply that goes out once the message's DB work has committed."""
+    after_commit(send_whatsapp, to, body, media_url=media_url)
+
+# --- INVOICES ---
+# Rendered on their own queue by a pool of worker processes (worker_merchant.py
+# --invoices) so ReportLab never holds up merchant_jobs.
+INVOICE_QUEUE = 'invoice_jobs'
+
+def get_queue(name=None):
+    """RQ queue on the current job's connection (or the shared Redis); None without Redis.
+    name defaults to the queue the current job came from."""
+    from rq import Queue, get_current_job
+    job = get_current_job()
+    conn = job.connection if job else None
+    if conn is None:
+        from redis_merchant import get_redis
+        conn = get_redis()
+    if conn is None: return None
+    return Queue(name or (job.origin if job else 'merchant_jobs'), connection=conn)
+
+def enqueue_invoice(order_id, sender, base_url):
+    """Queues the invoice render; renders inline if the queue can't be reached."""
+    try:
+        q = get_queue(INVOICE_QUEUE)
+        if q is not None:
+            q.enqueue(render_invoice_job, order_id, sender, base_url)
+            return
+    except Exception as e:
+        print(f"⚠️ Invoice queue unavailable, rendering inline: {e}")
+    render_invoice_job(order_id, sender, base_url)
+
+# Bulk exports run on batch_jobs (worker_merchant.py --batches), away from
+# both interactive messages and single-invoice renders
+BATCH_QUEUE = 'batch_jobs'
+
+def enqueue_batch(sender, period, customer_name, base_url):
+    from batch_merchant import batch_invoices_job, BATCH_JOB_TIMEOUT
+    try:
+        q = get_queue(BATCH_QUEUE)
+        if q is not None:
+            q.enqueue(batch_invoices_job, sender, period, customer_name, base_url=base_url, job_timeout=BATCH_JOB_TIMEOUT)
+            return
+    except Exception as e:
+        print(f"⚠️ Batch queue unavailable, running inline: {e}")
+    batch_invoices_job(sender, period, customer_name, base_url=base_url)
+
+def render_invoice_job(order_id, sender, base_url):
+    """invoice_jobs entry point: renders (or reuses) the PDF, records its URL and sends it."""
+    ensure_db()
+    with job_scope("render_invoice"):
+        try:
+            from utils_pdf_merchant import generate_invoice_pdf
+            with stage("pdf"):
+                pdf_url = generate_invoice_pdf(order_id, base_url=base_url)
+        except Exception as e:
+            print(f"PDF Error: {e}")
+            pdf_url = None
+        if pdf_url:
+            set_order_pdf_url(order_id, pdf_url)
+            send_whatsapp(sender, f"✅ Invoice INV-{order_id} Generated!", media_url=pdf_url, wait=True)
+        else:
+            send_whatsapp(sender, "✅ Order Saved (PDF Failed).", wait=True)
 
 # --- ENTRY POINT ---
 def process_message(data):
     """
     Called by RQ Worker. 
+    The whole message runs as one unit of work: a single DB connection and
+    transaction, committed once before any reply is sent.
     """
+    ensure_db()
+    # Redelivered webhooks/jobs for a message we've already handled are no-ops
+    message_id = message_id_of(data)
+    if not claim_message(message_id):
+        print(f"⏭️ Duplicate message {message_id}, skipping")
+        return
+    try:
+        with job_scope("process_message"):
+            if _coalesce(data): return
+            # Media and Gemini run before the transaction opens, so a slow
+            # download or model call never holds a pooled connection
+            ai_res = _resolve_intent(data)
+            with unit_of_work():
+                _process_message(data, ai_res)
+            # A "1" answers the draft the merchant was shown; anything they
+            # sent before it is handled afterwards as a new request
+            if coalesce_merchant.enabled() and coalesce_merchant.is_immediate(data):
+                _run_coalesced(data['from'])
+    except Exception:
+        release_message(message_id)
+        raise
+
+# --- COALESCING ---
+# See coalesce_merchant: parts are buffered in Redis and flush_coalesced
+# (scheduled with enqueue_in, so workers need the rq scheduler) handles them
+# as one message once the sender goes quiet.
+
+def _coalesce(data):
+    """True if the message was buffered for its sender's coalescing window."""
+    if not coalesce_merchant.enabled(): return False
+    # Replies to a prompt are never held back (process_message flushes the buffer after them)
+    if coalesce_merchant.is_immediate(data): return False
+    sender = data['from']
+    opened = coalesce_merchant.buffer_part(sender, data)
+    if opened is None: return False
+    if opened: _schedule_flush(sender, coalesce_merchant.COALESCE_WINDOW)
+    return True
+
+def _schedule_flush(sender, delay):
+    try:
+        q = get_queue()
+        if q is not None:
+            q.enqueue_in(timedelta(seconds=delay), flush_coalesced, {'from': sender})
+            return
+    except Exception as e:
+        print(f"⚠️ Could not schedule coalesced flush, flushing now: {e}")
+    _run_coalesced(sender)
+
+def flush_coalesced(data):
+    """merchant_jobs entry point for a coalescing window that may have closed."""
+    ensure_db()
+    sender = data['from']
+    delay = coalesce_merchant.flush_due_in(sender)
+    # The sender is still typing: check again when the window would close
+    if delay > 0.05:
+        _schedule_flush(sender, delay)
+        return
+    with job_scope("flush_coalesced"):
+        _run_coalesced(sender)
+
+def _run_coalesced(sender):
+    batch, parts = coalesce_merchant.take_parts(sender)
+    if not parts: return
+    try:
+        data = coalesce_merchant.merge_parts(sender, parts)
+        ai_res = _resolve_intent(data)
+        with unit_of_work():
+            # Kept until the work commits, so a failure doesn't lose the messages
+            after_commit(coalesce_merchant.done_parts, sender, batch)
+            _process_message(data, ai_res)
+    except Exception:
+        coalesce_merchant.release_parts(sender, batch)
+        raise
+
+def message_id_of(data):
+    """Twilio MessageSid from the webhook payload, else the RQ job id."""
+    message_id = data.get('message_sid') or data.get('MessageSid')
+    if not message_id:
+        try:
+            from rq import get_current_job
+            job = get_current_job()
+            message_id = job.id if job else None
+        except Exception:
+            message_id = None
+    return message_id
+
+KNOWN_INTENTS = {"CREATE_ORDER", "REMINDER", "INVOICE_BATCH", "SALES_REPORT", "BALANCE", "CHAT"}
+
+def _app_metrics():
+    """Counters kept by other modules, exported at scrape time."""
+    from cache_merchant import cache_stats
+    from parser_merchant import FAST_PATH_STATS
+    samples = [("mina_cache", {"stat": k}, v) for k, v in cache_stats().items()]
+    samples += [("mina_fast_path", {"stat": k}, v) for k, v in FAST_PATH_STATS.items()]
+    samples += [("mina_coalesce", {"stat": k}, v) for k, v in coalesce_merchant.COALESCE_STATS.items()]
+    samples += [("mina_media", {"stat": k}, v) for k, v in media_merchant.MEDIA_STATS.items()]
+    return samples
+
+register_collector(_app_metrics)
+describe("mina_prompt_products", "Products listed in each Gemini prompt, by how they were chosen.")
+
+# Used when the content isn't recognized: what WhatsApp normally sends
+DEFAULT_MIME = {'audio': 'audio/ogg', 'image': 'image/jpeg'}
+
+def _download_parts(parts):
+    """Coalesced parts -> ([(kind, text or Media)], missing); media that fails to download is dropped."""
+    out, missing = [], False
+    for p in parts:
+        if p.get('text'): out.append(('text', p['text']))
+        if p.get('media_url'):
+            kind = media_merchant.kind_of(p.get('media_type'))
+            media = fetch_media(p['media_url'], DEFAULT_MIME[kind]) if kind else None
+            # The content decides, not the declared type
+            if media: out.append((media_merchant.kind_of(media.mime) or kind, media))
+            elif kind: missing = True
+    return out, missing
+
+def _is_confirm(state, data):
+    return state == "CONFIRM_ORDER" and data['body'].lower() in ['1', 'yes', 'ha']
+
+def _resolve_intent(data):
+    """Downloads the message's media and asks the parser/cache/Gemini for its
+    intent, outside any unit of work. None for a reply to a pending draft."""
+    sender = data['from']
+    with stage("state"):
+        state, _ = get_user_state(sender)
+    if _is_confirm(state, data): return None
+    if data.get('parts'):
+        parts, missing = _download_parts(data['parts'])
+        return process_merchant_intent(sender, parts=parts, media_missing=missing)
+    if data['num_media'] > 0 and media_merchant.kind_of(data.get('media_type')):
+        kind = media_merchant.kind_of(data['media_type'])
+        media = fetch_media(data['media_url'], DEFAULT_MIME[kind])
+        if media: kind = media_merchant.kind_of(media.mime) or kind
+        return process_merchant_intent(sender, media_missing=media is None, **{kind: media})
+    return process_merchant_intent(sender, text=data['body'])
+
+def _process_message(data, ai_res=None):
+    """The message's DB work; ai_res comes from _resolve_intent()."""
     sender = data['from']
-    msg_body = data['body']
     
-    state, metadata = get_user_state(sender)
+    with stage("state"):
+        state, metadata = get_user_state(sender)
     
     # --- CONFIRM FLOW ---
-    if state == "CONFIRM_ORDER" and msg_body.lower() in ['1', 'yes', 'ha']:
+    if _is_confirm(state, data):
         order_id = metadata.get('order_id')
+        with stage("order_write"):
+            confirmed = bool(order_id) and confirm_order_merchant(order_id)
+        inc("mina_intents_total", intent="CONFIRM_ORDER", source="reply")
+        if not confirmed:
+            reply(sender, "⚠️ This draft has expired. Please send the order again.")
+            set_user_state(sender, None)
+            return
         base_url = os.getenv("PUBLIC_URL", "https://your-worker-url.onrender.com")
-        
-        pdf_url = generate_invoice_pdf(order_id, base_url=base_url)
-        
-        if pdf_url:
-            send_whatsapp(sender, f"✅ Invoice INV-{order_id} Generated!", media_url=pdf_url)
-        else:
-            send_whatsapp(sender, "✅ Order Saved (PDF Failed).")
-            
+
+        # Rendering is CPU-bound: hand it to invoice_jobs, which sends the PDF when done
+        after_commit(enqueue_invoice, order_id, sender, base_url)
         set_user_state(sender, None)
         return
 
     # --- INTENT FLOW ---
-    if data['num_media'] > 0 and 'audio' in data.get('media_type', ''):
-        audio_bytes = download_media(data['media_url'])
-        ai_res = process_merchant_intent(sender, audio=audio_bytes)
-    elif data['num_media'] > 0 and 'image' in data.get('media_type', ''):
-        img_bytes = download_media(data['media_url'])
-        ai_res = process_merchant_intent(sender, image=img_bytes)
-    else:
-        ai_res = process_merchant_intent(sender, text=msg_body)
+    # The draft was confirmed or dropped in between: resolve it now after all
+    if ai_res is None:
+        ai_res = _resolve_intent(data)
         
     intent = ai_res.get('intent')
-    reply = ai_res.get('reply_text')
+    reply_text = ai_res.get('reply_text')
     res_data = ai_res.get('data', {})
+    # The intent comes from the model: keep the label set bounded
+    inc("mina_intents_total", intent=intent if intent in KNOWN_INTENTS else "OTHER", source=ai_res.get('source', 'unknown'))
 
     if intent == "CREATE_ORDER":
         items = res_data.get('items', [])
         if items:
-            oid = create_draft_order_merchant(sender, res_data.get('customer_name', 'Guest'), items)
             lines = [f"- {i['product']} x {i['qty']}" for i in items]
             msg = f"🛒 Draft for {res_data.get('customer_name')}:\n" + "\n".join(lines) + "\n\nReply *1* to Confirm"
-            set_user_state(sender, "CONFIRM_ORDER", {"order_id": oid})
-            send_whatsapp(sender, msg)
+            # The same order resent while its draft is pending reuses that draft
+            if state == "CONFIRM_ORDER" and ai_res.get('cache_key') and metadata.get('intent_key') == ai_res['cache_key']:
+                reply(sender, msg)
+                return
+            with stage("order_write"):
+                oid = create_draft_order_merchant(sender, res_data.get('customer_name', 'Guest'), items)
+            set_user_state(sender, "CONFIRM_ORDER", {"order_id": oid, "intent_key": ai_res.get('cache_key')})
+            reply(sender, msg)
+        else:
+            reply(sender, "⚠️ Could not understand items.")
+    elif intent == "INVOICE_BATCH":
+        from batch_merchant import PERIODS
+        period = res_data.get('period') if res_data.get('period') in PERIODS else 'today'
+        base_url = os.getenv("PUBLIC_URL", "https://your-worker-url.onrender.com")
+        after_commit(enqueue_batch, sender, period, res_data.get('customer_name'), base_url)
+        reply(sender, reply_text or "📦 Preparing your invoices, I'll send them shortly.")
+    elif intent == "SALES_REPORT":
+        from batch_merchant import PERIODS, period_days
+        period = res_data.get('period') if res_data.get('period') in PERIODS else 'today'
+        with stage("report"):
+            sales = get_sales_merchant(sender, *period_days(period))
+        label = period.replace('_', ' ')
+        if not sales['orders']:
+            reply(sender, f"📊 No confirmed orders {label} yet.")
+        else:
+            reply(sender, f"📊 Sales {label}: ₹{sales['sales']:,.0f} from {sales['orders']} orders\n"
+                          f"✅ Paid ₹{sales['paid']:,.0f} | ⏳ Due ₹{sales['due']:,.0f}")
+    elif intent == "BALANCE":
+        name = res_data.get('customer_name') or ''
+        with stage("report"):
+            customer, _ = get_customer_balance_merchant(sender, name) if name else (None, 0.0)
+        if not customer:
+            reply(sender, f"⚠️ No customer matching '{name}'.")
+        elif customer['balance'] > 0.005:
+            reply(sender, f"💰 {customer['name']} owes ₹{customer['balance']:,.2f}")
         else:
-            send_whatsapp(sender, "⚠️ Could not understand items.")
+            reply(sender, f"✅ {customer['name']} has nothing outstanding.")
     else:
-        send_whatsapp(sender, reply)
\ No newline at end of file
+        reply(sender, reply_text)
\ No newline at end of file
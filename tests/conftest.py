@@ -0,0 +1,47 @@
+"""
+Shared fixtures. The DB tests run on a throwaway SQLite file and fakeredis;
+DATABASE_URL has to be set before db_merchant is first imported.
+
+    PYTHONPATH=... python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_TMP = tempfile.mkdtemp(prefix="mina-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_TMP, 'test.db')}")
+os.environ.setdefault("STATE_BACKEND", "sql")
+
+@pytest.fixture
+def redis():
+    """Fresh fakeredis behind redis_merchant.get_redis()."""
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis_merchant
+    client = fakeredis.FakeRedis()
+    client.flushall()
+    old = redis_merchant._client
+    redis_merchant._client = client
+    redis_merchant._down_until = 0.0
+    yield client
+    redis_merchant._client = old
+
+@pytest.fixture
+def db(redis):
+    """db_merchant with its schema migrated (skips when the app's utils module is missing)."""
+    pytest.importorskip("utils")
+    import db_merchant
+    db_merchant.ensure_db()
+    return db_merchant
+
+_phones = iter(range(10**6))
+
+@pytest.fixture
+def merchant(db):
+    """A fresh merchant phone per test, so tests don't see each other's rows."""
+    phone = f"+9190000{next(_phones):05d}"
+    db.get_or_create_user(phone)
+    return phone
@@ -0,0 +1,64 @@
+"""
+Intent cache keys and message idempotency on fakeredis.
+"""
+import uuid
+
+import pytest
+
+import cache_merchant as cm
+
+@pytest.fixture(autouse=True)
+def fresh(redis, monkeypatch):
+    # A new worker process: nothing cached locally, only what Redis holds
+    monkeypatch.setattr(cm, "_seen_messages", cm.TTLCache(100, 60))
+    monkeypatch.setattr(cm, "_intents", cm.TTLCache(100, 60))
+
+def _sid():
+    return f"SM{uuid.uuid4().hex}"
+
+def test_message_claimed_once():
+    sid = _sid()
+    assert cm.claim_message(sid) is True
+    assert cm.claim_message(sid) is False
+
+def test_claim_is_shared_between_workers(monkeypatch):
+    sid = _sid()
+    assert cm.claim_message(sid)
+    monkeypatch.setattr(cm, "_seen_messages", cm.TTLCache(100, 60))
+    assert cm.claim_message(sid) is False
+
+def test_released_message_can_be_claimed_again():
+    sid = _sid()
+    cm.claim_message(sid)
+    cm.release_message(sid)
+    assert cm.claim_message(sid) is True
+
+def test_claim_without_redis_is_per_process(monkeypatch):
+    monkeypatch.setattr(cm, "get_redis", lambda: None)
+    sid = _sid()
+    assert cm.claim_message(sid) is True
+    assert cm.claim_message(sid) is False
+
+def test_message_without_id_is_always_processed():
+    assert cm.claim_message(None) and cm.claim_message(None)
+
+def test_intent_key_normalizes_text():
+    assert cm.intent_key("+91", 1, text="10 kg  Atta ") == cm.intent_key("+91", 1, text="10 kg atta")
+    assert cm.intent_key("+91", 1, text="10 kg atta") != cm.intent_key("+91", 2, text="10 kg atta")
+    assert cm.intent_key("+91", 1, text="10 kg atta") != cm.intent_key("+92", 1, text="10 kg atta")
+
+def test_intent_key_parts_keep_boundaries():
+    a = cm.intent_key("+91", 1, parts=[('text', "ab"), ('text', "c")])
+    b = cm.intent_key("+91", 1, parts=[('text', "a"), ('text', "bc")])
+    assert a != b
+
+def test_intent_key_media():
+    assert cm.intent_key("+91", 1, media=b"voice-1") != cm.intent_key("+91", 1, media=b"voice-2")
+    assert cm.intent_key("+91", 1, media=b"") != cm.intent_key("+91", 1, text="")
+
+def test_cached_intent_shared_through_redis(monkeypatch):
+    key = cm.intent_key("+91", 1, text=uuid.uuid4().hex)
+    assert cm.get_cached_intent(key) is None
+    cm.cache_intent(key, {"intent": "CHAT"})
+    monkeypatch.setattr(cm, "_intents", cm.TTLCache(100, 60))
+    assert cm.get_cached_intent(key) == {"intent": "CHAT"}
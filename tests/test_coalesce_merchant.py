@@ -0,0 +1,70 @@
+"""
+Coalescing buffer on fakeredis: takes never hand the same part to two
+flushes, and parts of a failed flush are not lost.
+"""
+import pytest
+
+import coalesce_merchant as co
+
+@pytest.fixture(autouse=True)
+def window(redis, monkeypatch):
+    monkeypatch.setattr(co, "COALESCE_WINDOW", 2.0)
+
+SENDER = "whatsapp:+919800000001"
+
+def _send(*texts):
+    for t in texts:
+        co.buffer_part(SENDER, {'body': t, 'num_media': 0})
+
+def _texts(parts):
+    return [p['text'] for p in parts]
+
+def test_first_part_opens_the_window():
+    assert co.buffer_part(SENDER, {'body': "Ramesh ka order", 'num_media': 0}) is True
+    assert co.buffer_part(SENDER, {'body': "10 kg atta", 'num_media': 0}) is False
+
+def test_take_returns_parts_in_order():
+    _send("Ramesh ka order", "10 kg atta", "5 kg cheeni")
+    batch, parts = co.take_parts(SENDER)
+    assert batch is not None
+    assert _texts(parts) == ["Ramesh ka order", "10 kg atta", "5 kg cheeni"]
+    assert co.take_parts(SENDER) == (None, [])
+
+def test_concurrent_take_gets_only_new_parts():
+    _send("a", "b")
+    first, parts = co.take_parts(SENDER)
+    _send("c")
+    second, more = co.take_parts(SENDER)
+    assert _texts(parts) == ["a", "b"]
+    assert _texts(more) == ["c"]
+    assert first != second
+
+def test_done_parts_are_not_taken_again():
+    _send("a")
+    batch, _ = co.take_parts(SENDER)
+    co.done_parts(SENDER, batch)
+    _send("b")
+    assert _texts(co.take_parts(SENDER)[1]) == ["b"]
+
+def test_released_parts_come_back_first():
+    _send("a", "b")
+    batch, _ = co.take_parts(SENDER)
+    co.release_parts(SENDER, batch)
+    _send("c")
+    assert _texts(co.take_parts(SENDER)[1]) == ["a", "b", "c"]
+
+def test_expired_lease_is_taken_again(monkeypatch):
+    monkeypatch.setattr(co, "COALESCE_LEASE", -1)
+    _send("a")
+    co.take_parts(SENDER)     # this flush dies without done/release
+    _send("b")
+    assert _texts(co.take_parts(SENDER)[1]) == ["a", "b"]
+
+def test_merge_text_parts():
+    data = co.merge_parts(SENDER, [{'text': "Ramesh:"}, {'text': "10 kg atta"}])
+    assert data == {'from': SENDER, 'body': "Ramesh:\n10 kg atta", 'num_media': 0}
+
+def test_merge_mixed_parts_keeps_the_list():
+    parts = [{'text': "Ramesh ka order"}, {'media_url': "https://example.com/v.ogg", 'media_type': "audio/ogg"}]
+    data = co.merge_parts(SENDER, parts)
+    assert data['parts'] == parts and data['num_media'] == 1
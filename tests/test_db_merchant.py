@@ -0,0 +1,136 @@
+"""
+Connection pool, nested cursors and unit_of_work() on SQLite.
+"""
+import pytest
+
+def _exists(db, phone):
+    with db.get_cursor() as cur:
+        db.execute_query(cur, "SELECT id FROM users WHERE phone = %s", (phone,))
+        return db.fetchone_normalized(cur) is not None
+
+def _insert(db, cur, phone):
+    db.execute_query(cur, "INSERT INTO users (phone) VALUES (%s)", (phone,))
+
+# --- pool ---
+
+def test_pool_reuses_released_connection(db):
+    pool = db.ConnectionPool(1, timeout=0.1)
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+
+def test_pool_times_out_when_exhausted(db):
+    pool = db.ConnectionPool(1, timeout=0.1)
+    pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+
+def test_pool_discards_broken_connection(db):
+    pool = db.ConnectionPool(1, timeout=0.1)
+    conn = pool.acquire()
+    pool.release(conn, broken=True)
+    assert pool.acquire() is not conn
+
+def test_pool_rolls_back_on_release(db):
+    pool = db.ConnectionPool(1, timeout=0.1)
+    conn = pool.acquire()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO users (phone) VALUES (?)", ("+pool-leak",))
+    pool.release(conn)
+    pool.close()
+    assert not _exists(db, "+pool-leak")
+
+# --- nested cursors ---
+
+def test_nested_cursor_does_not_commit_outer(db):
+    with pytest.raises(RuntimeError):
+        with db.get_cursor() as cur:
+            _insert(db, cur, "+nested-outer")
+            with db.get_cursor() as inner:
+                _insert(db, inner, "+nested-inner")
+            raise RuntimeError("outer fails after the inner cursor closed")
+    assert not _exists(db, "+nested-outer")
+    assert not _exists(db, "+nested-inner")
+
+def test_inner_failure_rolls_back_whole_unit(db):
+    with pytest.raises(RuntimeError):
+        with db.get_cursor() as cur:
+            _insert(db, cur, "+inner-fail-outer")
+            with db.get_cursor() as inner:
+                _insert(db, inner, "+inner-fail-inner")
+                raise RuntimeError("inner fails")
+    assert not _exists(db, "+inner-fail-outer")
+    assert not _exists(db, "+inner-fail-inner")
+
+def test_outer_cursor_commits_nested_work(db):
+    with db.get_cursor() as cur:
+        _insert(db, cur, "+nested-ok-outer")
+        with db.get_cursor() as inner:
+            _insert(db, inner, "+nested-ok-inner")
+    assert _exists(db, "+nested-ok-outer")
+    assert _exists(db, "+nested-ok-inner")
+
+# --- unit of work ---
+
+def test_unit_of_work_rolls_back_everything(db):
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.get_or_create_user("+uow-a")
+            db.get_or_create_user("+uow-b")
+            raise RuntimeError("boom")
+    assert not _exists(db, "+uow-a")
+    assert not _exists(db, "+uow-b")
+
+def test_after_commit_runs_only_after_commit(db):
+    calls = []
+    with db.unit_of_work():
+        db.get_or_create_user("+uow-commit")
+        db.after_commit(calls.append, "done")
+        assert calls == []
+    assert calls == ["done"]
+    assert _exists(db, "+uow-commit")
+
+def test_after_commit_dropped_on_rollback(db):
+    calls = []
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.after_commit(calls.append, "done")
+            raise RuntimeError("boom")
+    assert calls == []
+
+def test_after_commit_without_session_runs_now(db):
+    calls = []
+    db.after_commit(calls.append, "now")
+    assert calls == ["now"]
+
+# --- customers ---
+
+def _customer_of(db, order_id):
+    with db.get_cursor() as cur:
+        db.execute_query(cur, "SELECT c.id, c.name FROM orders_merchant o JOIN customers_merchant c ON c.id = o.customer_id WHERE o.id = %s", (order_id,))
+        return db.fetchone_normalized(cur)
+
+def test_draft_reuses_customer_for_a_typo(db, merchant):
+    first = _customer_of(db, db.create_draft_order_merchant(merchant, "Ramesh", [{"product": "Sugar", "qty": 1, "rate": 44}]))
+    again = _customer_of(db, db.create_draft_order_merchant(merchant, "Rameshh", [{"product": "Sugar", "qty": 1, "rate": 44}]))
+    assert again['id'] == first['id']
+
+def test_draft_near_miss_creates_customer(db, merchant):
+    first = _customer_of(db, db.create_draft_order_merchant(merchant, "Ramesh", [{"product": "Sugar", "qty": 1, "rate": 44}]))
+    other = _customer_of(db, db.create_draft_order_merchant(merchant, "Rakesh", [{"product": "Sugar", "qty": 1, "rate": 44}]))
+    assert other['id'] != first['id']
+    assert other['name'] == "Rakesh"
+
+def test_find_customer_is_exact(db, merchant):
+    db.create_draft_order_merchant(merchant, "Ramesh", [{"product": "Sugar", "qty": 1, "rate": 44}])
+    db.create_draft_order_merchant(merchant, "Mahesh Traders", [{"product": "Sugar", "qty": 1, "rate": 44}])
+    assert db.find_customer_merchant(merchant, "ramesh")['name'] == "Ramesh"
+    assert db.find_customer_merchant(merchant, "mahesh traders")["name"] == "Mahesh Traders"
+    assert db.find_customer_merchant(merchant, "Rakesh") is None
+    assert db.find_customer_merchant(merchant, "Ramesh Kumar") is None
+    assert db.find_customer_merchant(merchant, "Mahesh") is None
+
+def test_statement_for_unknown_customer(db, merchant):
+    import batch_merchant
+    db.create_draft_order_merchant(merchant, "Ramesh", [{"product": "Sugar", "qty": 1, "rate": 44}])
+    assert batch_merchant.build_batch(merchant, 'today', "Rakesh") == (None, 0, "customer_not_found")
@@ -0,0 +1,77 @@
+"""
+Fair scheduler on fakeredis: round-robin across merchants, confirmations
+first, and a merchant's own jobs never reordered.
+"""
+import pytest
+
+pytest.importorskip("rq")
+
+from rq import Queue
+
+import fair_merchant
+
+@pytest.fixture
+def fair(redis, monkeypatch):
+    # fakeredis has no INFO; rq caches the server version on the connection
+    setattr(redis, '__rq_redis_server_version', (7, 2, 0))
+    monkeypatch.setattr(fair_merchant, "FAIR_MERCHANT_RATE", 0)
+    q = Queue('merchant_jobs', connection=redis)
+    return fair_merchant.FairScheduler([q], redis)
+
+def _send(fair, sender, body):
+    return fair.queues['merchant_jobs'].enqueue('tasks_merchant.process_message', {'from': sender, 'body': body, 'num_media': 0})
+
+def _drain(fair, busy=()):
+    fair.intake()
+    out = []
+    while True:
+        res = fair.pop(busy)
+        if res is None: return out
+        job = res[0]
+        out.append((job.args[0]['from'], job.args[0]['body']))
+
+def test_old_redis_is_refused(redis):
+    setattr(redis, '__rq_redis_server_version', (6, 0, 0))
+    with pytest.raises(RuntimeError):
+        fair_merchant.FairScheduler([Queue('merchant_jobs', connection=redis)], redis)
+
+def test_round_robin_across_merchants(fair):
+    for body in ("a1", "a2", "a3"): _send(fair, "A", body)
+    _send(fair, "B", "b1")
+    assert _drain(fair) == [("A", "a1"), ("B", "b1"), ("A", "a2"), ("A", "a3")]
+
+def test_busy_merchant_is_skipped(fair):
+    _send(fair, "A", "a1")
+    _send(fair, "B", "b1")
+    assert _drain(fair, busy=["A"]) == [("B", "b1")]
+    assert _drain(fair) == [("A", "a1")]
+
+def test_confirmation_jumps_the_queue_in_order(fair):
+    _send(fair, "B", "b1")
+    _send(fair, "A", "a1")
+    _send(fair, "A", "1")
+    # A's earlier message still runs before its "1"
+    assert _drain(fair) == [("A", "a1"), ("A", "1"), ("B", "b1")]
+
+def test_rate_limited_merchant_waits(fair, monkeypatch):
+    monkeypatch.setattr(fair_merchant, "FAIR_MERCHANT_RATE", 0.001)
+    monkeypatch.setattr(fair_merchant, "FAIR_MERCHANT_BURST", 1)
+    _send(fair, "A", "a1")
+    _send(fair, "A", "a2")
+    _send(fair, "B", "b1")
+    assert _drain(fair) == [("A", "a1"), ("B", "b1")]
+
+def test_requeued_job_runs_first(fair):
+    _send(fair, "A", "a1")
+    _send(fair, "A", "a2")
+    fair.intake()
+    job, _ = fair.pop()
+    fair.requeue_front(job)
+    assert _drain(fair) == [("A", "a1"), ("A", "a2")]
+
+def test_recover_readmits_jobs_of_a_dead_worker(fair, redis):
+    job = _send(fair, "A", "a1")
+    redis.lrem(fair.queues['merchant_jobs'].key, 1, job.id)
+    redis.rpush(f"{fair_merchant.PREFIX}intake:gone:1", job.id)
+    assert fair.recover() == 1
+    assert _drain(fair) == [("A", "a1")]
@@ -0,0 +1,66 @@
+"""
+Bulk import from CSV on SQLite: validation, dedupe and re-runs.
+"""
+import pytest
+
+@pytest.fixture
+def importer(db):
+    import import_merchant
+    return import_merchant
+
+def _csv(tmp_path, text, name="rows.csv"):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+def _count(db, merchant, table):
+    with db.get_cursor() as cur:
+        db.execute_query(cur, f"SELECT COUNT(*) AS n FROM {table} t JOIN users u ON u.id = t.merchant_id WHERE u.phone = %s", (merchant,))
+        return db.fetchone_normalized(cur)['n']
+
+PRODUCTS = """Item Name,Rate,UOM,HSN
+Aashirvaad Atta,"₹ 42.00",kg,1101
+Sugar,44,kg,1701
+sugar,45,kg,1701
+,10,pcs,
+Lux Soap,-5,pcs,3401
+"""
+
+def test_import_products(db, importer, merchant, tmp_path):
+    stats = importer.import_file(merchant, _csv(tmp_path, PRODUCTS), 'products', progress=None)
+    assert (stats['read'], stats['imported'], stats['duplicates'], stats['rejected']) == (5, 2, 1, 2)
+    assert sorted(reason for _, reason in stats['errors']) == ["missing name", "negative price"]
+
+def test_reimport_adds_nothing(db, importer, merchant, tmp_path):
+    path = _csv(tmp_path, PRODUCTS)
+    importer.import_file(merchant, path, 'products', progress=None)
+    stats = importer.import_file(merchant, path, 'products', progress=None)
+    assert stats['imported'] == 0
+    assert _count(db, merchant, "products_merchant") == 2
+
+CUSTOMERS = """Party Name,Mobile No,GSTIN
+Ramesh,+91 98765 43210,27AAPFU0939F1ZV
+Ramesh Kumar,+91 98765 43210,
+Suresh,,
+suresh,,
+Ramesh,12345,
+"""
+
+def test_import_customers(db, importer, merchant, tmp_path):
+    stats = importer.import_file(merchant, _csv(tmp_path, CUSTOMERS), 'customers', progress=None)
+    # Same phone -> duplicate; same name without a phone -> duplicate;
+    # "Ramesh" with an invalid phone is not merged into the Ramesh who has one
+    assert (stats['imported'], stats['duplicates'], stats['bad_phones']) == (3, 2, 1)
+    assert stats['errors'] == [(6, "invalid phone '12345', imported without it")]
+
+def test_reimport_customers_adds_nothing(db, importer, merchant, tmp_path):
+    path = _csv(tmp_path, CUSTOMERS)
+    importer.import_file(merchant, path, 'customers', progress=None)
+    stats = importer.import_file(merchant, path, 'customers', progress=None)
+    assert stats['imported'] == 0 and stats['bad_phones'] == 0
+    assert _count(db, merchant, "customers_merchant") == 3
+
+def test_clean_phone(importer):
+    assert importer.clean_phone("12345") is None
+    assert importer.clean_phone(None) is None
+    assert importer.clean_phone(919876543210.0) is not None
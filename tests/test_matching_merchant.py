@@ -0,0 +1,62 @@
+"""
+Customer name matching: typos resolve to the existing customer, different
+people don't.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matching_merchant import NameIndex
+
+# Same thresholds as db_merchant's defaults
+THRESHOLD, MARGIN, TOKEN_MIN = 0.85, 0.05, 0.85
+
+CUSTOMERS = {1: "Ramesh", 2: "Mahesh Traders", 3: "Ramesh Kumar", 4: "Gupta", 5: "Sunita Devi"}
+
+@pytest.fixture(scope="module")
+def index():
+    idx = NameIndex()
+    for cid, name in CUSTOMERS.items():
+        idx.add(cid, name)
+    return idx
+
+def _match(index, name):
+    return index.best_unique(name, THRESHOLD, MARGIN, TOKEN_MIN)[0]
+
+@pytest.mark.parametrize("name, expected", [
+    ("Ramesh", 1),
+    ("rameshh", 1),
+    ("रमेश", 1),
+    ("Gupta ji", 4),
+    ("Mahesh traders", 2),
+    ("Maesh Traders", 2),
+    ("Ramesh kumar", 3),
+    ("Ramsh Kumar", 3),
+    ("Sunita devi", 5),
+])
+def test_same_customer(index, name, expected):
+    assert _match(index, name) == expected
+
+@pytest.mark.parametrize("name", [
+    "Rakesh",           # scores 0.8 against Ramesh: a different person
+    "Rajesh",
+    "Suresh",
+    "Rakesh Kumar",
+    "Sunil Devi",
+])
+def test_near_miss_is_new_customer(index, name):
+    assert _match(index, name) is None
+
+def test_ambiguous_name_is_new_customer():
+    idx = NameIndex()
+    idx.add(1, "Ramesh Kumar")
+    idx.add(2, "Ramesh Singh")
+    assert idx.best_unique("Ramesh", THRESHOLD, MARGIN, TOKEN_MIN)[0] is None
+
+def test_one_word_name_matches_its_business():
+    idx = NameIndex()
+    idx.add(1, "Ramesh Traders")
+    assert idx.best_unique("Ramesh", THRESHOLD, MARGIN, TOKEN_MIN)[0] == 1
@@ -0,0 +1,81 @@
+"""
+Migration runner and the data migrations, on SQLite.
+"""
+import pytest
+
+@pytest.fixture
+def migrations(db):
+    import migrations_merchant
+    return migrations_merchant
+
+def _order(db, merchant, status='draft', pdf_url=None, created_at=None):
+    user = db.get_user_by_phone(merchant)
+    with db.get_cursor() as cur:
+        cust = db.insert_returning_id(cur, "INSERT INTO customers_merchant (merchant_id, name) VALUES (%s, %s)", (user['id'], "Ramesh"))
+        order_id = db.insert_returning_id(cur, "INSERT INTO orders_merchant (merchant_id, customer_id, status, final_amount, pdf_url) VALUES (%s, %s, %s, %s, %s)",
+                                          (user['id'], cust, status, 100.0, pdf_url))
+        if created_at:
+            db.execute_query(cur, "UPDATE orders_merchant SET created_at = %s WHERE id = %s", (created_at, order_id))
+    return order_id
+
+def _status(db, order_id):
+    with db.get_cursor() as cur:
+        db.execute_query(cur, "SELECT status FROM orders_merchant WHERE id = %s", (order_id,))
+        row = db.fetchone_normalized(cur)
+    return row and row['status']
+
+def test_m003_confirms_only_invoiced_drafts(db, migrations, merchant, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with_url = _order(db, merchant, pdf_url="https://example.com/invoice.pdf")
+    legacy = _order(db, merchant)
+    live = _order(db, merchant)
+    path = tmp_path / migrations.LEGACY_INVOICE_PATH.format(legacy)
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b"%PDF")
+
+    with db.get_cursor() as cur:
+        migrations._m003_draft_sweep_index(cur)
+
+    assert _status(db, with_url) == 'confirmed'
+    assert _status(db, legacy) == 'confirmed'
+    assert _status(db, live) == 'draft'
+
+def test_sweep_expires_only_stale_uninvoiced_drafts(db, merchant):
+    stale = _order(db, merchant, created_at="2020-01-01 00:00:00")
+    invoiced = _order(db, merchant, pdf_url="https://example.com/invoice.pdf", created_at="2020-01-01 00:00:00")
+    confirmed = _order(db, merchant, status='confirmed', created_at="2020-01-01 00:00:00")
+    live = _order(db, merchant)
+
+    db.sweep_expired_drafts(3600)
+
+    assert _status(db, stale) is None
+    assert _status(db, invoiced) == 'draft'
+    assert _status(db, confirmed) == 'confirmed'
+    assert _status(db, live) == 'draft'
+
+def test_migrate_is_idempotent(db, migrations):
+    assert migrations.migrate() == migrations.LATEST_VERSION
+    assert migrations.migrate() == migrations.LATEST_VERSION
+    with db.get_cursor() as cur:
+        db.execute_query(cur, "SELECT version FROM schema_migrations ORDER BY version")
+        versions = [r['version'] for r in db.fetchall_normalized(cur)]
+    assert versions == [v for v, _, _ in migrations.MIGRATIONS]
+
+def test_migrations_are_in_order(migrations):
+    versions = [v for v, _, _ in migrations.MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
+
+def test_lookup_indexes_exist(db):
+    with db.get_cursor() as cur:
+        db.execute_query(cur, "SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = {r['name'] for r in db.fetchall_normalized(cur)}
+    assert {"ix_products_merchant_merchant", "ix_order_items_merchant_order", "ix_orders_merchant_merchant",
+            "ix_orders_merchant_status_created"} <= indexes
+
+def test_pending_migration_is_applied(db, migrations):
+    latest = migrations.LATEST_VERSION
+    with db.get_cursor() as cur:
+        db.execute_query(cur, "DELETE FROM schema_migrations WHERE version = %s", (latest,))
+    assert migrations.current_version() == latest - 1
+    assert migrations.migrate() == latest
+    assert migrations.current_version() == latest
@@ -0,0 +1,103 @@
+"""
+Fast-path parser against the benchmark corpus (benchmarks/bench_fast_path.py).
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_fast_path import CATALOG
+from cache_merchant import make_catalog
+from parser_merchant import parse_order, parse_report
+
+@pytest.fixture(scope="module")
+def catalog():
+    return make_catalog(CATALOG)
+
+# message -> (customer, [(product, qty, unit, rate), ...])
+ORDERS = [
+    ("Ramesh: 10 kg atta @ 42, 5 pcs soap @ 30",
+     ("Ramesh", [("Aashirvaad Atta", 10, "kg", 42), ("Lux Soap", 5, "pcs", 30)])),
+    ("for Mahesh Traders - 2kg sugar, 3 lux soap",
+     ("Mahesh Traders", [("Sugar", 2, "kg", 44), ("Lux Soap", 3, "pcs", 32)])),
+    ("Gupta ji: aadha kg cheeni, dedh dozen soap",
+     ("Gupta ji", [("Sugar", 0.5, "kg", 44), ("Lux Soap", 18, "pcs", 32)])),
+    ("10 kg atta",
+     ("Guest", [("Aashirvaad Atta", 10, "kg", 42)])),
+    ("Sharma Store: 5 ltr sarson tel @ 160, 10 kg toor dal, 20 packet parle g",
+     ("Sharma Store", [("Fortune Mustard Oil", 5, "ltr", 160), ("Toor Dal", 10, "kg", 140), ("Parle G", 20, "packet", 10)])),
+    ("रमेश को 5 किलो चीनी",
+     ("रमेश", [("Sugar", 5, "kg", 44)])),
+    ("Vijay: 2 kg surf @ 125; 4 amul butter",
+     ("Vijay", [("Surf Excel", 2, "kg", 125), ("Amul Butter", 4, "pcs", 56)])),
+    ("Anil ke liye 25 kg basmati rice 85 ka",
+     ("Anil", [("Basmati Rice", 25, "kg", 85)])),
+    ("Pooja: 1 surf excel, 2 parle g, 1 tata tea",
+     ("Pooja", [("Surf Excel", 1, "kg", 130), ("Parle G", 2, "packet", 10), ("Tata Tea Premium", 1, "packet", 120)])),
+    # A different unit is fine when the message gives its rate
+    ("Suresh ko 1 bori chawal 2000 ka",
+     ("Suresh", [("Basmati Rice", 1, "bag", 2000)])),
+    ("Ramesh: 10kg atta rate 40, 1 bori chawal 2000 rs",
+     ("Ramesh", [("Aashirvaad Atta", 10, "kg", 40), ("Basmati Rice", 1, "bag", 2000)])),
+    ("Ramesh: 10 kg atta 40 rs/kg",
+     ("Ramesh", [("Aashirvaad Atta", 10, "kg", 40)])),
+]
+
+# Free-form or not confidently parseable: must go to Gemini
+FALL_THROUGH = [
+    # "bori" of a per-kg product without a rate: the catalog price would be wrong
+    "Suresh ko do packet chai 120 ka aur 1 bori chawal",
+    "Ramesh: 1 bori chawal",
+    "bhai kal wala order cancel kar do",
+    "Ramesh ka payment aa gaya kya?",
+    "remind me to call Suresh at 5",
+    "hello",
+    "aaj ki sale kitni hui?",
+    "Ramesh: 10 kg maida, 5 kg besan",
+    "jo pichli baar bheja tha wahi bhej do",
+    "Mahesh ko 3 carton Maggi",
+    # A product name alone, without a quantity, is not an order
+    "atta",
+    "sugar",
+    "surf excel",
+    # Rate or line total? Only "@", "rate" and "ka" mark a per-unit price
+    "Ramesh: 10kg atta 420 rs",
+    "Ramesh: 10 kg atta ₹420",
+]
+
+@pytest.mark.parametrize("text,expected", ORDERS)
+def test_parse_order(catalog, text, expected):
+    res = parse_order(text, catalog)
+    assert res is not None and res["intent"] == "CREATE_ORDER"
+    items = [(i["product"], i["qty"], i["unit"], i["rate"]) for i in res["data"]["items"]]
+    assert (res["data"]["customer_name"], items) == expected
+
+@pytest.mark.parametrize("text", FALL_THROUGH)
+def test_parse_order_falls_through(catalog, text):
+    assert parse_order(text, catalog) is None
+
+# message -> (intent, data), or None for Gemini
+REPORTS = [
+    ("aaj ki sale kitni hui?", ("SALES_REPORT", {"period": "today"})),
+    ("kal ki bikri kitni thi", ("SALES_REPORT", {"period": "yesterday"})),
+    ("pichle mahine ki sale kitni", ("SALES_REPORT", {"period": "last_month"})),
+    ("how much sales this week", ("SALES_REPORT", {"period": "this_week"})),
+    ("Ramesh ka kitna baaki hai?", ("BALANCE", {"customer_name": "Ramesh"})),
+    ("how much does Suresh owe", ("BALANCE", {"customer_name": "Suresh"})),
+    ("balance of Gupta Stores", ("BALANCE", {"customer_name": "Gupta Stores"})),
+    ("रमेश का बकाया", ("BALANCE", {"customer_name": "रमेश"})),
+    # Not reporting questions
+    ("aaj ka balance kitna hai", None),
+    ("mera udhar kitna hai", None),
+    ("sale kal se band hai kya", None),
+    ("Ramesh: 10 kg atta @ 42", None),
+]
+
+@pytest.mark.parametrize("text,expected", REPORTS)
+def test_parse_report(text, expected):
+    res = parse_report(text)
+    assert (res and (res["intent"], res["data"])) == expected
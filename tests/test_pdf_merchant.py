@@ -0,0 +1,33 @@
+"""
+Invoice rendering: concurrent renders of one order never clash.
+"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("reportlab")
+
+from benchmarks.bench_invoice_pdf import make_order
+import utils_pdf_merchant
+
+def test_concurrent_renders_in_one_process(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    order = make_order(50)
+    urls, errors = [], []
+    def render():
+        try: urls.append(utils_pdf_merchant.generate_invoice_pdf(order['id'], base_url="", order=order, force=True))
+        except Exception as e: errors.append(e)
+    threads = [threading.Thread(target=render) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert errors == []
+    assert len(set(urls)) == 1
+    path = urls[0].lstrip('/')
+    with open(path, 'rb') as f:
+        assert f.read(4) == b'%PDF'
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
@@ -0,0 +1,52 @@
+"""
+Sales and receivables rollups stay equal to a rebuild from the orders.
+"""
+from datetime import datetime, timezone
+
+ITEMS = [{"product": "Sugar", "qty": 5, "rate": 40}]   # 200
+
+def _today(db):
+    return (datetime.now(timezone.utc).replace(tzinfo=None) + db.UTC_OFFSET).strftime("%Y-%m-%d")
+
+def _state(db, merchant, name):
+    customer, _ = db.get_customer_balance_merchant(merchant, name)
+    return db.get_sales_merchant(merchant, _today(db)), customer and customer['balance']
+
+def test_drafts_are_not_sales(db, merchant):
+    db.create_draft_order_merchant(merchant, "Ramesh", ITEMS)
+    sales, _ = _state(db, merchant, "Ramesh")
+    assert sales['orders'] == 0 and sales['sales'] == 0
+
+def test_confirm_and_payment_update_rollups(db, merchant):
+    first = db.create_draft_order_merchant(merchant, "Ramesh", ITEMS)
+    second = db.create_draft_order_merchant(merchant, "Ramesh", ITEMS)
+    assert db.confirm_order_merchant(first)
+    assert db.confirm_order_merchant(second)
+    assert not db.confirm_order_merchant(second)    # already confirmed: counted once
+    sales, balance = _state(db, merchant, "Ramesh")
+    assert sales == {'orders': 2, 'sales': 400.0, 'paid': 0.0, 'due': 400.0}
+    assert balance == 400.0
+
+    assert db.set_payment_status_merchant(first, 'paid')
+    assert db.set_payment_status_merchant(first, 'paid')    # no-op
+    sales, balance = _state(db, merchant, "Ramesh")
+    assert (sales['paid'], sales['due'], balance) == (200.0, 200.0, 200.0)
+
+    db.set_payment_status_merchant(first, 'unpaid')
+    sales, balance = _state(db, merchant, "Ramesh")
+    assert (sales['paid'], balance) == (0.0, 400.0)
+
+def test_paid_draft_counts_as_paid_on_confirm(db, merchant):
+    order = db.create_draft_order_merchant(merchant, "Ramesh", ITEMS)
+    db.set_payment_status_merchant(order, 'paid')
+    db.confirm_order_merchant(order)
+    sales, balance = _state(db, merchant, "Ramesh")
+    assert (sales['sales'], sales['paid'], balance) == (200.0, 200.0, 0.0)
+
+def test_rebuild_matches_incremental(db, merchant):
+    orders = [db.create_draft_order_merchant(merchant, name, ITEMS) for name in ("Ramesh", "Suresh", "Ramesh")]
+    for o in orders: db.confirm_order_merchant(o)
+    db.set_payment_status_merchant(orders[1], 'paid')
+    before = [_state(db, merchant, n) for n in ("Ramesh", "Suresh")]
+    db.rebuild_rollups(merchant)
+    assert [_state(db, merchant, n) for n in ("Ramesh", "Suresh")] == before
@@ -0,0 +1,124 @@
+"""
+process_message() end to end on SQLite and fakeredis, with Gemini and
+Twilio replaced by stubs.
+"""
+import pytest
+
+@pytest.fixture
+def tasks(db, monkeypatch):
+    import tasks_merchant
+    sent = []
+    monkeypatch.setattr(tasks_merchant, "send_whatsapp", lambda to, body, media_url=None, wait=False: sent.append(body))
+    monkeypatch.setattr(tasks_merchant, "sent", sent, raising=False)
+    return tasks_merchant
+
+_sids = iter(range(10**6))
+
+def _msg(sender, body):
+    return {'from': sender, 'body': body, 'num_media': 0, 'message_sid': f"SM{next(_sids)}"}
+
+def test_intent_resolved_outside_unit_of_work(db, tasks, merchant, monkeypatch):
+    seen = []
+    def intent(user_phone, **kw):
+        seen.append(db._session.get())
+        return {"intent": "CHAT", "reply_text": "hi", "source": "llm"}
+    monkeypatch.setattr(tasks, "process_merchant_intent", intent)
+    tasks.process_message(_msg(merchant, "hello"))
+    assert seen == [None]
+    assert tasks.sent == ["hi"]
+
+def test_confirm_reply_skips_intent(db, tasks, merchant, monkeypatch):
+    monkeypatch.setattr(tasks, "process_merchant_intent", lambda *a, **kw: pytest.fail("intent resolved for a confirm"))
+    db.set_user_state(merchant, "CONFIRM_ORDER", {"order_id": 999999})
+    tasks.process_message(_msg(merchant, "1"))
+    assert db.get_user_state(merchant) == (None, {})
+    assert "expired" in tasks.sent[0]
+
+def test_duplicate_message_is_skipped(db, tasks, merchant, monkeypatch):
+    calls = []
+    monkeypatch.setattr(tasks, "process_merchant_intent",
+                        lambda *a, **kw: calls.append(1) or {"intent": "CHAT", "reply_text": "hi"})
+    msg = _msg(merchant, "hello")
+    tasks.process_message(msg)
+    tasks.process_message(msg)
+    assert len(calls) == 1
+
+def test_failed_message_can_be_retried(db, tasks, merchant, monkeypatch):
+    def boom(*a, **kw): raise RuntimeError("model down")
+    monkeypatch.setattr(tasks, "process_merchant_intent", boom)
+    msg = _msg(merchant, "hello")
+    with pytest.raises(RuntimeError):
+        tasks.process_message(msg)
+    monkeypatch.setattr(tasks, "process_merchant_intent", lambda *a, **kw: {"intent": "CHAT", "reply_text": "hi"})
+    tasks.process_message(msg)
+    assert tasks.sent == ["hi"]
+
+# --- Redis state ---
+
+@pytest.fixture
+def redis_state(db, monkeypatch):
+    from state_merchant import RedisStateStore
+    monkeypatch.setattr(db, "_state_store", RedisStateStore())
+    monkeypatch.setattr(db, "_WRITE_BEHIND", False)
+    return db._state_store
+
+def test_redis_state_written_after_commit(db, redis_state, merchant):
+    with db.unit_of_work():
+        db.set_user_state(merchant, "CONFIRM_ORDER", {"order_id": 1})
+        assert redis_state.get(merchant) is None
+    assert redis_state.get(merchant) == ("CONFIRM_ORDER", {"order_id": 1})
+
+def test_redis_state_dropped_on_rollback(db, redis_state, merchant):
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.set_user_state(merchant, "CONFIRM_ORDER", {"order_id": 1})
+            raise RuntimeError("boom")
+    assert redis_state.get(merchant) is None
+
+# --- intent cache ---
+
+class _Model:
+    def __init__(self):
+        self.calls = 0
+    def generate_content(self, contents):
+        self.calls += 1
+        return type("Res", (), {"text": '{"intent": "CHAT", "data": {}, "reply_text": "ok"}'})()
+
+def _voice(sender):
+    return dict(_msg(sender, ""), num_media=1, media_url="https://example.com/voice.ogg", media_type="audio/ogg")
+
+def test_failed_media_download_skips_intent_cache(db, tasks, merchant, monkeypatch):
+    model = _Model()
+    monkeypatch.setattr(tasks, "get_model", lambda: model)
+    monkeypatch.setattr(tasks, "download_media", lambda url: None)
+    tasks.process_message(_voice(merchant))
+    tasks.process_message(_voice(merchant))
+    assert model.calls == 2
+
+def test_same_text_hits_intent_cache(db, tasks, merchant, monkeypatch):
+    model = _Model()
+    monkeypatch.setattr(tasks, "get_model", lambda: model)
+    tasks.process_message(_msg(merchant, "kya haal hai"))
+    tasks.process_message(_msg(merchant, "kya haal hai"))
+    assert model.calls == 1
+
+# --- coalescing ---
+
+def test_failed_flush_keeps_parts(db, tasks, merchant, monkeypatch):
+    import coalesce_merchant
+    monkeypatch.setattr(coalesce_merchant, "COALESCE_WINDOW", 2.0)
+    monkeypatch.setattr(tasks, "_schedule_flush", lambda sender, delay: None)
+    seen = []
+    def boom(user_phone, text=None, **kw):
+        raise RuntimeError("model down")
+    monkeypatch.setattr(tasks, "process_merchant_intent", boom)
+    tasks.process_message(_msg(merchant, "kya"))
+    tasks.process_message(_msg(merchant, "haal hai"))
+    with pytest.raises(RuntimeError):
+        tasks._run_coalesced(merchant)
+
+    monkeypatch.setattr(tasks, "process_merchant_intent",
+                        lambda user_phone, text=None, **kw: seen.append(text) or {"intent": "CHAT", "reply_text": "ok"})
+    tasks._run_coalesced(merchant)
+    assert seen == ["kya\nhaal hai"]
+    assert coalesce_merchant.take_parts(merchant) == (None, [])
@@ -0,0 +1,64 @@
+"""
+ConcurrentWorker runs jobs with the same registry bookkeeping as rq's own
+workers. Smoke tests against fakeredis.
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("rq")
+
+from rq import Queue, Retry
+from rq.job import JobStatus
+
+import worker_merchant
+
+# Job functions: rq imports them by name, so they live at module level
+def add(a, b):
+    return a + b
+
+def fail():
+    raise RuntimeError("job failed")
+
+def _run(redis, *jobs, concurrency=2):
+    """Runs ConcurrentWorker until every job has ended, then stops it."""
+    worker = worker_merchant.ConcurrentWorker([Queue('merchant_jobs', connection=redis)], redis, concurrency)
+    def stop_when_done():
+        deadline = time.monotonic() + 15
+        while time.monotonic() < deadline:
+            if all(j.get_status(refresh=True) in (JobStatus.FINISHED, JobStatus.FAILED) for j in jobs): break
+            time.sleep(0.05)
+        worker.request_stop()
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    worker.work()
+    return worker
+
+def test_runs_a_job(redis):
+    q = Queue('merchant_jobs', connection=redis)
+    job = q.enqueue(add, 2, 3)
+    _run(redis, job)
+    job.refresh()
+    assert job.get_status() == JobStatus.FINISHED
+    assert job.return_value() == 5
+    assert job.id not in q.started_job_registry.get_job_ids()
+
+def test_failed_job_goes_to_failed_registry(redis):
+    q = Queue('merchant_jobs', connection=redis)
+    job = q.enqueue(fail)
+    _run(redis, job)
+    assert job.get_status(refresh=True) == JobStatus.FAILED
+    assert job.id in q.failed_job_registry.get_job_ids()
+    assert job.id not in q.started_job_registry.get_job_ids()
+
+def test_failed_job_is_retried(redis):
+    q = Queue('merchant_jobs', connection=redis)
+    job = q.enqueue(fail, retry=Retry(max=1))
+    _run(redis, job)
+    job.refresh()
+    assert job.get_status() == JobStatus.FAILED
+    assert job.retries_left == 0
@@ -1,116 +1,255 @@
 import os
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib import colors
+import re
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from db_merchant import get_order_details_merchant
+from reportlab.lib.pagesizes import A4
 
-# Ensure directory exists for storing PDFs
+# The rest of ReportLab (canvas, fonts, colors) is imported on first render;
+# warm_up() does it ahead of time.
+
+# Directory for storing PDFs, created on first render
 STATIC_FOLDER = "static/invoices"
-if not os.path.exists(STATIC_FOLDER):
-    os.makedirs(STATIC_FOLDER)
 
-def generate_invoice_pdf(order_id, base_url="https://mina-mom-agent.onrender.com"):
+WIDTH, HEIGHT = A4
+TABLE_Y = HEIGHT - 180
+RIGHT_X = WIDTH - 60
+
+# ==========================================
+# 1. LOW-LEVEL STAMPING
+# ==========================================
+# Invoices only use the standard Helvetica faces, so text is written straight
+# into the page stream as PDF operators (canvas.addLiteral) instead of going
+# through a ReportLab text object per string.
+
+FONTS = ("Helvetica", "Helvetica-Bold", "Helvetica-Oblique")
+
+_widths = {}   # font -> {char: glyph width per 1000 units}
+
+def _text_width(text, font, size):
+    table = _widths.get(font)
+    if table is None:
+        from reportlab.pdfbase.pdfmetrics import getFont
+        widths = getFont(font).widths
+        table = _widths[font] = {bytes([i]).decode('cp1252', 'replace'): widths[i] for i in range(32, 256)}
+    return sum(table.get(ch, 556) for ch in text) * size / 1000.0
+
+def _pdf_str(text):
+    """PDF literal string for a standard (WinAnsi) font."""
+    text = str(text).replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    if not text.isascii():
+        # The page stream is written as UTF-8, so WinAnsi bytes go in as octal escapes
+        text = ''.join(ch if ch < '\x80' else '\\%03o' % ord(ch)
+                       for ch in text.encode('cp1252', 'replace').decode('latin-1'))
+    return '(' + text + ')'
+
+def _font_refs(c):
+    """Registers the invoice fonts on this document and returns their resource names (/F1 ...)."""
+    refs = []
+    for font in FONTS:
+        t = c.beginText()
+        t.setFont(font, 10)
+        refs.append(re.search(r'/(\S+) ', t.getCode()).group(1))
+    return tuple(refs)
+
+def _rgb(color):
+    return "%.4f %.4f %.4f" % color.rgb()
+
+def _text_op(ref, size, x, y, text):
+    return f"BT /{ref} {size} Tf 1 0 0 1 {x:.2f} {y:.2f} Tm {_pdf_str(text)} Tj ET"
+
+# ==========================================
+# 2. STATIC TEMPLATE (cached per merchant)
+# ==========================================
+
+class InvoiceTemplate:
     """
-    Generates a PDF invoice for the given order_id.
+    The parts of an invoice that only depend on the merchant: header, "Bill To"
+    label, table header and footer. Laid out once into PDF operator strings
+    and stamped onto every invoice for that merchant.
     """
-    
-    # 1. Fetch Order Data from DB
-    order = get_order_details_merchant(order_id)
-    if not order:
-        return None
 
-    # Unpack Data
+    def __init__(self, merchant_name, merchant_phone, refs):
+        from reportlab.lib import colors
+        reg, bold, oblique = refs
+        w, h = WIDTH, HEIGHT
+        self.first_page = "\n".join([
+            # --- HEADER ---
+            "0 0 0 rg",
+            _text_op(bold, 20, 50, h - 50, merchant_name),
+            _text_op(reg, 10, 50, h - 65, f"Phone: {merchant_phone}"),
+            _text_op(bold, 16, w - 50 - _text_width("INVOICE", FONTS[1], 16), h - 50, "INVOICE"),
+            f"{_rgb(colors.lightgrey)} RG 50 {h - 100:.2f} m {w - 50:.2f} {h - 100:.2f} l S",
+            # --- BILL TO ---
+            _text_op(bold, 12, 50, h - 130, "Bill To:"),
+            # --- TABLE HEADER ---
+            f"{_rgb(colors.whitesmoke)} rg 50 {TABLE_Y - 5:.2f} {w - 100:.2f} 20 re f 0 0 0 rg",
+            _text_op(bold, 10, 60, TABLE_Y, "ITEM"),
+            _text_op(bold, 10, 300, TABLE_Y, "QTY"),
+            _text_op(bold, 10, 380, TABLE_Y, "RATE"),
+            _text_op(bold, 10, RIGHT_X - _text_width("TOTAL", FONTS[1], 10), TABLE_Y, "TOTAL"),
+        ])
+        self.footer = f"{_rgb(colors.grey)} rg " + _text_op(
+            oblique, 8, w / 2 - _text_width(FOOTER_TEXT, FONTS[2], 8) / 2, 30, FOOTER_TEXT)
+
+FOOTER_TEXT = "Generated via MinA - Your AI Business Assistant"
+
+TEMPLATE_CACHE_MAX = 256
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+def get_template(merchant_name, merchant_phone, refs):
+    key = (merchant_name, merchant_phone, refs)
+    with _templates_lock:
+        tpl = _templates.get(key)
+        if tpl is not None:
+            _templates.move_to_end(key)
+            return tpl
+    tpl = InvoiceTemplate(merchant_name, merchant_phone, refs)
+    with _templates_lock:
+        _templates[key] = tpl
+        while len(_templates) > TEMPLATE_CACHE_MAX:
+            _templates.popitem(last=False)
+    return tpl
+
+# ==========================================
+# 3. RENDERING
+# ==========================================
+
+def _format_date(created_at):
+    if isinstance(created_at, str):
+        try:
+            return datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S").strftime("%d-%b-%Y")
+        except:
+            return created_at
+    elif isinstance(created_at, datetime):
+        return created_at.strftime("%d-%b-%Y")
+    return datetime.now().strftime("%d-%b-%Y")
+
+def render_invoice(c, order, refs=None):
+    """Draws one invoice onto canvas c, starting on the current page."""
+    refs = refs or _font_refs(c)
+    reg, bold = refs[0], refs[1]
+    order_id = order.get('id')
     invoice_no = order.get('invoice_number') or f"INV-{order_id:04d}"
     customer_name = order.get('customer_name', 'Cash Customer')
     merchant_name = order.get('business_name') or "My Business"
     merchant_phone = order.get('merchant_phone', '')
     items = order.get('items', [])
     final_amount = order.get('final_amount', 0.0)
-    
-    # Handle dates safely
-    created_at = order.get('created_at')
-    if isinstance(created_at, str):
-        try:
-            date_str = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S").strftime("%d-%b-%Y")
-        except:
-            date_str = created_at
-    elif isinstance(created_at, datetime):
-        date_str = created_at.strftime("%d-%b-%Y")
-    else:
-        date_str = datetime.now().strftime("%d-%b-%Y")
-    
-    # 2. Setup PDF File
-    filename = f"invoice_{order_id}.pdf"
-    filepath = os.path.join(STATIC_FOLDER, filename)
-    
-    c = canvas.Canvas(filepath, pagesize=A4)
-    width, height = A4
-    
-    # --- HEADER ---
-    c.setFont("Helvetica-Bold", 20)
-    c.drawString(50, height - 50, merchant_name)
-    c.setFont("Helvetica", 10)
-    c.drawString(50, height - 65, f"Phone: {merchant_phone}")
-    c.setFont("Helvetica-Bold", 16)
-    c.drawRightString(width - 50, height - 50, "INVOICE")
-    c.setFont("Helvetica", 10)
-    c.drawRightString(width - 50, height - 70, f"# {invoice_no}")
-    c.drawRightString(width - 50, height - 85, f"Date: {date_str}")
-    c.setStrokeColor(colors.lightgrey)
-    c.line(50, height - 100, width - 50, height - 100)
-    
-    # --- BILL TO ---
-    c.setFillColor(colors.black)
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, height - 130, "Bill To:")
-    c.setFont("Helvetica", 12)
-    c.drawString(50, height - 145, customer_name)
-    
-    # --- TABLE HEADER ---
-    y = height - 180
-    c.setFillColor(colors.whitesmoke)
-    c.rect(50, y - 5, width - 100, 20, fill=True, stroke=False)
-    c.setFillColor(colors.black)
-    c.setFont("Helvetica-Bold", 10)
-    c.drawString(60, y, "ITEM")
-    c.drawString(300, y, "QTY")
-    c.drawString(380, y, "RATE")
-    c.drawRightString(width - 60, y, "TOTAL")
-    
+    date_str = _format_date(order.get('created_at'))
+
+    tpl = get_template(merchant_name, merchant_phone, refs)
+    c.addLiteral(tpl.first_page)
+
+    # --- VARIABLE FIELDS ---
+    inv_txt, date_txt = f"# {invoice_no}", f"Date: {date_str}"
+    c.addLiteral("\n".join([
+        _text_op(reg, 10, WIDTH - 50 - _text_width(inv_txt, FONTS[0], 10), HEIGHT - 70, inv_txt),
+        _text_op(reg, 10, WIDTH - 50 - _text_width(date_txt, FONTS[0], 10), HEIGHT - 85, date_txt),
+        _text_op(reg, 12, 50, HEIGHT - 145, customer_name),
+    ]))
+
     # --- ROWS ---
-    y -= 25
-    c.setFont("Helvetica", 10)
+    # One text block per page, built as a list of strings and joined once
+    y = TABLE_Y - 25
+    ops = [f"0 0 0 rg BT /{reg} 10 Tf"]
     for item in items:
         name = item.get('product_name', 'Item')
         qty = item.get('quantity', 0)
         rate = item.get('unit_price', 0)
-        total = item.get('total_price', 0)
-        
+        total = f"{item.get('total_price', 0):.2f}"
+
         if len(name) > 40: name = name[:37] + "..."
-        
-        c.drawString(60, y, name)
-        c.drawString(300, y, str(qty))
-        c.drawString(380, y, f"{rate:.2f}")
-        c.drawRightString(width - 60, y, f"{total:.2f}")
+
+        ops.append(
+            f"1 0 0 1 60 {y:.2f} Tm {_pdf_str(name)} Tj "
+            f"1 0 0 1 300 {y:.2f} Tm {_pdf_str(qty)} Tj "
+            f"1 0 0 1 380 {y:.2f} Tm ({rate:.2f}) Tj "
+            f"1 0 0 1 {RIGHT_X - _text_width(total, FONTS[0], 10):.2f} {y:.2f} Tm ({total}) Tj"
+        )
         y -= 20
-        
+
         if y < 100:
+            ops.append("ET")
+            c.addLiteral("\n".join(ops))
             c.showPage()
-            y = height - 50
-            
+            y = HEIGHT - 50
+            ops = [f"0 0 0 rg BT /{reg} 10 Tf"]
+    ops.append("ET")
+    c.addLiteral("\n".join(ops))
+
     # --- TOTAL ---
-    c.setStrokeColor(colors.black)
-    c.line(50, y - 10, width - 50, y - 10)
-    y -= 40
-    c.setFont("Helvetica-Bold", 14)
-    c.drawString(300, y, "Total Amount:")
-    c.drawRightString(width - 60, y, f"INR {final_amount:.2f}")
-    
+    amount = f"INR {final_amount:.2f}"
+    c.addLiteral("\n".join([
+        f"0 0 0 RG 50 {y - 10:.2f} m {WIDTH - 50:.2f} {y - 10:.2f} l S",
+        _text_op(bold, 14, 300, y - 40, "Total Amount:"),
+        _text_op(bold, 14, RIGHT_X - _text_width(amount, FONTS[1], 14), y - 40, amount),
+    ]))
+
     # --- FOOTER ---
-    c.setFont("Helvetica-Oblique", 8)
-    c.setFillColor(colors.grey)
-    c.drawCentredString(width / 2, 30, "Generated via MinA - Your AI Business Assistant")
-    c.save()
-    
-    return f"{base_url}/{filepath}"
\ No newline at end of file
+    c.addLiteral(tpl.footer)
+
+# Bump when the layout changes so files rendered by older code aren't reused
+RENDER_VERSION = 2
+
+def invoice_digest(order):
+    """Hash of everything printed on the invoice; names the output file."""
+    fields = {k: order.get(k) for k in ('id', 'invoice_number', 'customer_name', 'business_name', 'merchant_phone', 'final_amount')}
+    fields['date'] = _format_date(order.get('created_at'))
+    fields['items'] = [[i.get('product_name'), i.get('quantity'), i.get('unit_price'), i.get('total_price')]
+                       for i in order.get('items', [])]
+    raw = json.dumps([RENDER_VERSION, fields], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:20]
+
+def generate_invoice_pdf(order_id, base_url="https://mina-mom-agent.onrender.com", order=None, force=False):
+    """
+    Generates a PDF invoice for the given order_id.
+    Pass an already-loaded order (get_order_details_merchant shape) to skip the DB fetch.
+    Files are named by content hash, so an unchanged invoice is not rendered
+    again unless force=True.
+    """
+
+    # 1. Fetch Order Data from DB
+    if order is None:
+        from db_merchant import get_order_details_merchant
+        order = get_order_details_merchant(order_id)
+    if not order:
+        return None
+    order = dict(order, id=order.get('id') or order_id)
+
+    # 2. Setup PDF File
+    filename = f"invoice_{order_id}_{invoice_digest(order)}.pdf"
+    filepath = os.path.join(STATIC_FOLDER, filename)
+    if os.path.exists(filepath) and not force:
+        return f"{base_url}/{filepath}"
+
+    # invariant=1 drops timestamps/random IDs so the same order gives the same bytes.
+    # Written under a temp name so concurrent renders never serve a half-written file.
+    from reportlab.pdfgen import canvas
+    os.makedirs(STATIC_FOLDER, exist_ok=True)
+    # One temp file per render: threads of one process must not share it either
+    fd, tmppath = tempfile.mkstemp(prefix=filename + ".", suffix=".tmp", dir=STATIC_FOLDER)
+    os.close(fd)
+    try:
+        c = canvas.Canvas(tmppath, pagesize=A4, invariant=1)
+        render_invoice(c, order)
+        c.save()
+        os.chmod(tmppath, 0o644)   # mkstemp creates it owner-only
+        os.replace(tmppath, filepath)
+    except Exception:
+        try: os.remove(tmppath)
+        except OSError: pass
+        raise
+
+    return f"{base_url}/{filepath}"
+
+def warm_up():
+    """Loads ReportLab and the font width tables and creates STATIC_FOLDER."""
+    from reportlab.pdfgen import canvas
+    for font in FONTS:
+        _text_width("0", font, 10)
+    os.makedirs(STATIC_FOLDER, exist_ok=True)
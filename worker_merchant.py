@@ -1,7 +1,23 @@
 import os
 import sys
+import time
+_START = time.perf_counter()
+import signal
+import argparse
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import redis
-from rq import Worker, Queue
+from rq import Worker, SimpleWorker, Queue
+from rq.job import JobStatus
+from rq.executions import Execution
+from rq.scheduler import RQScheduler
+from rq.utils import now
+from rq.exceptions import DequeueTimeout
+from fair_merchant import FairScheduler, sender_of
+
+_IMPORTS_S = time.perf_counter() - _START
 
 # ADD THIS LINE: Tell the worker to look in the current directory for tasks_merchant.py
 sys.path.append(os.getcwd())
@@ -10,9 +26,292 @@ listen = ['merchant_jobs']
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 conn = redis.from_url(redis_url)
 
+# The default RQ Worker forks a fresh process per job, which throws away the
+# DB connection pool after every message. SimpleWorker runs jobs in this
+# process so pooled connections survive across jobs. Set RQ_FORK=1 to go back.
+USE_FORK = os.getenv('RQ_FORK', '0') == '1'
+# A forked job process exits as soon as the job returns, so replies can't be
+# left to background sender threads there
+if USE_FORK:
+    os.environ.setdefault('SEND_SHARDS', '0')
+
+# Jobs run at once per process with --concurrency (1 = plain rq worker)
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '1'))
+
+# Per-merchant round-robin with a priority lane for confirmations (see
+# fair_merchant). Opt-in: it needs Redis 6.2+ and runs through
+# ConcurrentWorker, which doesn't enforce rq's job_timeout. Runs jobs in this
+# process, so not with RQ_FORK=1.
+FAIR_SCHEDULING = os.getenv('FAIR_SCHEDULING', '0') == '1' and not USE_FORK
+FAIR_RECOVER_INTERVAL = 30
+
+# Invoice rendering runs on its own queue, one worker process per core
+INVOICE_QUEUE = 'invoice_jobs'
+INVOICE_WORKERS = int(os.getenv('INVOICE_WORKERS', '0')) or os.cpu_count() or 1
+
+# Bulk invoice/statement exports, one job at a time
+BATCH_QUEUE = 'batch_jobs'
+
+# Background housekeeping: state write-behind flush and expired draft sweep
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', '60'))
+
+def maintenance_loop():
+    from db_merchant import flush_state_write_behind, sweep_expired_drafts
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        try:
+            while flush_state_write_behind():
+                pass
+            swept = sweep_expired_drafts()
+            if swept: print(f"🧹 Swept {swept} expired draft orders")
+        except Exception as e:
+            print(f"Maintenance Error: {e}")
+
+# ==========================================
+# CONCURRENT MODE
+# ==========================================
+# Jobs are mostly waiting on Gemini/Twilio/Postgres, so one process can run
+# several on threads. Jobs from the same sender run one after another in queue
+# order; different senders run in parallel. Per-service caps live in
+# limits_merchant. With FAIR_SCHEDULING, jobs come from fair_merchant's
+# per-merchant round-robin instead of the plain FIFO. rq's job_timeout is not enforced in this mode (it relies on
+# signals in the main thread); the HTTP clients' own timeouts apply instead.
+#
+# The process registers as an rq worker and each running job sits in its
+# queue's StartedJobRegistry under a heartbeat, so a job whose process was
+# killed goes to the FailedJobRegistry (or is retried) instead of vanishing.
+
+DEQUEUE_TIMEOUT = 1   # seconds; also how long a stop request can wait on an idle queue
+RESULT_TTL = 500
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TTL = 60    # a running job counts as abandoned this long after its process stops beating
+CLEAN_REGISTRIES_INTERVAL = 60
+
+def warm_up(llm=True, pdf=True):
+    """Imports the task module and sets up DB/Gemini/ReportLab before the first job, then prints a startup report."""
+    t0 = time.perf_counter()
+    try:
+        import tasks_merchant
+        imported = time.perf_counter() - t0
+        timings = tasks_merchant.warm_up(llm=llm, pdf=pdf)
+    except Exception as e:
+        # Jobs initialize whatever is missing on first use
+        print(f"⚠️ Warm-up failed: {e}")
+        return
+    steps = [f"imports {_IMPORTS_S + imported:.2f}s"] + [f"{name} {secs:.2f}s" for name, secs in timings.items()]
+    print(f"⏱️ Startup {time.perf_counter() - _START:.2f}s: " + ", ".join(steps))
+
+def flush_sends():
+    import http_merchant
+    http_merchant.flush_sends()
+
+# _perform mirrors rq 2.x Worker.perform_job/handle_job_success/handle_job_failure,
+# including job and Execution methods rq treats as internal; requirements.txt
+# pins rq to 2.x and tests/test_worker_merchant.py runs jobs through it.
+class ConcurrentWorker:
+    def __init__(self, queues, connection, concurrency, fair=False):
+        self.queues = queues
+        self.conn = connection
+        self.fair = FairScheduler(queues, connection) if fair else None
+        self.executor = ThreadPoolExecutor(concurrency, thread_name_prefix="job")
+        # Bounds jobs held by this process, running or waiting behind their sender
+        self.slots = threading.Semaphore(concurrency * 2)
+        self.lanes = {}   # sender -> deque of (job, queue) waiting; present while the sender has a job running
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # Registration, heartbeats and stats only: jobs run on our threads, not in worker.work()
+        self.worker = SimpleWorker(queues, connection=connection)
+        self.running = {}   # job id -> (job, execution)
+
+    def request_stop(self, signum=None, frame=None):
+        if not self.stopping.is_set():
+            print("🛑 Stopping: finishing running jobs, requeueing the rest...")
+        self.stopping.set()
+
+    def work(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        self.worker.register_birth()
+        self.worker.heartbeat(HEARTBEAT_TTL)
+        scheduler = threading.Thread(target=self._schedule_loop, name="scheduler", daemon=True)
+        scheduler.start()
+        while not self.stopping.is_set():
+            if not self.slots.acquire(timeout=1): continue
+            try:
+                if self.fair:
+                    # Senders with a job running here wait for their next turn
+                    with self.lock: busy = list(self.lanes)
+                    res = self.fair.next(busy, timeout=DEQUEUE_TIMEOUT)
+                else:
+                    res = Queue.dequeue_any(self.queues, timeout=DEQUEUE_TIMEOUT, connection=self.conn)
+            except DequeueTimeout:
+                res = None
+            except Exception as e:
+                print(f"Dequeue Error: {e}")
+                res = None
+                time.sleep(1)
+            if res is None:
+                self.slots.release()
+                continue
+            self._dispatch(*res)
+        self._shutdown()
+
+    def _schedule_loop(self):
+        """
+        Moves due enqueue_in() jobs onto their queues, as rq's with_scheduler
+        does, and keeps the worker and running jobs' heartbeats alive.
+        """
+        scheduler = RQScheduler(self.queues, connection=self.conn)
+        recovered_at = beat_at = cleaned_at = 0.0
+        while not self.stopping.wait(1):
+            try:
+                if time.monotonic() - beat_at > HEARTBEAT_INTERVAL:
+                    beat_at = time.monotonic()
+                    self._heartbeat()
+                if time.monotonic() - cleaned_at > CLEAN_REGISTRIES_INTERVAL:
+                    # Moves jobs of killed workers from StartedJobRegistry to FailedJobRegistry
+                    cleaned_at = time.monotonic()
+                    self.worker.clean_registries()
+                if scheduler.acquire_locks():
+                    scheduler.enqueue_scheduled_jobs()
+                if self.fair and time.monotonic() - recovered_at > FAIR_RECOVER_INTERVAL:
+                    recovered_at = time.monotonic()
+                    self.fair.recover()
+            except Exception as e:
+                print(f"Scheduler Error: {e}")
+        try: scheduler.release_locks()
+        except Exception: pass
+
+    def _dispatch(self, job, queue):
+        key = sender_of(job)
+        with self.lock:
+            lane = self.lanes.get(key)
+            if lane is not None:
+                lane.append((job, queue))
+                return
+            self.lanes[key] = deque()
+        self.executor.submit(self._run_lane, key, job, queue)
+
+    def _run_lane(self, key, job, queue):
+        while True:
+            try:
+                self._perform(job, queue)
+            finally:
+                self.slots.release()
+            with self.lock:
+                lane = self.lanes[key]
+                if not lane:
+                    del self.lanes[key]
+                    if self.fair: self.fair.notify()
+                    return
+                # While stopping, leave the rest of the lane for _shutdown to requeue
+                if self.stopping.is_set(): return
+                job, queue = lane.popleft()
+
+    def _heartbeat(self):
+        with self.lock: running = list(self.running.values())
+        with self.conn.pipeline() as pipe:
+            self.worker.heartbeat(HEARTBEAT_TTL, pipeline=pipe)
+            for job, execution in running:
+                execution.heartbeat(job.started_job_registry, HEARTBEAT_TTL, pipeline=pipe)
+                job.heartbeat(now(), HEARTBEAT_TTL, pipeline=pipe, xx=True)
+            pipe.execute()
+
+    def _perform(self, job, queue):
+        """Runs a job with the bookkeeping rq's perform_job does: started registry, result, failed registry/retry."""
+        name = self.worker.name
+        with self.conn.pipeline() as pipe:
+            execution = Execution.create(job, HEARTBEAT_TTL, pipeline=pipe, worker_name=name)
+            job.prepare_for_execution(name, pipeline=pipe)
+            pipe.execute()
+        with self.lock: self.running[job.id] = (job, execution)
+        job.started_at = now()
+        try:
+            job.perform()
+            ok, exc = True, None
+        except Exception:
+            ok, exc = False, traceback.format_exc()
+            print(f"❌ Job {job.id} failed:\n{exc}")
+        job.ended_at = now()
+        with self.lock: self.running.pop(job.id, None)
+
+        with self.conn.pipeline() as pipe:
+            if ok:
+                result_ttl = job.get_result_ttl(RESULT_TTL)
+                job._status = JobStatus.FINISHED
+                if result_ttl != 0:
+                    job._handle_success(result_ttl, pipeline=pipe, worker_name=name, execution_id=execution.id,
+                                        execution_started_at=execution.created_at, execution_ended_at=job.ended_at)
+                job.cleanup(result_ttl, pipeline=pipe, remove_from_queue=False)
+                self.worker.increment_successful_job_count(pipeline=pipe)
+            elif job.should_retry:
+                job.retry(queue, pipe)
+                self.worker.increment_failed_job_count(pipeline=pipe)
+            else:
+                job.set_status(JobStatus.FAILED, pipeline=pipe)
+                job._handle_failure(exc, pipe, worker_name=name, execution_id=execution.id,
+                                    execution_started_at=execution.created_at, execution_ended_at=job.ended_at)
+                self.worker.increment_failed_job_count(pipeline=pipe)
+            self.worker.increment_total_working_time(job.ended_at - job.started_at, pipe)
+            execution.delete(job=job, pipeline=pipe)
+            pipe.execute()
+
+    def _shutdown(self):
+        self.executor.shutdown(wait=True)
+        requeued = 0
+        with self.lock:
+            for lane in self.lanes.values():
+                # Front of the queue, in their original order
+                for job, queue in reversed(lane):
+                    if self.fair: self.fair.requeue_front(job)
+                    else: queue.enqueue_job(job, at_front=True)
+                    requeued += 1
+            self.lanes.clear()
+        flush_sends()
+        self.worker.register_death()
+        print(f"👋 Worker stopped ({requeued} waiting jobs requeued)")
+
+def run_invoice_pool():
+    from rq.worker_pool import WorkerPool
+    warm_up(llm=False)
+    print(f"🧾 Invoice workers started ({INVOICE_WORKERS} processes)...")
+    pool = WorkerPool([INVOICE_QUEUE], connection=conn, num_workers=INVOICE_WORKERS,
+                      worker_class=Worker if USE_FORK else SimpleWorker)
+    pool.start()
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--invoices', action='store_true', help=f"render PDFs from {INVOICE_QUEUE} instead of handling messages")
+    parser.add_argument('--batches', action='store_true', help=f"run bulk exports from {BATCH_QUEUE} instead of handling messages")
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY, help="jobs run at once in this process")
+    args = parser.parse_args()
+    if args.invoices:
+        run_invoice_pool()
+        sys.exit(0)
+    if args.batches:
+        warm_up(llm=False)
+        print(f"📦 Batch worker started on {BATCH_QUEUE}...")
+        worker_cls = Worker if USE_FORK else SimpleWorker
+        worker_cls([Queue(BATCH_QUEUE, connection=conn)], connection=conn).work()
+        sys.exit(0)
+
+    # Every in-flight job holds a DB connection for its unit of work
+    if args.concurrency > 1:
+        os.environ.setdefault('DB_POOL_SIZE', str(args.concurrency))
+
+    warm_up(pdf=False)
+    # Prometheus /metrics on METRICS_PORT (stage latencies, intents, DB queries per job)
+    from metrics_merchant import start_exporter
+    start_exporter()
     print("🚀 Worker Merchant Started (Path Patched)...")
+    threading.Thread(target=maintenance_loop, name="maintenance", daemon=True).start()
     queues = [Queue(name, connection=conn) for name in listen]
-    worker = Worker(queues, connection=conn)
-    worker.work()
-
+    if args.concurrency > 1 or FAIR_SCHEDULING:
+        print(f"🧵 Running up to {args.concurrency} jobs at once" + (", fair per merchant" if FAIR_SCHEDULING else ""))
+        ConcurrentWorker(queues, conn, args.concurrency, fair=FAIR_SCHEDULING).work()
+    else:
+        worker_cls = Worker if USE_FORK else SimpleWorker
+        worker = worker_cls(queues, connection=conn)
+        # with_scheduler runs enqueue_in() jobs (coalesced message flushes)
+        worker.work(with_scheduler=True)
+        flush_sends()